@@ -0,0 +1,240 @@
+import asyncio
+import socket
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Set
+
+from config import (
+    IDLE_IN_TRANSACTION_TIMEOUT,
+    IDLE_SESSION_TIMEOUT,
+    MAX_BACKEND_CONNECTS,
+    MAX_CLIENT_CONNECTIONS,
+    SSL_REQUEST_CODE,
+    TCP_KEEPALIVE,
+    TCP_KEEPALIVE_COUNT,
+    TCP_KEEPALIVE_IDLE,
+    TCP_KEEPALIVE_INTERVAL,
+    TCP_NODELAY,
+)
+from pg_protocol import CANCEL_REQUEST_CODE, GSSENC_REQUEST_CODE, error_response, read_startup_packet
+from proxy_logging import conn_log
+
+# Controle de admissão do proxy: limites de clientes simultâneos e de conexões
+# ao PostgreSQL sendo abertas ao mesmo tempo (com fila e tempo máximo de
+# espera), opções TCP dos sockets e encerramento de clientes ociosos.
+
+# Status de transação do ReadyForQuery ('T' e 'E' = dentro de uma transação)
+_IN_TRANSACTION = (84, 69)
+
+# Cabeçalho de um ReadyForQuery; o byte seguinte é o status da transação
+READY_FOR_QUERY_HEADER = b'Z\x00\x00\x00\x05'
+# Mensagens do cliente respondidas com um ReadyForQuery: 'Q', 'S' (Sync) e 'F'
+READY_REQUEST_TYPES = frozenset(b'QSF')
+# Mensagens do protocolo estendido que deixam a conexão à espera de um Sync
+EXTENDED_QUERY_TYPES = frozenset(b'PBEDCH')
+
+
+# Limite de concorrência com fila FIFO: quem chega com o limite atingido
+# espera uma vaga até o tempo máximo. A vaga liberada passa direto para o
+# primeiro da fila (`active` não muda).
+class ConcurrencyLimit:
+    __slots__ = ('limit', 'active', '_waiters', 'waited', 'timeouts')
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self.waited = 0
+        self.timeouts = 0
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.limit <= 0 or (self.active < self.limit and not self._waiters):
+            self.active += 1
+            return True
+        self.waited += 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout if timeout > 0 else None)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        return True
+
+    def release(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    def waiting(self) -> int:
+        return sum(1 for waiter in self._waiters if not waiter.done())
+
+
+client_slots = ConcurrencyLimit(MAX_CLIENT_CONNECTIONS)
+backend_connect_slots = ConcurrencyLimit(MAX_BACKEND_CONNECTS)
+
+
+def configure_socket(writer: asyncio.StreamWriter) -> None:
+    sock = writer.get_extra_info('socket')
+    if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 if TCP_NODELAY else 0)
+        if not TCP_KEEPALIVE:
+            return
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # Ajustes finos só onde o sistema oferece (Linux; parte no macOS)
+        for name, value in (
+            ('TCP_KEEPIDLE', TCP_KEEPALIVE_IDLE),
+            ('TCP_KEEPINTVL', TCP_KEEPALIVE_INTERVAL),
+            ('TCP_KEEPCNT', TCP_KEEPALIVE_COUNT),
+        ):
+            option = getattr(socket, name, None)
+            if option is not None and value > 0:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+    except OSError as e:
+        conn_log.debug('Não foi possível ajustar opções TCP: %s', e)
+
+
+async def reject_client(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, code: str, text: str
+) -> None:
+    # Lê o pacote de inicialização (negando SSL) antes de responder, para o
+    # cliente receber a ErrorResponse em vez de um reset da conexão
+    try:
+        while True:
+            packet_code, _ = await asyncio.wait_for(read_startup_packet(reader), 5)
+            if packet_code == SSL_REQUEST_CODE or packet_code == GSSENC_REQUEST_CODE:
+                writer.write(b'N')
+                continue
+            if packet_code != CANCEL_REQUEST_CODE:
+                writer.write(error_response(code, text, 'FATAL'))
+                await writer.drain()
+            break
+    except Exception:
+        pass
+    finally:
+        writer.close()
+
+
+# Estado de ociosidade de um cliente. `idle_since` é zerado quando o cliente
+# envia dados e marcado quando o servidor responde à última requisição
+# pendente (ReadyForQuery); `status` é o status de transação desse
+# ReadyForQuery. `pending` e `unsynced` (mensagens do protocolo estendido
+# enviadas depois do último Sync) só são usados fora do modo pool. `tail`
+# guarda os últimos bytes do repasse sem enquadramento, para um ReadyForQuery
+# dividido entre duas leituras.
+class IdleTracker:
+    __slots__ = ('writer', 'idle_since', 'status', 'pending', 'unsynced', 'tail')
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer = writer
+        self.idle_since = time.monotonic()
+        self.status = 73
+        self.pending = 0
+        self.unsynced = False
+        self.tail = b''
+
+    def request(self, msg_type: int) -> None:
+        # Mensagem do cliente enviada ao servidor
+        if msg_type in READY_REQUEST_TYPES:
+            self.pending += 1
+            self.unsynced = False
+        elif msg_type in EXTENDED_QUERY_TYPES:
+            self.unsynced = True
+
+    def ready(self, status: int) -> None:
+        if self.pending > 0:
+            self.pending -= 1
+        if self.pending == 0:
+            self.idle_since = time.monotonic()
+            self.status = status
+
+    def ready_raw(self, data: bytes) -> None:
+        # Repasse sem enquadramento: conta os ReadyForQuery da leitura, mais
+        # o que começou no fim da anterior (a junção dos 4 últimos bytes dela
+        # com os 4 primeiros desta só contém cabeçalhos que cruzam a divisa),
+        # e só considera o cliente ocioso se o fluxo termina em um
+        count = data.count(READY_FOR_QUERY_HEADER) + (self.tail[1:] + data[:4]).count(READY_FOR_QUERY_HEADER)
+        last = (self.tail + data[-6:])[-6:]
+        self.tail = last[-5:]
+        if count:
+            self.pending = max(0, self.pending - count)
+        if self.pending == 0 and len(last) == 6 and last[:5] == READY_FOR_QUERY_HEADER:
+            self.idle_since = time.monotonic()
+            self.status = last[5]
+
+
+_tracked: Set[IdleTracker] = set()
+_idle_stats: Dict[str, int] = {'idle_in_transaction_timeouts': 0, 'idle_session_timeouts': 0}
+
+
+def idle_timeouts_enabled() -> bool:
+    return IDLE_IN_TRANSACTION_TIMEOUT > 0 or IDLE_SESSION_TIMEOUT > 0
+
+
+def track_idle(writer: asyncio.StreamWriter) -> Optional[IdleTracker]:
+    if not idle_timeouts_enabled():
+        return None
+    tracker = IdleTracker(writer)
+    _tracked.add(tracker)
+    return tracker
+
+
+def untrack_idle(tracker: Optional[IdleTracker]) -> None:
+    if tracker is not None:
+        _tracked.discard(tracker)
+
+
+def _expire(tracker: IdleTracker, in_transaction: bool) -> None:
+    _tracked.discard(tracker)
+    peer = tracker.writer.get_extra_info('peername')
+    if in_transaction:
+        _idle_stats['idle_in_transaction_timeouts'] += 1
+        conn_log.warning('Encerrando cliente %s: ocioso dentro de uma transação', peer, extra={'peer': str(peer)})
+        error = error_response(
+            '25P03', 'conexão encerrada por IDLE_IN_TRANSACTION_TIMEOUT (ociosa dentro de uma transação)', 'FATAL'
+        )
+    else:
+        _idle_stats['idle_session_timeouts'] += 1
+        conn_log.info('Encerrando cliente %s: sessão ociosa', peer, extra={'peer': str(peer)})
+        error = error_response('57P05', 'conexão encerrada por IDLE_SESSION_TIMEOUT (sessão ociosa)', 'FATAL')
+    try:
+        tracker.writer.write(error)
+        tracker.writer.close()
+    except Exception:
+        pass
+
+
+async def reap_idle_clients() -> None:
+    # Uma única tarefa por processo verifica todos os clientes; o fechamento
+    # do socket do cliente encerra os laços de encaminhamento da conexão
+    interval = min(t for t in (IDLE_IN_TRANSACTION_TIMEOUT, IDLE_SESSION_TIMEOUT) if t > 0) / 4
+    interval = min(1.0, max(0.1, interval))
+    while True:
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        for tracker in list(_tracked):
+            if not tracker.idle_since or tracker.pending:
+                continue
+            in_transaction = tracker.status in _IN_TRANSACTION
+            timeout = IDLE_IN_TRANSACTION_TIMEOUT if in_transaction else IDLE_SESSION_TIMEOUT
+            if timeout > 0 and now - tracker.idle_since > timeout:
+                _expire(tracker, in_transaction)
+
+
+def admission_stats() -> Dict[str, int]:
+    stats = dict(_idle_stats)
+    stats['clients_waiting'] = client_slots.waiting()
+    stats['clients_rejected'] = client_slots.timeouts
+    stats['backend_connects_active'] = backend_connect_slots.active
+    stats['backend_connects_waiting'] = backend_connect_slots.waiting()
+    stats['backend_connect_queue_timeouts'] = backend_connect_slots.timeouts
+    return stats
@@ -0,0 +1,339 @@
+import re
+import struct
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from config import AUTO_PREPARE_MAX_STATEMENTS, AUTO_PREPARE_THRESHOLD
+from lru_cache import LRUCache
+from pg_protocol import message, pack_uint32, parse_error_fields
+from proxy_logging import query_log
+
+# Promoção automática de consultas simples ('Q') repetidas a statements
+# preparados. O texto de cada 'Q' tem os literais trocados por parâmetros
+# ($1, $2...); quando o mesmo texto passa de AUTO_PREPARE_THRESHOLD execuções
+# numa conexão com o backend, o proxy prepara o statement (Parse + Sync antes
+# da própria consulta, com a conexão ociosa fora de transação) e daí em diante
+# envia Bind/Describe/Execute/Sync com os literais extraídos. As respostas
+# acrescentadas (ParseComplete, BindComplete, NoData, CloseComplete e o
+# ReadyForQuery da preparação) são retiradas do fluxo para o cliente, que vê
+# exatamente a resposta de uma consulta simples: RowDescription e DataRow em
+# formato texto, CommandComplete e ReadyForQuery.
+#
+# Um Parse recusado pelo servidor (literal que precisa continuar literal, tipo
+# que não pode ser inferido) não chega ao cliente e o texto nunca mais é
+# promovido; a consulta original segue logo depois, como sempre.
+
+AUTO_PREPARE_ENABLED = AUTO_PREPARE_THRESHOLD > 0
+
+# Consultas maiores que isso não são contadas nem promovidas
+_MAX_QUERY_BYTES = 65536
+_MAX_PARAMS = 65535
+# Textos contados por conexão (os mais antigos são esquecidos)
+_MAX_COUNTED = 4 * max(AUTO_PREPARE_MAX_STATEMENTS, 1)
+
+_INT4_MAX = 2147483647
+_INT8_MAX = 9223372036854775807
+_OID_INT4 = 23
+_OID_INT8 = 20
+_OID_NUMERIC = 1700
+
+_PROBE = 0
+_EXECUTE = 1
+
+_WORD_CHARS = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_$' + bytes(range(0x80, 0x100)))
+_SPACE_CHARS = frozenset(b' \t\n\r\x0b\x0c')
+# Palavras depois das quais uma string é um valor; depois de qualquer outra
+# ela pode ser um literal tipado (date '...', interval '...') e fica no texto
+_VALUE_KEYWORDS = frozenset((
+    b'select', b'where', b'and', b'or', b'not', b'case', b'when', b'then', b'else', b'like', b'ilike',
+    b'between', b'escape', b'from', b'distinct', b'any', b'all', b'some', b'having', b'on', b'is',
+    b'limit', b'offset', b'returning',
+))
+
+# Só comandos DML de um único statement são promovidos
+_PROMOTABLE_START_RE = re.compile(
+    rb'(?:\s|--[^\n]*\n|/\*.*?\*/)*(?:select|insert|update|delete|with|values)\b', re.IGNORECASE | re.DOTALL
+)
+_RESET_RE = re.compile(rb'\s*(?:discard\s+all|deallocate\s+(?:prepare\s+)?all)\b', re.IGNORECASE)
+_LITERAL_RE = re.compile(
+    rb'"(?:[^"]|"")*"'
+    rb'|--[^\n]*'
+    rb'|/\*.*?\*/'
+    rb'|(?<![A-Za-z0-9_$\x80-\xff])\$(?P<tag>(?:[A-Za-z_\x80-\xff][A-Za-z0-9_\x80-\xff]*)?)\$.*?\$(?P=tag)\$'
+    rb"|(?P<str>'(?:[^']|'')*')"
+    rb'|(?P<num>(?<![A-Za-z0-9_$\x80-\xff.])(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?'
+    rb'(?![A-Za-z0-9_$\x80-\xff.]))'
+    rb'|(?P<sort>(?<![A-Za-z0-9_$\x80-\xff])(?:order\s+by|group\s+by|distinct\s+on)(?![A-Za-z0-9_$\x80-\xff]))'
+    rb'|(?P<end>;)'
+    rb"|(?P<open>['\"]|/\*|(?<![A-Za-z0-9_$\x80-\xff])\$)",
+    re.IGNORECASE | re.DOTALL,
+)
+# Erros que indicam que o statement preparado não existe mais ou ficou
+# inválido (DEALLOCATE feito pelo cliente, mudança de colunas da tabela)
+_STALE_STATEMENT_CODES = frozenset(('26000', '0A000'))
+
+_pack_uint16 = struct.Struct('!H').pack
+_DESCRIBE_EXECUTE_SYNC = message(b'D', b'P\x00') + message(b'E', b'\x00' + pack_uint32(0)) + message(b'S')
+_SYNC = message(b'S')
+
+StatementKey = Tuple[bytes, Tuple[int, ...]]
+Parameterized = Tuple[bytes, Tuple[int, ...], List[bytes]]
+
+# Textos cujo Parse o servidor recusou, compartilhados por todas as conexões
+_unpreparable = LRUCache(4096, 4 * 1024 * 1024)
+_stats = {'prepared': 0, 'prepare_failures': 0, 'executions': 0, 'evictions': 0, 'invalidations': 0}
+
+
+def _previous_char(query: bytes, pos: int) -> int:
+    # Posição do último caractere antes de `pos` que não é espaço (-1 se não há)
+    pos -= 1
+    while pos >= 0 and query[pos] in _SPACE_CHARS:
+        pos -= 1
+    return pos
+
+
+def _previous_word(query: bytes, pos: int) -> bytes:
+    start = pos
+    while start > 0 and query[start - 1] in _WORD_CHARS:
+        start -= 1
+    return query[start:pos + 1].lower()
+
+
+def _string_stays_literal(query: bytes, start: int, text: bytes) -> bool:
+    # E'...', U&'...', B'...', literais tipados e strings com barra invertida
+    # (cujo sentido depende de standard_conforming_strings) ficam no texto
+    if b'\\' in text:
+        return True
+    if start > 0 and (query[start - 1] in _WORD_CHARS or query[start - 1] == 38):
+        return True
+    prev = _previous_char(query, start)
+    if prev < 0:
+        return False
+    if query[prev] == 34:
+        return True
+    return query[prev] in _WORD_CHARS and _previous_word(query, prev) not in _VALUE_KEYWORDS
+
+
+def _number_is_position(query: bytes, start: int) -> bool:
+    # ORDER BY 1, GROUP BY 1, 2 e DISTINCT ON (1) se referem a colunas;
+    # como parâmetro o número viraria uma constante
+    prev = _previous_char(query, start)
+    if prev < 0:
+        return False
+    char = query[prev]
+    return char == 44 or char == 40 or (char in _WORD_CHARS and _previous_word(query, prev) == b'by')
+
+
+def _number_type(text: bytes) -> int:
+    # Mesmo tipo que o PostgreSQL dá ao literal
+    if b'.' in text or b'e' in text or b'E' in text:
+        return _OID_NUMERIC
+    value = int(text)
+    if value <= _INT4_MAX:
+        return _OID_INT4
+    if value <= _INT8_MAX:
+        return _OID_INT8
+    return _OID_NUMERIC
+
+
+def parameterize(query: bytes) -> Optional[Parameterized]:
+    # (texto com $1, $2..., tipo de cada parâmetro, valores em formato texto),
+    # ou None se a consulta não pode ser promovida
+    if len(query) > _MAX_QUERY_BYTES or _PROMOTABLE_START_RE.match(query) is None:
+        return None
+    out = []
+    types = []
+    values: List[bytes] = []
+    last = 0
+    sorting = False
+    for m in _LITERAL_RE.finditer(query):
+        kind = m.lastgroup
+        if kind is None or kind == 'tag':
+            continue
+        if kind == 'sort':
+            sorting = True
+            continue
+        if kind == 'end':
+            if query[m.end():].strip(b' \t\n\r\x0b\x0c;'):
+                return None
+            break
+        if kind == 'open':
+            return None
+        start = m.start()
+        text = m.group()
+        if kind == 'str':
+            if _string_stays_literal(query, start, text):
+                continue
+            types.append(0)
+            values.append(text[1:-1].replace(b"''", b"'"))
+        else:
+            if sorting and _number_is_position(query, start):
+                continue
+            types.append(_number_type(text))
+            values.append(text)
+        out.append(query[last:start])
+        out.append(b'$%d' % len(values))
+        last = m.end()
+    if len(values) > _MAX_PARAMS:
+        return None
+    out.append(query[last:])
+    return b''.join(out), tuple(types), values
+
+
+def _parse_message(name: bytes, text: bytes, types: Tuple[int, ...]) -> bytes:
+    return message(
+        b'P', name + b'\x00' + text + b'\x00' + _pack_uint16(len(types)) + struct.pack(f'!{len(types)}I', *types)
+    )
+
+
+def _bind_message(name: bytes, values: List[bytes]) -> bytes:
+    # Parâmetros e resultados em formato texto, como na consulta simples
+    parts = [b'\x00', name, b'\x00\x00\x00', _pack_uint16(len(values))]
+    for value in values:
+        parts.append(pack_uint32(len(value)))
+        parts.append(value)
+    parts.append(b'\x00\x00')
+    body = b''.join(parts)
+    return b'B' + pack_uint32(len(body) + 4) + body
+
+
+# Statements criados pelo proxy numa conexão com o backend e contagem dos
+# textos ainda não promovidos. Vive enquanto a conexão existir (no modo pool,
+# passa de um cliente para outro junto com ela).
+class ServerStatements:
+    __slots__ = ('names', 'counts', 'next_id')
+
+    def __init__(self) -> None:
+        self.names: Dict[StatementKey, bytes] = {}
+        self.counts: Dict[StatementKey, int] = {}
+        self.next_id = 0
+
+    def clear(self) -> None:
+        # DISCARD ALL / DEALLOCATE ALL removem os statements no servidor
+        self.names.clear()
+        self.counts.clear()
+
+    def count(self, key: StatementKey) -> int:
+        counts = self.counts
+        count = counts.get(key, 0) + 1
+        if count == 1 and len(counts) >= _MAX_COUNTED:
+            del counts[next(iter(counts))]
+        counts[key] = count
+        return count
+
+    def new_name(self) -> Tuple[bytes, bytes]:
+        # (nome do novo statement, Close do mais antigo se o limite foi atingido)
+        close = b''
+        if len(self.names) >= AUTO_PREPARE_MAX_STATEMENTS:
+            oldest = next(iter(self.names))
+            close = message(b'C', b'S' + self.names.pop(oldest) + b'\x00')
+            _stats['evictions'] += 1
+        self.next_id += 1
+        return b'proxy_auto_%d' % self.next_id, close
+
+
+# Estado da promoção num fluxo cliente->backend: as respostas esperadas, na
+# ordem das requisições que terminam em ReadyForQuery ('Q', 'S', 'F'), para
+# saber quais mensagens do servidor foram pedidas pelo proxy.
+class AutoPrepare:
+    __slots__ = ('server', 'expected', 'unsynced', 'status')
+
+    def __init__(self, server: Optional[ServerStatements] = None) -> None:
+        self.server = server
+        # None = resposta que segue inteira para o cliente; senão
+        # (_PROBE ou _EXECUTE, chave, nome do statement)
+        self.expected: Deque[Optional[Tuple[int, StatementKey, bytes]]] = deque()
+        self.unsynced = False
+        self.status = 73
+
+    def client_message(self, msg_type: int) -> None:
+        # Mensagens do cliente que não são uma 'Q' inteira
+        if msg_type == 83:
+            self.unsynced = False
+            self.expected.append(None)
+        elif msg_type == 81 or msg_type == 70:
+            self.expected.append(None)
+        elif msg_type in b'PBEDCH':
+            self.unsynced = True
+
+    def simple_query(self, query: bytes) -> Optional[bytes]:
+        # Mensagens a enviar no lugar da 'Q', ou None para enviá-la como está
+        expected = self.expected
+        server = self.server
+        if server is None or self.unsynced:
+            expected.append(None)
+            return None
+        if _RESET_RE.match(query) is not None:
+            server.clear()
+            expected.append(None)
+            return None
+        parameterized = parameterize(query)
+        if parameterized is None:
+            expected.append(None)
+            return None
+        text, types, values = parameterized
+        key = (text, types)
+        name = server.names.get(key)
+        if name is not None:
+            expected.append((_EXECUTE, key, name))
+            _stats['executions'] += 1
+            return _bind_message(name, values) + _DESCRIBE_EXECUTE_SYNC
+        if (
+            expected
+            or self.status != 73
+            or key in _unpreparable
+            or server.count(key) < AUTO_PREPARE_THRESHOLD
+        ):
+            expected.append(None)
+            return None
+        # Prepara fora de transação (um Parse recusado abortaria a transação)
+        # e executa a consulta original desta vez
+        name, close = server.new_name()
+        del server.counts[key]
+        expected.append((_PROBE, key, name))
+        expected.append(None)
+        return close + _parse_message(name, text, types) + _SYNC + message(b'Q', query + b'\x00')
+
+    def server_message(self, data: bytes, start: int, end: int) -> bool:
+        # Chamado para cada mensagem completa do servidor enquanto há respostas
+        # esperadas; False quando ela responde ao proxy e não vai ao cliente
+        entry = self.expected[0]
+        msg_type = data[start]
+        if msg_type == 90:
+            self.expected.popleft()
+            if entry is not None and entry[0] == _PROBE:
+                return False
+            self.status = data[start + 5]
+            return True
+        if entry is None:
+            return True
+        kind, key, name = entry
+        if kind == _PROBE:
+            if msg_type == 49:
+                self.server.names[key] = name
+                _stats['prepared'] += 1
+                query_log.debug('Consulta promovida a statement preparado %s: %r', name, key[0])
+                return False
+            if msg_type == 69:
+                _unpreparable.put(key, True, len(key[0]))
+                _stats['prepare_failures'] += 1
+                query_log.debug(
+                    'Parse recusado, consulta segue sem preparar: %s (%r)',
+                    parse_error_fields(data[start + 5:end]).get('M', ''), key[0],
+                )
+                return False
+            return msg_type != 51
+        if msg_type == 50 or msg_type == 110 or msg_type == 51:
+            return False
+        if msg_type == 69 and parse_error_fields(data[start + 5:end]).get('C') in _STALE_STATEMENT_CODES:
+            # Prepara de novo numa próxima vez
+            if self.server.names.get(key) == name:
+                del self.server.names[key]
+                _stats['invalidations'] += 1
+        return True
+
+
+def auto_prepare_stats() -> Dict[str, int]:
+    stats = dict(_stats)
+    stats['unpreparable'] = len(_unpreparable)
+    return stats
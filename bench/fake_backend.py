@@ -0,0 +1,272 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import re
+import ssl
+import struct
+from typing import List, Optional
+
+# Backend PostgreSQL de mentira, só com o necessário do protocolo v3 para
+# medir o proxy: inicialização (sem senha, md5 ou SCRAM-SHA-256), consulta
+# simples e estendida e COPY.
+#
+# Consultas no formato `ROWS <n> [WIDTH <w>]` retornam n linhas com uma coluna
+# de w bytes, `ERROR <sqlstate>` retorna um ErrorResponse e qualquer outra
+# consulta retorna uma linha com o próprio texto. `COPY ... TO STDOUT` envia
+# as linhas de `ROWS <n> [WIDTH <w>]` (se presente no texto) como CopyData, e
+# `COPY ... FROM STDIN` aceita CopyData até CopyDone e conta as linhas.
+# Com --tls-cert/--tls-key o SSLRequest é aceito, para testar o TLS com o
+# PostgreSQL (BACKEND_TLS_MODE).
+
+SSL_REQUEST_CODE = 80877103
+PROTOCOL_V3 = 196608
+
+_ROWS_RE = re.compile(rb'^\s*ROWS\s+(\d+)(?:\s+WIDTH\s+(\d+))?', re.IGNORECASE)
+_COPY_SIZE_RE = re.compile(rb'ROWS\s+(\d+)(?:\s+WIDTH\s+(\d+))?', re.IGNORECASE)
+_pack_uint32 = struct.Struct('!I').pack
+
+
+def message(msg_type: bytes, body: bytes = b'') -> bytes:
+    return msg_type + _pack_uint32(len(body) + 4) + body
+
+
+def row_description(column: bytes = b'q') -> bytes:
+    return message(b'T', struct.pack('!H', 1) + column + b'\x00' + struct.pack('!IhIhih', 0, 0, 25, -1, -1, 0))
+
+
+def data_row(value: bytes) -> bytes:
+    return message(b'D', struct.pack('!HI', 1, len(value)) + value)
+
+
+def error_response(code: bytes, text: bytes) -> bytes:
+    return message(b'E', b'SERROR\x00VERROR\x00C' + code + b'\x00M' + text + b'\x00\x00')
+
+
+def result_set(query: bytes) -> List[bytes]:
+    m = _ROWS_RE.match(query)
+    if m is None:
+        return [data_row(query)]
+    count = int(m.group(1))
+    width = int(m.group(2) or 16)
+    row = data_row(b'x' * width)
+    return [row] * count
+
+
+def copy_out(query: bytes) -> List[bytes]:
+    m = _COPY_SIZE_RE.search(query)
+    count = int(m.group(1)) if m else 1
+    width = int((m and m.group(2)) or 16)
+    line = message(b'd', b'x' * width + b'\n')
+    return [message(b'H', b'\x00' + struct.pack('!hh', 1, 0))] + [line] * count + [
+        message(b'c'), message(b'C', b'COPY %d\x00' % count)
+    ]
+
+
+def _hmac(key: bytes, data: bytes) -> bytes:
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+
+class FakeBackendSession:
+    def __init__(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, auth: str = 'trust', password: str = '',
+        tls: Optional[ssl.SSLContext] = None,
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        self.auth = auth
+        self.password = password
+        self.tls = tls
+        self.user = ''
+        self.status = b'I'
+        self.statements = {}
+        self.portal_query: Optional[bytes] = None
+        # Linhas recebidas no COPY FROM STDIN em andamento (None fora do COPY)
+        self.copy_in_rows: Optional[int] = None
+
+    async def _read_password_message(self) -> bytes:
+        header = await self.reader.readexactly(5)
+        return await self.reader.readexactly(struct.unpack('!I', header[1:])[0] - 4)
+
+    async def _authenticate(self) -> bool:
+        if self.auth == 'md5':
+            salt = os.urandom(4)
+            self.writer.write(message(b'R', _pack_uint32(5) + salt))
+            await self.writer.drain()
+            response = (await self._read_password_message()).rstrip(b'\x00')
+            inner = hashlib.md5((self.password + self.user).encode()).hexdigest()
+            return response == b'md5' + hashlib.md5(inner.encode() + salt).hexdigest().encode()
+        if self.auth == 'scram':
+            salt = os.urandom(16)
+            iterations = 4096
+            salted = hashlib.pbkdf2_hmac('sha256', self.password.encode(), salt, iterations)
+            client_key = _hmac(salted, b'Client Key')
+            stored_key = hashlib.sha256(client_key).digest()
+            self.writer.write(message(b'R', _pack_uint32(10) + b'SCRAM-SHA-256\x00\x00'))
+            await self.writer.drain()
+            body = await self._read_password_message()
+            client_first = body[body.index(b'\x00') + 5:]
+            client_first_bare = client_first[3:]
+            client_nonce = dict(a.split(b'=', 1) for a in client_first_bare.split(b','))[b'r']
+            server_first = b'r=%s%s,s=%s,i=%d' % (
+                client_nonce, base64.b64encode(os.urandom(12)), base64.b64encode(salt), iterations
+            )
+            self.writer.write(message(b'R', _pack_uint32(11) + server_first))
+            await self.writer.drain()
+            client_final = await self._read_password_message()
+            without_proof, proof = client_final.rsplit(b',p=', 1)
+            auth_message = client_first_bare + b',' + server_first + b',' + without_proof
+            signature = _hmac(stored_key, auth_message)
+            recovered = bytes(a ^ b for a, b in zip(base64.b64decode(proof), signature))
+            if hashlib.sha256(recovered).digest() != stored_key:
+                return False
+            server_signature = _hmac(_hmac(salted, b'Server Key'), auth_message)
+            self.writer.write(message(b'R', _pack_uint32(12) + b'v=' + base64.b64encode(server_signature)))
+        return True
+
+    async def startup(self) -> bool:
+        while True:
+            header = await self.reader.readexactly(8)
+            length, code = struct.unpack('!II', header)
+            body = await self.reader.readexactly(length - 8)
+            if code == SSL_REQUEST_CODE:
+                if self.tls is None or self.writer.get_extra_info('ssl_object') is not None:
+                    self.writer.write(b'N')
+                    continue
+                self.writer.write(b'S')
+                await self.writer.drain()
+                await self.writer.start_tls(self.tls)
+                continue
+            if code != PROTOCOL_V3:
+                return False
+            break
+        parts = body.split(b'\x00')
+        params = dict(zip(parts[0::2], parts[1::2]))
+        self.user = params.get(b'user', b'').decode()
+        if not await self._authenticate():
+            self.writer.write(error_response(b'28P01', b'password authentication failed'))
+            await self.writer.drain()
+            return False
+        self.writer.write(
+            message(b'R', _pack_uint32(0))
+            + message(b'S', b'server_version\x0016.0\x00')
+            + message(b'S', b'client_encoding\x00UTF8\x00')
+            + message(b'K', struct.pack('!II', 4242, 1234))
+            + message(b'Z', self.status)
+        )
+        await self.writer.drain()
+        return True
+
+    def simple_query(self, query: bytes) -> None:
+        upper = query.lstrip().upper()
+        if upper.startswith(b'BEGIN'):
+            self.status = b'T'
+            out = [message(b'C', b'BEGIN\x00')]
+        elif upper.startswith(b'COMMIT') or upper.startswith(b'ROLLBACK'):
+            self.status = b'I'
+            out = [message(b'C', upper.split()[0].rstrip(b';') + b'\x00')]
+        elif upper.startswith(b'COPY') and b'FROM STDIN' in upper:
+            self.copy_in_rows = 0
+            self.writer.write(message(b'G', b'\x00' + struct.pack('!hh', 1, 0)))
+            return
+        elif upper.startswith(b'COPY'):
+            out = copy_out(query)
+        elif upper.startswith(b'ERROR'):
+            code = (upper.split() + [b'XX000'])[1][:5]
+            if self.status == b'T':
+                self.status = b'E'
+            out = [error_response(code, b'erro simulado')]
+        else:
+            rows = result_set(query)
+            out = [row_description()]
+            out.extend(rows)
+            out.append(message(b'C', b'SELECT %d\x00' % len(rows)))
+        out.append(message(b'Z', self.status))
+        self.writer.writelines(out)
+
+    def copy_in(self, msg_type: bytes, body: bytes) -> None:
+        if msg_type == b'd':
+            self.copy_in_rows += body.count(b'\n')
+            return
+        if msg_type == b'c':
+            out = message(b'C', b'COPY %d\x00' % self.copy_in_rows)
+        else:
+            out = error_response(b'57014', b'COPY cancelado pelo cliente')
+        self.copy_in_rows = None
+        self.writer.write(out + message(b'Z', self.status))
+
+    def extended(self, msg_type: bytes, body: bytes) -> None:
+        if msg_type == b'P':
+            name, query, _ = body.split(b'\x00', 2)
+            self.statements[name] = query
+            self.writer.write(message(b'1'))
+        elif msg_type == b'B':
+            _portal, statement, _ = body.split(b'\x00', 2)
+            self.portal_query = self.statements.get(statement, b'')
+            self.writer.write(message(b'2'))
+        elif msg_type == b'D':
+            self.writer.write(row_description())
+        elif msg_type == b'E':
+            rows = result_set(self.portal_query or b'')
+            self.writer.writelines(rows)
+            self.writer.write(message(b'C', b'SELECT %d\x00' % len(rows)))
+        elif msg_type == b'C':
+            self.writer.write(message(b'3'))
+        elif msg_type == b'S':
+            self.writer.write(message(b'Z', self.status))
+
+    async def run(self) -> None:
+        try:
+            if not await self.startup():
+                return
+            while True:
+                header = await self.reader.readexactly(5)
+                msg_type = header[:1]
+                length = struct.unpack('!I', header[1:])[0]
+                body = await self.reader.readexactly(length - 4)
+                if msg_type == b'X':
+                    break
+                if self.copy_in_rows is not None and msg_type in (b'd', b'c', b'f'):
+                    self.copy_in(msg_type, body)
+                elif msg_type == b'Q':
+                    self.simple_query(body[:-1])
+                else:
+                    self.extended(msg_type, body)
+                await self.writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        finally:
+            self.writer.close()
+
+
+async def run_fake_backend(
+    host: str, port: int, auth: str = 'trust', password: str = '', tls: Optional[ssl.SSLContext] = None
+) -> None:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await FakeBackendSession(reader, writer, auth, password, tls).run()
+
+    server = await asyncio.start_server(handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Backend PostgreSQL de mentira para benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55432)
+    parser.add_argument('--auth', choices=['trust', 'md5', 'scram'], default='trust')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--tls-cert', default='', help='certificado para aceitar SSLRequest')
+    parser.add_argument('--tls-key', default='', help='chave (padrão: o arquivo do certificado)')
+    args = parser.parse_args()
+    tls = None
+    if args.tls_cert:
+        tls = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        tls.load_cert_chain(args.tls_cert, args.tls_key or None)
+    asyncio.run(run_fake_backend(args.host, args.port, args.auth, args.password, tls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+import argparse
+import asyncio
+import os
+import struct
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Mede o proxy contra um backend de mentira: o backend e o proxy (proxy.py,
+# ou seja, run_server) rodam em processos separados e cada fase é executada
+# direto no backend e via proxy. Para cada fase são informados vazão,
+# latência p50/p99 (quando faz sentido) e CPU de cada processo por mensagem
+# recebida pelo cliente.
+#
+#   python -m bench.forwarding --rows 200000 --width 32 --repeat 5 --clients 50
+#   python -m bench.forwarding --proxy-env POOL_MODE=transaction --proxy-env POOL_CLIENT_AUTH=trust
+
+ROOT = Path(__file__).resolve().parent.parent
+PROTOCOL_V3 = 196608
+
+SHORT_QUERY = b'select 10.clientes.nome from 10.clientes where id = 1'
+
+
+def _message(msg_type: bytes, body: bytes = b'') -> bytes:
+    return msg_type + struct.pack('!I', len(body) + 4) + body
+
+
+async def _read_until(reader: asyncio.StreamReader, last: bytes = b'Z') -> Tuple[int, int]:
+    # Retorna (mensagens, bytes) recebidos até a mensagem do tipo `last`
+    messages = 0
+    total = 0
+    while True:
+        header = await reader.readexactly(5)
+        length = struct.unpack('!I', header[1:])[0]
+        await reader.readexactly(length - 4)
+        messages += 1
+        total += 1 + length
+        if header[:1] == last:
+            return messages, total
+
+
+async def connect(host: str, port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    reader, writer = await asyncio.open_connection(host, port)
+    params = b'user\x00bench\x00database\x00bench\x00\x00'
+    writer.write(struct.pack('!II', 8 + len(params), PROTOCOL_V3) + params)
+    await writer.drain()
+    await _read_until(reader)
+    return reader, writer
+
+
+def _disconnect(writer: asyncio.StreamWriter) -> None:
+    writer.write(_message(b'X'))
+    writer.close()
+
+
+# Resultado de uma fase: tempo total, mensagens e bytes recebidos pelo cliente
+# e latências por requisição (vazio quando a fase mede só vazão)
+class PhaseResult:
+    def __init__(self, elapsed: float, messages: int, total: int, latencies: Optional[List[float]] = None) -> None:
+        self.elapsed = elapsed
+        self.messages = messages
+        self.total = total
+        self.latencies = latencies or []
+
+
+async def bench_result_set(host: str, port: int, rows: int, width: int, repeat: int) -> PhaseResult:
+    reader, writer = await connect(host, port)
+    query = _message(b'Q', b'ROWS %d WIDTH %d\x00' % (rows, width))
+    messages = 0
+    total = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        writer.write(query)
+        await writer.drain()
+        m, b = await _read_until(reader)
+        messages += m
+        total += b
+    elapsed = time.perf_counter() - started
+    _disconnect(writer)
+    return PhaseResult(elapsed, messages, total)
+
+
+async def bench_copy_out(host: str, port: int, rows: int, width: int, repeat: int) -> PhaseResult:
+    reader, writer = await connect(host, port)
+    query = _message(b'Q', b'COPY (ROWS %d WIDTH %d) TO STDOUT\x00' % (rows, width))
+    messages = 0
+    total = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        writer.write(query)
+        await writer.drain()
+        m, b = await _read_until(reader)
+        messages += m
+        total += b
+    elapsed = time.perf_counter() - started
+    _disconnect(writer)
+    return PhaseResult(elapsed, messages, total)
+
+
+async def bench_copy_in(host: str, port: int, rows: int, width: int, repeat: int) -> PhaseResult:
+    # Aqui o volume vai do cliente para o servidor: `messages`/`total` contam
+    # o CopyData enviado
+    reader, writer = await connect(host, port)
+    line = _message(b'd', b'x' * width + b'\n')
+    batch = line * 1000
+    messages = 0
+    total = 0
+    started = time.perf_counter()
+    for _ in range(repeat):
+        writer.write(_message(b'Q', b'COPY bench FROM STDIN\x00'))
+        await writer.drain()
+        await _read_until(reader, b'G')
+        sent = 0
+        while sent < rows:
+            count = min(1000, rows - sent)
+            writer.write(batch if count == 1000 else line * count)
+            await writer.drain()
+            sent += count
+        writer.write(_message(b'c'))
+        await writer.drain()
+        await _read_until(reader)
+        messages += rows
+        total += rows * len(line)
+    elapsed = time.perf_counter() - started
+    _disconnect(writer)
+    return PhaseResult(elapsed, messages, total)
+
+
+async def _short_queries(host: str, port: int, count: int, extended: bool) -> Tuple[int, int, List[float]]:
+    reader, writer = await connect(host, port)
+    if extended:
+        # Statement sem nome reenviado a cada execução, como fazem os drivers
+        request = (
+            _message(b'P', b'\x00' + SHORT_QUERY + b'\x00\x00\x00')
+            + _message(b'B', b'\x00\x00\x00\x00\x00\x00\x00\x00')
+            + _message(b'E', b'\x00\x00\x00\x00\x00')
+            + _message(b'S')
+        )
+    else:
+        request = _message(b'Q', SHORT_QUERY + b'\x00')
+    messages = 0
+    total = 0
+    latencies = []
+    for _ in range(count):
+        started = time.perf_counter()
+        writer.write(request)
+        await writer.drain()
+        m, b = await _read_until(reader)
+        latencies.append(time.perf_counter() - started)
+        messages += m
+        total += b
+    _disconnect(writer)
+    return messages, total, latencies
+
+
+async def bench_short_queries(host: str, port: int, count: int, clients: int, extended: bool = False) -> PhaseResult:
+    per_client = max(1, count // clients)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(_short_queries(host, port, per_client, extended) for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    latencies = [latency for _, _, client_latencies in results for latency in client_latencies]
+    return PhaseResult(elapsed, sum(r[0] for r in results), sum(r[1] for r in results), latencies)
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    # utime + stime do processo (Linux); None onde /proc não existe
+    try:
+        fields = Path(f'/proc/{pid}/stat').read_text().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def _report(label: str, phase: str, result: PhaseResult, cpu: Dict[str, Optional[float]]) -> None:
+    line = (
+        f'{label:>6} {phase}: {result.messages / result.elapsed:,.0f} msg/s, '
+        f'{result.total / result.elapsed / 1e6:,.1f} MB/s ({result.elapsed:.2f}s)'
+    )
+    if result.latencies:
+        line += (
+            f', {len(result.latencies) / result.elapsed:,.0f} req/s, '
+            f'p50={_percentile(result.latencies, 0.5) * 1e6:.0f}us '
+            f'p99={_percentile(result.latencies, 0.99) * 1e6:.0f}us'
+        )
+    costs = [
+        f'{name}={seconds / result.messages * 1e6:.2f}us'
+        for name, seconds in cpu.items()
+        if seconds is not None and result.messages
+    ]
+    if costs:
+        line += ', cpu/msg ' + ' '.join(costs)
+    print(line)
+
+
+async def _run(args: argparse.Namespace, pids: Dict[str, int]) -> None:
+    targets = [('direto', args.backend_port), ('proxy', args.proxy_port)]
+    phases = [
+        ('result set', lambda port: bench_result_set(args.host, port, args.rows, args.width, args.repeat)),
+        ('copy out', lambda port: bench_copy_out(args.host, port, args.rows, args.width, args.repeat)),
+        ('copy in', lambda port: bench_copy_in(args.host, port, args.rows, args.width, args.repeat)),
+        ('consultas curtas (1 cliente)', lambda port: bench_short_queries(args.host, port, args.queries, 1)),
+        (
+            f'consultas curtas ({args.clients} clientes)',
+            lambda port: bench_short_queries(args.host, port, args.queries, args.clients),
+        ),
+        (
+            f'protocolo estendido ({args.clients} clientes)',
+            lambda port: bench_short_queries(args.host, port, args.queries, args.clients, extended=True),
+        ),
+    ]
+    for phase, run in phases:
+        for label, port in targets:
+            before = {name: _cpu_seconds(pid) for name, pid in pids.items()}
+            result = await run(port)
+            cpu = {}
+            for name, pid in pids.items():
+                after = _cpu_seconds(pid)
+                cpu[name] = None if after is None or before[name] is None else after - before[name]
+            if label == 'direto':
+                cpu.pop('proxy', None)
+            _report(label, phase, result, cpu)
+
+
+def _wait_port(host: str, port: int, timeout: float = 10.0) -> None:
+    import socket
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Porta {host}:{port} não respondeu')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Benchmark do proxy contra um backend de mentira')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--backend-port', type=int, default=55432)
+    parser.add_argument('--proxy-port', type=int, default=55433)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--width', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--queries', type=int, default=5000, help='total de consultas curtas por fase')
+    parser.add_argument('--clients', type=int, default=50, help='clientes simultâneos nas fases concorrentes')
+    parser.add_argument(
+        '--proxy-env', action='append', default=[], metavar='NOME=VALOR',
+        help='variável de ambiente extra para o proxy (pode repetir)',
+    )
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update({
+        'PG_HOST': args.host,
+        'PG_PORT': str(args.backend_port),
+        'PROXY_HOST': args.host,
+        'PROXY_PORT': str(args.proxy_port),
+        'SSL_REQUEST_CODE': '80877103',
+        'DEBUG_LOG_QUERIES': 'false',
+    })
+    for item in args.proxy_env:
+        name, _, value = item.partition('=')
+        env[name] = value
+    backend = subprocess.Popen(
+        [sys.executable, '-m', 'bench.fake_backend', '--host', args.host, '--port', str(args.backend_port)],
+        cwd=ROOT,
+    )
+    proxy = subprocess.Popen([sys.executable, 'proxy.py'], cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    try:
+        _wait_port(args.host, args.backend_port)
+        _wait_port(args.host, args.proxy_port)
+        asyncio.run(_run(args, {'backend': backend.pid, 'proxy': proxy.pid}))
+    finally:
+        proxy.terminate()
+        backend.terminate()
+        proxy.wait()
+        backend.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,328 @@
+import re
+from typing import Optional
+
+# Reescritor anterior ao motor de regras (rewrite_rules.py), mantido só como
+# referência para os benchmarks e o teste diferencial: `rewrite_schema_table`
+# é a versão original em str e `rewrite_schema_table_bytes` a versão em bytes
+# que a substituiu no proxy. As diferenças intencionais do motor de regras em
+# relação a elas estão descritas junto de DEFAULT_RULES.
+
+
+# Pré-filtro: só vale executar o reescritor se houver dígito seguido de '.'
+# (schema numérico, com ou sem aspas) ou menção a matricula/codlig. Bytes não
+# ASCII entram no filtro porque o reescritor usa str.isdigit/str.isspace.
+_REWRITE_HINT_RE = re.compile(
+    rb'[0-9\x80-\xff][\t\n\x0b\x0c\r\x1c-\x1f \x80-\xff]*\.|matricula|codlig',
+    re.IGNORECASE,
+)
+
+
+def _is_identifier_start(byte: int) -> bool:
+    return (byte == 95) or (65 <= byte <= 90) or (97 <= byte <= 122)
+
+
+def _is_identifier_part(byte: int) -> bool:
+    return _is_identifier_start(byte) or (48 <= byte <= 57) or byte == 36
+
+
+def rewrite_schema_table(sql: str) -> str:
+    s = sql
+    i = 0
+    n = len(s)
+    out = []
+
+    in_squote = False
+    in_dquote = False
+    in_line_comment = False
+    in_block_comment = False
+    dollar_tag: Optional[str] = None
+
+    while i < n:
+        ch = s[i]
+
+        if in_line_comment:
+            out.append(ch)
+            if ch == '\n':
+                in_line_comment = False
+            i += 1
+            continue
+
+        if in_block_comment:
+            out.append(ch)
+            if ch == '*' and i + 1 < n and s[i + 1] == '/':
+                out.append('/')
+                i += 2
+                in_block_comment = False
+            else:
+                i += 1
+            continue
+
+        if in_squote:
+            out.append(ch)
+            if ch == "'":
+                if i + 1 < n and s[i + 1] == "'":
+                    out.append("'")
+                    i += 2
+                else:
+                    in_squote = False
+                    i += 1
+            else:
+                i += 1
+            continue
+
+        if in_dquote:
+            out.append(ch)
+            if ch == '"':
+                if i + 1 < n and s[i + 1] == '"':
+                    out.append('"')
+                    i += 2
+                else:
+                    in_dquote = False
+                    i += 1
+            else:
+                i += 1
+            continue
+
+        if dollar_tag is not None:
+            out.append(ch)
+            if ch == '$' and s.startswith(dollar_tag, i):
+                out.append(dollar_tag[1:])
+                i += len(dollar_tag)
+                dollar_tag = None
+            else:
+                i += 1
+            continue
+
+        if ch == '-' and i + 1 < n and s[i + 1] == '-':
+            out.append('-')
+            out.append('-')
+            i += 2
+            in_line_comment = True
+            continue
+        if ch == '/' and i + 1 < n and s[i + 1] == '*':
+            out.append('/')
+            out.append('*')
+            i += 2
+            in_block_comment = True
+            continue
+        if ch == "'":
+            out.append(ch)
+            in_squote = True
+            i += 1
+            continue
+        if ch == '"':
+            j = i + 1
+            content_chars = []
+            while j < n:
+                cj = s[j]
+                if cj == '"':
+                    if j + 1 < n and s[j + 1] == '"':
+                        content_chars.append('"')
+                        j += 2
+                        continue
+                    else:
+                        break
+                else:
+                    content_chars.append(cj)
+                    j += 1
+            if j < n and s[j] == '"':
+                token = ''.join(content_chars)
+                if token.count('.') == 1:
+                    left, right = token.split('.', 1)
+                    if left.isdigit() and (len(right) > 0 and _is_identifier_start(ord(right[0])) and all(_is_identifier_part(ord(c)) for c in right[1:])):
+                        out.append('"')
+                        out.append(left)
+                        out.append('"')
+                        out.append('.')
+                        out.append('"')
+                        out.append(right)
+                        out.append('"')
+                        i = j + 1
+                        continue
+                if token.lower() == 'matricula':
+                    out.append('"matricula"')
+                    i = j + 1
+                    continue
+                out.append(s[i:j + 1])
+                i = j + 1
+                continue
+            out.append(ch)
+            in_dquote = True
+            i += 1
+            continue
+        if ch == '$':
+            j = i + 1
+            while j < n and (s[j].isalnum() or s[j] == '_'):
+                j += 1
+            if j < n and s[j] == '$':
+                tag = s[i:j + 1]
+                out.append(tag)
+                i = j + 1
+                dollar_tag = tag
+                continue
+
+        if s[i].isdigit():
+            j = i
+            while j < n and s[j].isdigit():
+                j += 1
+            j_ws = j
+            while j_ws < n and s[j_ws].isspace():
+                j_ws += 1
+            if j_ws < n and s[j_ws] == '.':
+                k = j_ws + 1
+                while k < n and s[k].isspace():
+                    k += 1
+                if k < n and _is_identifier_start(ord(s[k])):
+                    k2 = k + 1
+                    while k2 < n and _is_identifier_part(ord(s[k2])):
+                        k2 += 1
+                    schema = s[i:j]
+                    table = s[k:k2]
+                    out.append('"')
+                    out.append(schema)
+                    out.append('"')
+                    out.append('.')
+                    out.append('"')
+                    out.append(table)
+                    out.append('"')
+                    i = k2
+                    continue
+        out.append(ch)
+        i += 1
+
+    rewritten = ''.join(out)
+
+    try:
+        s_fix = rewritten
+        s_fix = re.sub(
+            r"(\b[\w$]+\.)(codlig)(\s*=\s*)([\w$]+\.)(?:\"?matricula\"?\b)",
+            r'\1\2::text\3\4"matricula"',
+            s_fix,
+            flags=re.IGNORECASE,
+        )
+        s_fix = re.sub(
+            r"(\b[\w$]+\.)(?:\"?matricula\"?\b)(\s*=\s*)([\w$]+\.)(codlig\b)",
+            r'\1"matricula"\2\3\4::text',
+            s_fix,
+            flags=re.IGNORECASE,
+        )
+    except Exception:
+        return rewritten
+
+    return s_fix
+
+
+# --- Reescritor em bytes -------------------------------------------------
+#
+# Mesma saída de `rewrite_schema_table` (mais os ajustes codlig/matricula),
+# mas operando direto sobre os bytes UTF-8 da mensagem: o texto é varrido por
+# expressões regulares que saltam até o próximo ponto de interesse e os
+# trechos inalterados são copiados como fatias. A comparação codlig/matricula
+# é tratada na mesma passada, portanto respeita literais, identificadores
+# entre aspas e comentários. Bytes não ASCII são tratados como caracteres de
+# identificador.
+
+_WS = rb'[\t\n\x0b\x0c\r\x1c-\x1f ]'
+_NOT_WORD = rb'(?![A-Za-z0-9_\x80-\xff])'
+# Prefixo `xxx.` do lado direito da comparação; '$' só entra quando não abre
+# um dollar-quote e o prefixo não pode terminar em dígito (nesse caso vale a
+# reescrita de schema numérico).
+_CMP_PREFIX = rb'(?:[A-Za-z0-9_\x80-\xff]|\$(?![A-Za-z0-9_\x80-\xff]*\$))+(?<![0-9])\.'
+
+_EVENT_RE = re.compile(
+    # Todo evento começa por um destes caracteres; o lookahead deixa o motor
+    # de regex descartar rapidamente as demais posições.
+    rb'(?=[-/\'"$0-9.])(?:'
+    # Literais, comentários e dollar-quotes completos: copiados sem alteração
+    rb'(?P<skip>\'[^\']*(?:\'\'[^\']*)*\'(?!\')'
+    rb'|--[^\n]*\n'
+    rb'|/\*[^*]*\*+(?:[^*/][^*]*\*+)*/'
+    rb'|\$(?P<tag>[A-Za-z0-9_\x80-\xff]*)\$(?s:.*?)\$(?P=tag)\$)'
+    # Identificadores entre aspas reescritos: "10.tabela" e "MATRICULA"
+    rb'|(?P<qschema>"(?P<qs>[0-9]+)\.(?P<qt>[A-Za-z_][A-Za-z0-9_$]*)"(?!"))'
+    rb'|(?P<qmat>"(?i:matricula)"(?!"))'
+    rb'|(?P<qskip>"[^"]*(?:""[^"]*)*"(?!"))'
+    # Abertura sem fechamento: o restante do texto é copiado como está
+    rb'|(?P<open>--|/\*|\'|"|\$[A-Za-z0-9_\x80-\xff]*\$)'
+    rb'|(?P<schema>(?P<sch>[0-9]+)' + _WS + rb'*\.' + _WS + rb'*(?P<tbl>[A-Za-z_][A-Za-z0-9_$]*))'
+    rb'|(?P<fwd>\.(?i:codlig)(?P<fop>' + _WS + rb'*=' + _WS + rb'*' + _CMP_PREFIX + rb')'
+    rb'(?i:matricula' + _NOT_WORD + rb'|"matricula"(?!")))'
+    rb'|(?P<rev>\.(?i:matricula)' + _NOT_WORD + rb'(?P<rop>' + _WS + rb'*=' + _WS + rb'*' + _CMP_PREFIX + rb')'
+    rb'(?i:codlig)' + _NOT_WORD + rb')'
+    rb')'
+)
+_IDENT_RUN_CHARS = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_$' + bytes(range(0x80, 0x100)))
+
+
+def _has_word_before(data, dot: int, floor: int) -> bool:
+    # Equivale ao `\b[\w$]+\.` das regexes antigas: o identificador colado ao
+    # ponto precisa conter ao menos um caractere de palavra (não só '$').
+    j = dot - 1
+    while j >= floor and data[j] in _IDENT_RUN_CHARS:
+        if data[j] != 36:
+            return True
+        j -= 1
+    return False
+
+
+def rewrite_schema_table_bytes(data) -> bytes:
+    # Aceita bytes, bytearray ou memoryview; retorna `data` inalterado (mesmo
+    # objeto, quando for bytes) se nada precisar ser reescrito.
+    view = memoryview(data)
+    out = []
+    copied = 0
+    # Fim do último trecho reescrito: o prefixo `xxx.` da comparação
+    # codlig/matricula não pode atravessá-lo (a saída ali termina em aspas).
+    floor = 0
+    pos = 0
+    restart = True
+    while restart:
+        restart = False
+        for m in _EVENT_RE.finditer(data, pos):
+            kind = m.lastgroup
+            if kind == 'skip' or kind == 'qskip':
+                continue
+            if kind == 'open':
+                break
+            start = m.start()
+            if kind == 'qmat':
+                if view[start + 1:start + 10] == b'matricula':
+                    continue
+                out.append(view[copied:start])
+                out.append(b'"matricula"')
+            elif kind == 'qschema':
+                out.append(view[copied:start])
+                out.extend((b'"', m.group('qs'), b'"."', m.group('qt'), b'"'))
+            elif kind == 'schema':
+                out.append(view[copied:start])
+                out.extend((b'"', m.group('sch'), b'"."', m.group('tbl'), b'"'))
+            else:
+                # Comparação codlig/matricula (em qualquer ordem)
+                if not _has_word_before(data, start, floor):
+                    pos = start + 1
+                    restart = True
+                    break
+                out.append(view[copied:start])
+                if kind == 'fwd':
+                    op_start = m.start('fop')
+                    out.extend((view[start:op_start], b'::text', view[op_start:m.end('fop')], b'"matricula"'))
+                else:
+                    op_start = m.start('rop')
+                    out.extend((b'."matricula"', view[op_start:m.end()], b'::text'))
+            copied = floor = m.end()
+
+    if not out:
+        return data if isinstance(data, bytes) else bytes(data)
+    out.append(view[copied:])
+    return b''.join(out)
+
+
+def needs_rewrite(query: bytes) -> bool:
+    return _REWRITE_HINT_RE.search(query) is not None
+
+
+def rewrite_query(query: bytes) -> bytes:
+    # Retorna o próprio objeto `query` quando nada muda
+    if not needs_rewrite(query):
+        return query
+    return rewrite_schema_table_bytes(query)
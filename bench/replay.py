@@ -0,0 +1,364 @@
+import argparse
+import asyncio
+import mmap
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from bench.forwarding import ROOT, _percentile, _wait_port
+from capture import KIND_CONTINUATION, KIND_MESSAGE, KIND_STARTUP, read_capture
+from pg_auth import (
+    AUTH_CLEARTEXT,
+    AUTH_MD5,
+    AUTH_OK,
+    AUTH_SASL,
+    AUTH_SASL_CONTINUE,
+    AUTH_SASL_FINAL,
+    SCRAM_MECHANISM,
+    ScramClient,
+    md5_response,
+)
+from pg_protocol import (
+    Framer,
+    message,
+    pack_uint32,
+    parse_error_fields,
+    parse_startup_params,
+    read_message,
+    startup_message,
+    unpack_uint32,
+)
+
+# Replay de capturas do proxy (CAPTURE_DIR): os arquivos são mapeados em
+# memória e cada sessão capturada vira uma conexão que reenvia as mensagens
+# do cliente na ordem original, no ritmo capturado (--speed 1), N vezes mais
+# rápido (--speed N) ou sem esperas (--speed max). Como um cliente de verdade,
+# cada requisição ('Q', 'S', 'F') só sai depois da resposta da anterior; os
+# dados de COPY FROM seguem sem esperar. Ao final são informadas vazão e
+# latência (envio até o ReadyForQuery) das requisições.
+#
+#   python -m bench.replay captura/*.pgcap --port 55433 --sessions 200 --speed max
+#   python -m bench.replay captura/*.pgcap --fake-backend --start-proxy --speed 10
+
+# Espera a resposta das requisições anteriores antes de enviar
+_WAIT = 1
+# Inicia uma requisição respondida com ReadyForQuery
+_REQUEST = 2
+_COPY_TYPES = frozenset(b'dcf')
+_REQUEST_TYPES = frozenset(b'QSF')
+
+
+# Sessão capturada: pacote de inicialização, horário e eventos (horário,
+# bytes, flags) apontando para o arquivo mapeado
+class CapturedSession:
+    __slots__ = ('startup', 'started', 'events')
+
+    def __init__(self, startup: bytes, started: float) -> None:
+        self.startup = startup
+        self.started = started
+        self.events: List[Tuple[float, memoryview, int]] = []
+
+
+def load_captures(paths: List[str]) -> Tuple[List[CapturedSession], int]:
+    # Retorna as sessões em ordem de início e quantos registros ficaram sem
+    # sessão (a inicialização estava num arquivo já removido pela rotação)
+    sessions: Dict[Tuple[int, int], CapturedSession] = {}
+    orphans = 0
+    for path in sorted(paths):
+        if os.path.getsize(path) == 0:
+            continue
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        for pid, timestamp, session_id, kind, start, end in read_capture(mapped):
+            key = (pid, session_id)
+            if kind == KIND_STARTUP:
+                # Repetida no início de cada arquivo da rotação
+                if key not in sessions:
+                    sessions[key] = CapturedSession(bytes(view[start:end]), timestamp)
+                continue
+            session = sessions.get(key)
+            if session is None:
+                orphans += 1
+                continue
+            if kind == KIND_MESSAGE:
+                msg_type = mapped[start]
+                flags = 0 if msg_type in _COPY_TYPES else _WAIT
+                if msg_type in _REQUEST_TYPES:
+                    flags |= _REQUEST
+                session.events.append((timestamp, view[start:end], flags))
+            elif kind == KIND_CONTINUATION:
+                session.events.append((timestamp, view[start:end], 0))
+    return sorted(sessions.values(), key=lambda session: session.started), orphans
+
+
+class ReplayStats:
+    def __init__(self) -> None:
+        self.sessions = 0
+        self.failed = 0
+        self.requests = 0
+        self.errors = 0
+        self.messages = 0
+        self.bytes = 0
+        self.lag = 0.0
+        self.elapsed = 0.0
+        self.latencies: List[float] = []
+
+
+def _startup_packet(packet: bytes, overrides: Dict[str, str]) -> Tuple[bytes, str]:
+    params = parse_startup_params(packet[8:])
+    if not overrides:
+        return packet, params.get('user', '')
+    params.update(overrides)
+    return startup_message(params), params.get('user', '')
+
+
+async def _authenticate(
+    reader: asyncio.StreamReader, writer: asyncio.StreamWriter, user: str, password: Optional[str]
+) -> None:
+    scram: Optional[ScramClient] = None
+    while True:
+        msg_type, body = await read_message(reader)
+        if msg_type == 82:
+            code = unpack_uint32(body, 0)[0]
+            if code == AUTH_OK:
+                continue
+            if password is None:
+                raise RuntimeError('o servidor pediu senha; use --password')
+            if code == AUTH_CLEARTEXT:
+                writer.write(message(b'p', password.encode('utf-8') + b'\x00'))
+            elif code == AUTH_MD5:
+                writer.write(message(b'p', md5_response(user, password, body[4:8]).encode('ascii') + b'\x00'))
+            elif code == AUTH_SASL:
+                scram = ScramClient(password)
+                initial = scram.initial_response()
+                writer.write(message(
+                    b'p', SCRAM_MECHANISM.encode('ascii') + b'\x00' + pack_uint32(len(initial)) + initial
+                ))
+            elif code == AUTH_SASL_CONTINUE and scram is not None:
+                writer.write(message(b'p', scram.final_response(body[4:])))
+            elif code == AUTH_SASL_FINAL and scram is not None:
+                scram.verify_final(body[4:])
+            else:
+                raise RuntimeError(f'método de autenticação {code} não suportado')
+            await writer.drain()
+        elif msg_type == 90:
+            return
+        elif msg_type == 69:
+            raise RuntimeError(parse_error_fields(body).get('M', 'erro do servidor'))
+
+
+async def _read_responses(
+    reader: asyncio.StreamReader, sent: Deque[float], idle: asyncio.Event, stats: ReplayStats
+) -> None:
+    framer = Framer()
+    try:
+        while True:
+            data = await reader.read(262144)
+            if not data:
+                break
+            stats.bytes += len(data)
+            data = framer.feed(data)
+            if data is None:
+                continue
+            n = len(data)
+            pos = 0
+            need = 5
+            while n - pos >= 5:
+                end = pos + 1 + unpack_uint32(data, pos + 1)[0]
+                if end > n:
+                    need = end - pos
+                    break
+                msg_type = data[pos]
+                stats.messages += 1
+                if msg_type == 90:
+                    if sent:
+                        stats.latencies.append(time.perf_counter() - sent.popleft())
+                        stats.requests += 1
+                    if not sent:
+                        idle.set()
+                elif msg_type == 69:
+                    stats.errors += 1
+                pos = end
+            if pos < n:
+                framer.keep(data, pos, need)
+    finally:
+        idle.set()
+
+
+async def _replay_session(
+    session: CapturedSession,
+    args: argparse.Namespace,
+    overrides: Dict[str, str],
+    slots: asyncio.Semaphore,
+    clock: Tuple[float, float],
+    stats: ReplayStats,
+) -> None:
+    speed = args.speed
+    schedule_start, capture_start = clock
+    if speed:
+        delay = schedule_start + (session.started - capture_start) / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+    async with slots:
+        stats.sessions += 1
+        writer = None
+        responses = None
+        try:
+            reader, writer = await asyncio.open_connection(args.host, args.port)
+            packet, user = _startup_packet(session.startup, overrides)
+            writer.write(packet)
+            await writer.drain()
+            await _authenticate(reader, writer, user, args.password)
+
+            sent: Deque[float] = deque()
+            idle = asyncio.Event()
+            idle.set()
+            responses = asyncio.create_task(_read_responses(reader, sent, idle, stats))
+            for timestamp, payload, flags in session.events:
+                if speed:
+                    delay = schedule_start + (timestamp - capture_start) / speed - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    elif -delay > stats.lag:
+                        stats.lag = -delay
+                if flags & _WAIT and sent:
+                    await idle.wait()
+                    if responses.done():
+                        raise ConnectionResetError('servidor encerrou a conexão')
+                if flags & _REQUEST:
+                    sent.append(time.perf_counter())
+                    idle.clear()
+                writer.write(payload)
+                if writer.transport.get_write_buffer_size() > 262144:
+                    await writer.drain()
+            await writer.drain()
+            await idle.wait()
+        except (OSError, RuntimeError, asyncio.IncompleteReadError) as e:
+            stats.failed += 1
+            if stats.failed <= 5:
+                print(f'sessão falhou: {e}', file=sys.stderr)
+        finally:
+            if responses is not None:
+                responses.cancel()
+            if writer is not None:
+                writer.close()
+
+
+async def replay(sessions: List[CapturedSession], args: argparse.Namespace, overrides: Dict[str, str]) -> ReplayStats:
+    stats = ReplayStats()
+    slots = asyncio.Semaphore(args.sessions)
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        clock = (time.perf_counter(), sessions[0].started)
+        await asyncio.gather(*(_replay_session(session, args, overrides, slots, clock, stats) for session in sessions))
+    stats.elapsed = time.perf_counter() - started
+    return stats
+
+
+def _report(stats: ReplayStats) -> None:
+    elapsed = stats.elapsed
+    print(f'sessões: {stats.sessions} ({stats.failed} com falha) em {elapsed:.2f}s')
+    line = f'requisições: {stats.requests} ({stats.requests / elapsed:,.0f} req/s), erros do servidor: {stats.errors}'
+    if stats.latencies:
+        line += (
+            f', latência p50={_percentile(stats.latencies, 0.5) * 1e6:.0f}us'
+            f' p95={_percentile(stats.latencies, 0.95) * 1e6:.0f}us'
+            f' p99={_percentile(stats.latencies, 0.99) * 1e6:.0f}us'
+            f' max={max(stats.latencies) * 1e6:.0f}us'
+        )
+    print(line)
+    print(
+        f'recebido: {stats.messages / elapsed:,.0f} msg/s, {stats.bytes / elapsed / 1e6:,.1f} MB/s'
+        f' ({stats.messages} mensagens, {stats.bytes} bytes)'
+    )
+    if stats.lag:
+        print(f'maior atraso em relação ao ritmo capturado: {stats.lag * 1000:.1f}ms')
+
+
+def _parse_speed(value: str) -> float:
+    if value == 'max':
+        return 0.0
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('use um número maior que zero ou "max"')
+    return speed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay de capturas de tráfego do proxy')
+    parser.add_argument('captures', nargs='+', help='arquivos .pgcap (ou diretórios com eles)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=55433, help='porta do proxy (ou do backend) alvo')
+    parser.add_argument('--speed', type=_parse_speed, default=1.0, help='1 = ritmo capturado, N = N vezes, max = sem esperas')
+    parser.add_argument('--sessions', type=int, default=100, help='sessões simultâneas no máximo')
+    parser.add_argument('--repeat', type=int, default=1, help='quantas vezes reproduzir a captura')
+    parser.add_argument('--password', help='senha enviada se o servidor pedir (as da captura não são gravadas)')
+    parser.add_argument(
+        '--param', action='append', default=[], metavar='NOME=VALOR',
+        help='sobrepõe um parâmetro de inicialização, por exemplo user ou database (pode repetir)',
+    )
+    parser.add_argument('--fake-backend', action='store_true', help='sobe o backend de mentira em --backend-port')
+    parser.add_argument('--backend-port', type=int, default=55432)
+    parser.add_argument('--start-proxy', action='store_true', help='sobe o proxy em --port apontando para --backend-port')
+    parser.add_argument(
+        '--proxy-env', action='append', default=[], metavar='NOME=VALOR',
+        help='variável de ambiente extra para o proxy (pode repetir)',
+    )
+    args = parser.parse_args()
+
+    paths = []
+    for item in args.captures:
+        path = Path(item)
+        if path.is_dir():
+            paths.extend(str(child) for child in sorted(path.glob('*.pgcap')))
+        else:
+            paths.append(item)
+    sessions, orphans = load_captures(paths)
+    events = sum(len(session.events) for session in sessions)
+    print(f'{len(sessions)} sessões e {events} mensagens em {len(paths)} arquivos', end='')
+    print(f' ({orphans} registros sem inicialização ignorados)' if orphans else '')
+    if not sessions:
+        return
+    overrides = dict(item.partition('=')[::2] for item in args.param)
+
+    processes = []
+    try:
+        if args.fake_backend:
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'bench.fake_backend', '--host', args.host, '--port', str(args.backend_port)],
+                cwd=ROOT,
+            ))
+            _wait_port(args.host, args.backend_port)
+        if args.start_proxy:
+            env = dict(os.environ)
+            env.update({
+                'PG_HOST': args.host,
+                'PG_PORT': str(args.backend_port),
+                'PROXY_HOST': args.host,
+                'PROXY_PORT': str(args.port),
+                'SSL_REQUEST_CODE': '80877103',
+                'DEBUG_LOG_QUERIES': 'false',
+                'CAPTURE_DIR': '',
+            })
+            for item in args.proxy_env:
+                name, _, value = item.partition('=')
+                env[name] = value
+            processes.append(subprocess.Popen(
+                [sys.executable, 'proxy.py'], cwd=ROOT, env=env, stdout=subprocess.DEVNULL
+            ))
+            _wait_port(args.host, args.port)
+        _report(asyncio.run(replay(sessions, args, overrides)))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import time
+from pathlib import Path
+from typing import Callable, List
+
+from bench.legacy_rewriter import needs_rewrite as legacy_needs_rewrite
+from bench.legacy_rewriter import rewrite_schema_table, rewrite_schema_table_bytes
+from rewrite_rules import load_rules
+
+# Microbenchmark do reescritor sobre um corpus de consultas no formato das que
+# passam pelo proxy (schemas numéricos por cliente, comparações
+# codlig/matricula, literais, comentários, listas IN e INSERTs longos).
+#
+#   python -m bench.rewriter --iterations 2000
+#   python -m bench.rewriter --corpus consultas.sql   (uma consulta por linha)
+#   python -m bench.rewriter --rules regras.json      (além das embutidas)
+
+_TEMPLATES = [
+    'select c.nome, c.cpf from {s}.clientes c where c.id = {n}',
+    'SELECT * FROM {s}.pedidos p JOIN {s}.itens i ON i.pedido_id = p.id WHERE p.data >= \'2024-01-01\'',
+    'select a.codlig, b.nome from {s}.ligacoes a join {s}.assinantes b on a.codlig = b.matricula',
+    'select count(*) from {s}.faturas f where b.matricula = f.codlig and f.valor > 10.5',
+    'update {s}.clientes set ultimo_acesso = now() where id = {n}',
+    'insert into {s}.eventos (tipo, payload) values (\'login\', \'{{"ip": "10.0.0.{n}"}}\')',
+    'select id, nome from usuarios where email = \'user{n}@example.com\'',
+    'select 1',
+    'begin',
+    'commit',
+    'select * from pg_catalog.pg_type where oid = {n}',
+    '/* relatório 1.2 */ select sum(valor) from {s}.faturas where mes = {n} -- total',
+    'select * from {s}.produtos where id in ({ids})',
+    'insert into {s}.leituras (sensor, valor) values {values}',
+    'select $1::int + 2.5, $tag$ 9.x não é tabela $tag$ from {s}.t',
+    'select "Nome", "CPF" from "{s}"."Clientes" where "ID" = {n}',
+]
+
+
+def build_corpus(size: int) -> List[bytes]:
+    corpus = []
+    for i in range(size):
+        template = _TEMPLATES[i % len(_TEMPLATES)]
+        query = template.format(
+            s=10 + i % 50,
+            n=i,
+            ids=', '.join(str(i + k) for k in range(50)),
+            values=', '.join(f'({k}, {k}.{i % 10})' for k in range(40)),
+        )
+        corpus.append(query.encode('utf-8'))
+    return corpus
+
+
+def load_corpus(path: str) -> List[bytes]:
+    return [line for line in Path(path).read_bytes().splitlines() if line.strip()]
+
+
+def _time(fn: Callable[[], None], iterations: int) -> float:
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Microbenchmark do reescritor de SQL')
+    parser.add_argument('--corpus', help='arquivo com uma consulta por linha (padrão: corpus embutido)')
+    parser.add_argument('--size', type=int, default=400, help='tamanho do corpus embutido')
+    parser.add_argument('--iterations', type=int, default=50, help='passadas sobre o corpus')
+    parser.add_argument('--rules', default='', help='arquivo de regras (como REWRITE_RULES_FILE; padrão: só as embutidas)')
+    args = parser.parse_args()
+
+    rules = load_rules(args.rules)
+
+    corpus = load_corpus(args.corpus) if args.corpus else build_corpus(args.size)
+    texts = [q.decode('utf-8', errors='replace') for q in corpus]
+    total_bytes = sum(len(q) for q in corpus)
+    rewritten = sum(1 for q in corpus if rules.rewrite(q) is not q)
+    divergent = sum(
+        1 for q, t in zip(corpus, texts)
+        if rewrite_schema_table_bytes(q).decode('utf-8', errors='replace') != rewrite_schema_table(t)
+    )
+    divergent_rules = sum(1 for q in corpus if rules.rewrite(q) != rewrite_schema_table_bytes(q))
+    print(
+        f'corpus: {len(corpus)} consultas, {total_bytes / 1024:.1f} KiB, '
+        f'{sum(1 for q in corpus if rules.needs_rewrite(q))} passam no pré-filtro, {rewritten} reescritas, '
+        f'{divergent} diferentes da versão str, {divergent_rules} do motor de regras diferentes da versão bytes'
+    )
+    print('regras: ' + ', '.join(f'{name}={hits}' for name, hits in rules.hits.items()))
+
+    cases = [
+        ('rewrite_schema_table (str)', lambda: [rewrite_schema_table(t) for t in texts]),
+        ('rewrite_schema_table_bytes', lambda: [rewrite_schema_table_bytes(q) for q in corpus]),
+        ('rewrite (regras)', lambda: [rules.rewrite(q) for q in corpus]),
+        ('needs_rewrite (regras)', lambda: [rules.needs_rewrite(q) for q in corpus]),
+        ('needs_rewrite (legado)', lambda: [legacy_needs_rewrite(q) for q in corpus]),
+    ]
+    count = len(corpus) * args.iterations
+    for label, fn in cases:
+        elapsed = _time(fn, args.iterations)
+        print(
+            f'{label:>28}: {elapsed / count * 1e6:8.2f} us/consulta, '
+            f'{total_bytes * args.iterations / elapsed / 1e6:8.1f} MB/s'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+import argparse
+import random
+import re
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from bench.legacy_rewriter import rewrite_schema_table, rewrite_schema_table_bytes
+
+# Teste diferencial do reescritor em bytes contra a versão original em str:
+# consultas geradas aleatoriamente a partir de fragmentos SQL (e, com
+# --corpus, as de um arquivo) passam pelas duas funções e as saídas são
+# comparadas. Duas classes de divergência são intencionais:
+#   codlig   o ajuste codlig/matricula da versão str é uma regex aplicada ao
+#            texto já reescrito, sem respeitar literais, comentários,
+#            dollar-quotes e identificadores entre aspas (e pode engolir a
+#            aspa de um identificador colado, `b.matricula"x"`); a versão em
+#            bytes trata a comparação na mesma passada do resto.
+#   unicode  a versão str usa str.isdigit/str.isspace, que aceitam dígitos e
+#            espaços não ASCII (`١٠.t` vira `"١٠"."t"`); a versão em bytes só
+#            reconhece os ASCII, como o PostgreSQL.
+# Uma divergência só entra numa dessas classes se desaparece quando a causa é
+# neutralizada na consulta (dígitos e espaços não ASCII trocados por '#',
+# `codlig` por `codlix`). Qualquer outra é um erro: o comando lista exemplos
+# e sai com 1.
+#
+#   python -m bench.rewriter_diff --iterations 200000 --seed 1
+#   python -m bench.rewriter_diff --corpus consultas.sql
+
+_FRAGMENTS = [
+    'a', 'b', 't1', 'x$', '$', '$a$', '$$', '.', ' ', '\n', '=', ' = ', '(', ')', ',', '*', '/', '-', '_', '::',
+    'codlig', 'CODLIG', 'matricula', 'Matricula', '"matricula"', '"MATRICULA"', 'a.codlig', 'b.matricula',
+    '"5.abc"', '"x"', '"', "'", "''", '--', '/*', '*/', '5', '12', '.5', 'tab', 'select ', 'é', '"5.té"',
+    '\u0661\u0660', '\u00a0', '\u3000',
+]
+
+_CODLIG_RE = re.compile('codlig', re.IGNORECASE)
+
+
+def _without_unicode_digits_and_spaces(query: str) -> str:
+    return ''.join('#' if ord(c) > 127 and (c.isdigit() or c.isspace()) else c for c in query)
+
+
+def _outputs(query: str) -> Tuple[str, str]:
+    legacy = rewrite_schema_table(query)
+    return legacy, rewrite_schema_table_bytes(query.encode('utf-8')).decode('utf-8')
+
+
+def _agree(query: str) -> bool:
+    legacy, current = _outputs(query)
+    return legacy == current
+
+
+def classify(query: str) -> Optional[Tuple[str, str, str]]:
+    # None quando as duas versões concordam; senão (classe, saída str, saída bytes)
+    legacy, current = _outputs(query)
+    if legacy == current:
+        return None
+    neutral = _without_unicode_digits_and_spaces(query)
+    if neutral != query and _agree(neutral):
+        return 'unicode', legacy, current
+    neutral = _CODLIG_RE.sub('codlix', neutral)
+    if _agree(neutral):
+        return 'codlig', legacy, current
+    return 'unexpected', legacy, current
+
+
+def random_queries(count: int, seed: int, max_fragments: int) -> List[str]:
+    rng = random.Random(seed)
+    return [
+        ''.join(rng.choice(_FRAGMENTS) for _ in range(rng.randint(1, max_fragments)))
+        for _ in range(count)
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Teste diferencial do reescritor em bytes contra a versão str')
+    parser.add_argument('--corpus', help='arquivo com uma consulta por linha, testado além das aleatórias')
+    parser.add_argument('--iterations', type=int, default=200000, help='consultas aleatórias')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-fragments', type=int, default=14, help='fragmentos por consulta aleatória')
+    parser.add_argument('--show', type=int, default=20, help='exemplos mostrados por classe')
+    args = parser.parse_args()
+
+    queries = random_queries(args.iterations, args.seed, args.max_fragments)
+    if args.corpus:
+        text = Path(args.corpus).read_text(encoding='utf-8', errors='replace')
+        queries.extend(line for line in text.splitlines() if line.strip())
+    counts: Dict[str, int] = {'codlig': 0, 'unicode': 0, 'unexpected': 0}
+    for query in queries:
+        result = classify(query)
+        if result is None:
+            continue
+        kind, legacy, current = result
+        counts[kind] += 1
+        if counts[kind] <= args.show:
+            print(f'[{kind}] {query!r}\n    str:   {legacy!r}\n    bytes: {current!r}')
+    print(
+        f'{len(queries)} consultas; divergências intencionais: {counts["codlig"]} codlig/matricula e '
+        f'{counts["unicode"]} unicode; inesperadas: {counts["unexpected"]}'
+    )
+    sys.exit(1 if counts['unexpected'] else 0)
+
+
+if __name__ == '__main__':
+    main()
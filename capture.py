@@ -0,0 +1,206 @@
+import os
+import queue
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from config import CAPTURE_DIR, CAPTURE_MAX_FILE_BYTES, CAPTURE_MAX_FILES, CAPTURE_QUEUE_SIZE
+from proxy_logging import proxy_log
+
+# Captura do tráfego cliente->servidor para replay (bench/replay.py). Cada
+# arquivo começa com MAGIC, o pid e o horário de abertura; depois vêm
+# registros (horário, sessão, tipo, tamanho) seguidos dos bytes:
+#   S  pacote de inicialização completo (com o tamanho)
+#   M  mensagem do cliente enquadrada, como foi enviada (o início dela, se
+#      passou adiante em streaming)
+#   C  continuação da mensagem em streaming
+#   X  fim da sessão
+# Mensagens de senha ('p') e SSLRequest não são gravadas. Cada arquivo novo
+# da rotação repete a inicialização das sessões abertas, então qualquer
+# arquivo pode ser reproduzido sem os anteriores. O event loop só
+# monta os registros de cada leitura e entrega um bloco à fila; a escrita,
+# a rotação e a remoção dos arquivos antigos ficam numa thread, e com a fila
+# cheia o bloco é descartado e contado.
+
+MAGIC = b'PGCAP1\n\x00'
+FILE_HEADER = struct.Struct('!Id')
+RECORD = struct.Struct('!dIcI')
+
+KIND_STARTUP = b'S'
+KIND_MESSAGE = b'M'
+KIND_CONTINUATION = b'C'
+KIND_END = b'X'
+
+CAPTURE_ENABLED = bool(CAPTURE_DIR)
+
+_pack_record = RECORD.pack
+_PASSWORD_MESSAGE = 112
+
+
+class CaptureWriter:
+    def __init__(self, directory: str, max_file_bytes: int, max_files: int, queue_size: int) -> None:
+        self.directory = Path(directory)
+        self.max_file_bytes = max(1, max_file_bytes)
+        self.max_files = max_files
+        self.queue: queue.Queue = queue.Queue(max(0, queue_size))
+        self.files: List[Path] = []
+        self.file = None
+        self.file_bytes = 0
+        self.sequence = 0
+        self.stats = {'bytes': 0, 'dropped': 0, 'files': 0, 'write_errors': 0}
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self.thread.start()
+
+    def put(self, block: bytes) -> None:
+        try:
+            self.queue.put_nowait(block)
+        except queue.Full:
+            self.stats['dropped'] += 1
+
+    def _open(self) -> None:
+        self.sequence += 1
+        now = time.time()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        path = self.directory / f'capture-{os.getpid()}-{stamp}-{self.sequence:04d}.pgcap'
+        self.file = open(path, 'wb')
+        startups = b''.join(list(_open_sessions.values()))
+        self.file.write(MAGIC + FILE_HEADER.pack(os.getpid(), now) + startups)
+        self.file_bytes = len(MAGIC) + FILE_HEADER.size + len(startups)
+        self.files.append(path)
+        self.stats['files'] += 1
+        while self.max_files > 0 and len(self.files) > self.max_files:
+            old = self.files.pop(0)
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+    def _write(self, data: bytes) -> None:
+        if self.file is None or self.file_bytes >= self.max_file_bytes:
+            if self.file is not None:
+                self.file.close()
+            self._open()
+        self.file.write(data)
+        self.file_bytes += len(data)
+        self.stats['bytes'] += len(data)
+
+    def _run(self) -> None:
+        while True:
+            block = self.queue.get()
+            blocks = [block]
+            # Junta o que mais estiver na fila numa única escrita
+            while block is not None and len(blocks) < 256:
+                try:
+                    block = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                blocks.append(block)
+            stop = blocks[-1] is None
+            if stop:
+                blocks.pop()
+            try:
+                if blocks:
+                    self._write(b''.join(blocks))
+                if self.file is not None and (stop or self.queue.empty()):
+                    self.file.flush()
+            except OSError as e:
+                self.stats['write_errors'] += 1
+                proxy_log.error('Erro gravando a captura: %s', e)
+            if stop:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                return
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+
+
+_writer: Optional[CaptureWriter] = None
+_sessions = 0
+# Registro de inicialização de cada sessão aberta, repetido a cada rotação
+_open_sessions: Dict[int, bytes] = {}
+
+
+def start_capture() -> None:
+    global _writer
+    if CAPTURE_ENABLED and _writer is None:
+        _writer = CaptureWriter(CAPTURE_DIR, CAPTURE_MAX_FILE_BYTES, CAPTURE_MAX_FILES, CAPTURE_QUEUE_SIZE)
+        proxy_log.info('Capturando o tráfego dos clientes em %s', CAPTURE_DIR)
+
+
+def stop_capture() -> None:
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
+
+
+# Captura de uma conexão do cliente: os registros de uma leitura vão juntos
+# para a fila em flush()
+class ConnectionCapture:
+    __slots__ = ('session', 'records', 'skipping')
+
+    def __init__(self) -> None:
+        global _sessions
+        _sessions += 1
+        self.session = _sessions
+        self.records: List[bytes] = []
+        # A mensagem em streaming é uma senha: a continuação também não vai
+        self.skipping = False
+
+    def _record(self, kind: bytes, payload: bytes) -> None:
+        self.records.append(_pack_record(time.time(), self.session, kind, len(payload)))
+        self.records.append(payload)
+
+    def startup(self, data: bytes, start: int, end: int) -> None:
+        self._record(KIND_STARTUP, data[start:end])
+        _open_sessions[self.session] = self.records[-2] + self.records[-1]
+
+    def message(self, data: bytes, start: int, end: int) -> None:
+        self.skipping = data[start] == _PASSWORD_MESSAGE
+        if not self.skipping:
+            self._record(KIND_MESSAGE, data[start:end])
+
+    def continuation(self, data: bytes, end: int) -> None:
+        if not self.skipping:
+            self._record(KIND_CONTINUATION, data[:end])
+
+    def flush(self) -> None:
+        if self.records and _writer is not None:
+            _writer.put(b''.join(self.records))
+        self.records = []
+
+    def close(self) -> None:
+        _open_sessions.pop(self.session, None)
+        self._record(KIND_END, b'')
+        self.flush()
+
+
+def read_capture(buffer) -> Iterator[Tuple[int, float, int, bytes, int, int]]:
+    # (pid, horário, sessão, tipo, início, fim) de cada registro de um arquivo
+    # de captura (bytes ou mmap); um registro truncado no fim é ignorado
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError('arquivo de captura inválido')
+    pid, _ = FILE_HEADER.unpack_from(buffer, len(MAGIC))
+    pos = len(MAGIC) + FILE_HEADER.size
+    size = len(buffer)
+    unpack = RECORD.unpack_from
+    while pos + RECORD.size <= size:
+        timestamp, session, kind, length = unpack(buffer, pos)
+        start = pos + RECORD.size
+        end = start + length
+        if end > size:
+            break
+        yield pid, timestamp, session, kind, start, end
+        pos = end
+
+
+def capture_stats() -> Dict[str, int]:
+    stats = dict(_writer.stats) if _writer is not None else {}
+    stats['sessions'] = _sessions
+    return stats
@@ -1,5 +1,6 @@
 import os
 from pathlib import Path
+from typing import List, Tuple
 
 
 def _get_required_env(name: str) -> str:
@@ -31,6 +32,58 @@ def _get_required_bool(name: str) -> bool:
     )
 
 
+def _get_optional_env(name: str, default: str) -> str:
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    return value
+
+
+def _get_optional_int(name: str, default: int) -> int:
+    raw = _get_optional_env(name, str(default))
+    try:
+        return int(raw)
+    except ValueError:
+        raise RuntimeError(f"Valor inválido para {name}: '{raw}'. Esperado inteiro.")
+
+
+def _get_optional_bool(name: str, default: bool) -> bool:
+    raw = _get_optional_env(name, "true" if default else "false").strip().lower()
+    if raw in {"1", "true", "t", "yes", "y", "on"}:
+        return True
+    if raw in {"0", "false", "f", "no", "n", "off"}:
+        return False
+    raise RuntimeError(
+        f"Valor inválido para {name}: '{raw}'. Use true/false (1/0, on/off, yes/no)."
+    )
+
+
+def _get_optional_choice(name: str, default: str, choices: set) -> str:
+    raw = _get_optional_env(name, default).strip().lower()
+    if raw not in choices:
+        raise RuntimeError(
+            f"Valor inválido para {name}: '{raw}'. Use um de: {', '.join(sorted(choices))}."
+        )
+    return raw
+
+
+def _get_optional_hosts(name: str) -> List[Tuple[str, int]]:
+    # Lista "host:porta,host:porta" (porta opcional, padrão 5432)
+    hosts = []
+    for item in _get_optional_env(name, "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        host, sep, port = item.rpartition(":")
+        if not sep:
+            host, port = item, "5432"
+        try:
+            hosts.append((host.strip("[]"), int(port)))
+        except ValueError:
+            raise RuntimeError(f"Valor inválido em {name}: '{item}'. Use host:porta separados por vírgula.")
+    return hosts
+
+
 def _load_dotenv_file(path: Path) -> None:
     try:
         if not path.exists() or not path.is_file():
@@ -92,11 +145,152 @@ PG_PORT: int = _get_required_int("PG_PORT")
 # Configurações do Proxy local
 PROXY_HOST: str = _get_required_env("PROXY_HOST")
 PROXY_PORT: int = _get_required_int("PROXY_PORT")
+# Processos trabalhadores (cada um com seu event loop, mesma porta via SO_REUSEPORT)
+PROXY_WORKERS: int = _get_optional_int("PROXY_WORKERS", 1)
+# Usar uvloop como event loop, se instalado
+PROXY_UVLOOP: bool = _get_optional_bool("PROXY_UVLOOP", False)
+# Intervalo (segundos) do resumo de estatísticas agregadas dos trabalhadores
+WORKER_STATS_INTERVAL: int = _get_optional_int("WORKER_STATS_INTERVAL", 60)
+# Endpoint HTTP de métricas no formato do Prometheus (0 desativa; com vários
+# trabalhadores, o trabalhador i usa METRICS_PORT + i)
+METRICS_HOST: str = _get_optional_env("METRICS_HOST", "127.0.0.1")
+METRICS_PORT: int = _get_optional_int("METRICS_PORT", 0)
 
 # Código de requisição para negar SSL (cliente -> 'N')
 SSL_REQUEST_CODE: int = _get_required_int("SSL_REQUEST_CODE")
+# TLS com os clientes: certificado e chave (vazio desativa e o SSLRequest é
+# negado com 'N'), recusar clientes sem TLS e session tickets emitidos por
+# handshake (TLS 1.3), usados para retomar a sessão sem handshake completo
+CLIENT_TLS_CERT_FILE: str = _get_optional_env("CLIENT_TLS_CERT_FILE", "")
+CLIENT_TLS_KEY_FILE: str = _get_optional_env("CLIENT_TLS_KEY_FILE", "")
+CLIENT_TLS_REQUIRED: bool = _get_optional_bool("CLIENT_TLS_REQUIRED", False)
+CLIENT_TLS_SESSION_TICKETS: int = _get_optional_int("CLIENT_TLS_SESSION_TICKETS", 2)
+# TLS com o PostgreSQL, como o sslmode do libpq, e CA para verificar o servidor
+# (vazio = CAs do sistema)
+BACKEND_TLS_MODE: str = _get_optional_choice(
+    "BACKEND_TLS_MODE", "disable", {"disable", "prefer", "require", "verify-ca", "verify-full"}
+)
+BACKEND_TLS_CA_FILE: str = _get_optional_env("BACKEND_TLS_CA_FILE", "")
+# Tempo máximo (segundos) de um handshake TLS
+TLS_HANDSHAKE_TIMEOUT: int = _get_optional_int("TLS_HANDSHAKE_TIMEOUT", 10)
 
 # Ativar logs de consultas para depuração
 DEBUG_LOG_QUERIES: bool = _get_required_bool("DEBUG_LOG_QUERIES")
 
+# Logs: nível geral, níveis por categoria ("query=info,auth=warning") e formato
+LOG_LEVEL: str = _get_optional_choice("LOG_LEVEL", "info", {"debug", "info", "warning", "error"})
+LOG_LEVELS: str = _get_optional_env("LOG_LEVELS", "")
+LOG_FORMAT: str = _get_optional_choice("LOG_FORMAT", "text", {"text", "json"})
+# Amostragem dos logs por consulta: 1 a cada N, ou só a primeira ocorrência de cada fingerprint
+LOG_QUERY_SAMPLE_EVERY: int = _get_optional_int("LOG_QUERY_SAMPLE_EVERY", 1)
+LOG_QUERY_FIRST_ONLY: bool = _get_optional_bool("LOG_QUERY_FIRST_ONLY", False)
+# Tamanho máximo do texto de uma consulta nos logs (0 = sem limite)
+LOG_MAX_QUERY_CHARS: int = _get_optional_int("LOG_MAX_QUERY_CHARS", 2000)
+# Capacidade da fila de logs; com a fila cheia os registros são descartados
+LOG_QUEUE_SIZE: int = _get_optional_int("LOG_QUEUE_SIZE", 10000)
 
+# Cache LRU de reescritas (chave = bytes da consulta original; 0 desativa)
+REWRITE_CACHE_MAX_ENTRIES: int = _get_optional_int("REWRITE_CACHE_MAX_ENTRIES", 8192)
+REWRITE_CACHE_MAX_BYTES: int = _get_optional_int("REWRITE_CACHE_MAX_BYTES", 32 * 1024 * 1024)
+# Tamanho máximo de uma mensagem 'Q'/'P' acumulada para reescrita; acima
+# disso ela é repassada sem reescrita (em streaming, se atravessar leituras)
+REWRITE_MAX_MESSAGE_BYTES: int = _get_optional_int("REWRITE_MAX_MESSAGE_BYTES", 16 * 1024 * 1024)
+# Arquivo JSON com regras de reescrita adicionais (vazio = só as padrão)
+REWRITE_RULES_FILE: str = _get_optional_env("REWRITE_RULES_FILE", "")
+# Cache de mensagens Parse já reescritas (chave = corpo do 'P' original; 0 desativa)
+PARSE_CACHE_MAX_ENTRIES: int = _get_optional_int("PARSE_CACHE_MAX_ENTRIES", 4096)
+PARSE_CACHE_MAX_BYTES: int = _get_optional_int("PARSE_CACHE_MAX_BYTES", 16 * 1024 * 1024)
+# Statements nomeados acompanhados por conexão (os mais antigos são esquecidos)
+PARSE_CACHE_MAX_STATEMENTS: int = _get_optional_int("PARSE_CACHE_MAX_STATEMENTS", 1024)
+# Cache de resultados de SELECTs simples: tabelas ("schema.tabela" ou só
+# "tabela") e/ou fingerprints permitidos, separados por vírgula. Desativado
+# sem allowlist ou com TTL (segundos) igual a 0.
+RESULT_CACHE_TABLES: str = _get_optional_env("RESULT_CACHE_TABLES", "")
+RESULT_CACHE_FINGERPRINTS: str = _get_optional_env("RESULT_CACHE_FINGERPRINTS", "")
+RESULT_CACHE_TTL: int = _get_optional_int("RESULT_CACHE_TTL", 5)
+RESULT_CACHE_MAX_ENTRIES: int = _get_optional_int("RESULT_CACHE_MAX_ENTRIES", 1024)
+RESULT_CACHE_MAX_BYTES: int = _get_optional_int("RESULT_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+# Respostas maiores que isso não são guardadas
+RESULT_CACHE_MAX_ENTRY_BYTES: int = _get_optional_int("RESULT_CACHE_MAX_ENTRY_BYTES", 1024 * 1024)
+# Promoção automática de consultas simples repetidas a statements preparados:
+# execuções do mesmo texto (com literais trocados por parâmetros) numa conexão
+# com o backend antes de preparar (0 desativa) e máximo de statements por conexão
+AUTO_PREPARE_THRESHOLD: int = _get_optional_int("AUTO_PREPARE_THRESHOLD", 0)
+AUTO_PREPARE_MAX_STATEMENTS: int = _get_optional_int("AUTO_PREPARE_MAX_STATEMENTS", 256)
+# Estatísticas por consulta normalizada (fingerprint): máximo de consultas
+# acompanhadas (0 desativa), quantas aparecem no resumo e intervalo (segundos)
+# do resumo periódico no log (0 desativa)
+QUERY_STATS_MAX_ENTRIES: int = _get_optional_int("QUERY_STATS_MAX_ENTRIES", 0)
+QUERY_STATS_TOP: int = _get_optional_int("QUERY_STATS_TOP", 20)
+QUERY_STATS_DUMP_INTERVAL: int = _get_optional_int("QUERY_STATS_DUMP_INTERVAL", 0)
+# Captura do tráfego cliente->servidor para replay (vazio desativa): diretório
+# dos arquivos, tamanho de cada arquivo antes da rotação, arquivos mantidos
+# por processo (0 = todos) e capacidade da fila da thread de escrita
+CAPTURE_DIR: str = _get_optional_env("CAPTURE_DIR", "")
+CAPTURE_MAX_FILE_BYTES: int = _get_optional_int("CAPTURE_MAX_FILE_BYTES", 256 * 1024 * 1024)
+CAPTURE_MAX_FILES: int = _get_optional_int("CAPTURE_MAX_FILES", 8)
+CAPTURE_QUEUE_SIZE: int = _get_optional_int("CAPTURE_QUEUE_SIZE", 10000)
+# Diagnóstico: tempos por etapa dos laços de encaminhamento ligados desde o
+# início, eventos guardados pelo trace por conexão, duração (segundos) do
+# profile disparado por SIGUSR2 e diretório dos arquivos gravados pelos sinais
+# (vazio = diretório temporário do sistema)
+SPAN_TIMING: bool = _get_optional_bool("SPAN_TIMING", False)
+TRACE_BUFFER_SIZE: int = _get_optional_int("TRACE_BUFFER_SIZE", 10000)
+PROFILE_SECONDS: int = _get_optional_int("PROFILE_SECONDS", 10)
+DIAGNOSTICS_DIR: str = _get_optional_env("DIAGNOSTICS_DIR", "")
+
+# Após a autenticação, repassar servidor->cliente sem enquadrar mensagens
+SERVER_PASSTHROUGH: bool = _get_optional_bool("SERVER_PASSTHROUGH", True)
+# No repasse direto, detectar erros do servidor (melhor esforço) para o log
+SERVER_PASSTHROUGH_SNIFF_ERRORS: bool = _get_optional_bool("SERVER_PASSTHROUGH_SNIFF_ERRORS", True)
+
+# Controle de admissão: clientes simultâneos e conexões ao PostgreSQL sendo
+# abertas ao mesmo tempo (0 = sem limite). Acima do limite a conexão espera na
+# fila até o tempo máximo (segundos) e então recebe um erro.
+MAX_CLIENT_CONNECTIONS: int = _get_optional_int("MAX_CLIENT_CONNECTIONS", 0)
+CLIENT_QUEUE_TIMEOUT: int = _get_optional_int("CLIENT_QUEUE_TIMEOUT", 10)
+MAX_BACKEND_CONNECTS: int = _get_optional_int("MAX_BACKEND_CONNECTS", 0)
+BACKEND_QUEUE_TIMEOUT: int = _get_optional_int("BACKEND_QUEUE_TIMEOUT", 10)
+# Encerrar clientes ociosos dentro de uma transação e fora dela (segundos, 0 desativa)
+IDLE_IN_TRANSACTION_TIMEOUT: int = _get_optional_int("IDLE_IN_TRANSACTION_TIMEOUT", 0)
+IDLE_SESSION_TIMEOUT: int = _get_optional_int("IDLE_SESSION_TIMEOUT", 0)
+# Opções TCP dos sockets do cliente e do PostgreSQL (keepalive em segundos)
+TCP_NODELAY: bool = _get_optional_bool("TCP_NODELAY", True)
+TCP_KEEPALIVE: bool = _get_optional_bool("TCP_KEEPALIVE", True)
+TCP_KEEPALIVE_IDLE: int = _get_optional_int("TCP_KEEPALIVE_IDLE", 60)
+TCP_KEEPALIVE_INTERVAL: int = _get_optional_int("TCP_KEEPALIVE_INTERVAL", 10)
+TCP_KEEPALIVE_COUNT: int = _get_optional_int("TCP_KEEPALIVE_COUNT", 6)
+# Conexões com o PostgreSQL abertas de antemão para novos clientes fora do
+# modo pool (0 desativa) e idade máxima (segundos) de cada uma, abaixo do
+# authentication_timeout do servidor
+WARM_BACKENDS: int = _get_optional_int("WARM_BACKENDS", 0)
+WARM_BACKEND_MAX_AGE: int = _get_optional_int("WARM_BACKEND_MAX_AGE", 30)
+
+# Pool de conexões com o backend: off, session ou transaction
+POOL_MODE: str = _get_optional_choice("POOL_MODE", "off", {"off", "session", "transaction"})
+# Arquivo com as senhas dos usuários (formato userlist do pgbouncer: "usuario" "senha")
+POOL_USERS_FILE: str = _get_optional_env("POOL_USERS_FILE", "")
+# Como o proxy autentica os clientes no modo pool: md5, plain ou trust
+POOL_CLIENT_AUTH: str = _get_optional_choice("POOL_CLIENT_AUTH", "md5", {"md5", "plain", "trust"})
+# Máximo de conexões por (usuário, banco) e no total
+POOL_SIZE: int = _get_optional_int("POOL_SIZE", 20)
+POOL_MAX_BACKENDS: int = _get_optional_int("POOL_MAX_BACKENDS", 100)
+# Consulta executada ao devolver uma conexão ao pool (vazio desativa)
+POOL_RESET_QUERY: str = _get_optional_env("POOL_RESET_QUERY", "DISCARD ALL")
+# No modo transaction, executar a consulta de reset a cada devolução
+POOL_RESET_QUERY_ALWAYS: bool = _get_optional_bool("POOL_RESET_QUERY_ALWAYS", False)
+# Tempo máximo (segundos) para abrir e autenticar uma conexão com o backend
+POOL_CONNECT_TIMEOUT: float = float(_get_optional_int("POOL_CONNECT_TIMEOUT", 10))
+
+# Réplicas de leitura ("host:porta,host:porta"; só no modo pool) e intervalo
+# (segundos) da verificação de saúde delas
+PG_REPLICAS: List[Tuple[str, int]] = _get_optional_hosts("PG_REPLICAS")
+REPLICA_HEALTH_INTERVAL: int = _get_optional_int("REPLICA_HEALTH_INTERVAL", 5)
+
+if PG_REPLICAS and POOL_MODE == "off":
+    raise RuntimeError("PG_REPLICAS exige POOL_MODE session ou transaction (o roteamento é feito pelo pool).")
+
+if POOL_MODE != "off" and POOL_CLIENT_AUTH != "trust" and not POOL_USERS_FILE:
+    raise RuntimeError(
+        "POOL_USERS_FILE é obrigatório com POOL_MODE ativo (o proxy autentica os clientes e o backend)."
+    )
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+# Custo fixo aproximado por entrada (nó do OrderedDict + objetos bytes)
+ENTRY_OVERHEAD = 96
+
+
+# Cache LRU limitado por número de entradas e por bytes. O tamanho de cada
+# entrada é informado por quem insere; itens maiores que `max_item_bytes` não
+# são armazenados, para que um único item gigante não esvazie o cache.
+class LRUCache:
+    def __init__(self, max_entries: int, max_bytes: int, max_item_bytes: Optional[int] = None) -> None:
+        self.max_entries = max(0, max_entries)
+        self.max_bytes = max(0, max_bytes)
+        if max_item_bytes is None:
+            max_item_bytes = self.max_bytes // 16
+        self.max_item_bytes = max_item_bytes
+        self._data: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._sizes: Dict[Hashable, int] = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Hashable, value: Any, size: int) -> None:
+        if not self.enabled:
+            return
+        size += ENTRY_OVERHEAD
+        if size > self.max_item_bytes:
+            return
+        if key in self._data:
+            self.current_bytes -= self._sizes[key]
+            self._data.move_to_end(key)
+        self._data[key] = value
+        self._sizes[key] = size
+        self.current_bytes += size
+        while len(self._data) > self.max_entries or self.current_bytes > self.max_bytes:
+            old_key, _ = self._data.popitem(last=False)
+            self.current_bytes -= self._sizes.pop(old_key)
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self._data:
+            return default
+        self.current_bytes -= self._sizes.pop(key)
+        return self._data.pop(key)
+
+    def clear(self) -> None:
+        self._data.clear()
+        self._sizes.clear()
+        self.current_bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'entries': len(self._data),
+            'bytes': self.current_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,237 @@
+import asyncio
+import bisect
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+# Métricas no formato de texto do Prometheus. Tudo roda no event loop, então
+# os contadores são listas e atributos incrementados direto nos laços de
+# encaminhamento, sem locks; o texto só é montado quando o endpoint é lido.
+
+# Logger da categoria 'proxy' (proxy_logging), obtido pelo nome para este
+# módulo não depender da configuração
+_log = logging.getLogger('proxy.proxy')
+
+CLIENT_TO_SERVER = 0
+SERVER_TO_CLIENT = 1
+_DIRECTIONS = ('client_to_server', 'server_to_client')
+
+# Bytes e mensagens por direção (mensagens indexadas pelo byte de tipo). No
+# repasse direto servidor->cliente só os bytes são contados.
+bytes_total = [0, 0]
+messages_total = ([0] * 256, [0] * 256)
+# Mensagens 'Q'/'P' reescritas, por tipo
+rewrites_total = [0] * 256
+# ErrorResponse do servidor por SQLSTATE
+server_errors_total: Dict[str, int] = {}
+# Aplicações de cada regra de reescrita (execuções do reescritor, ou seja,
+# falhas do cache de reescrita)
+rewrite_rule_hits_total: Dict[str, int] = {}
+# Tempo (segundos) de cada etapa das leituras nos laços de encaminhamento e
+# leituras medidas, por direção; só com os spans ligados (tracing.py)
+SPAN_STEPS = ('framing', 'rewrite', 'write', 'drain')
+span_seconds_total = ([0.0] * len(SPAN_STEPS), [0.0] * len(SPAN_STEPS))
+span_reads_total = [0, 0]
+
+
+class Histogram:
+    __slots__ = ('name', 'help', 'bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, name: str, help_text: str, bounds: Tuple[float, ...]) -> None:
+        self.name = name
+        self.help = help_text
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, out: List[str]) -> None:
+        out.append(f'# HELP {self.name} {self.help}')
+        out.append(f'# TYPE {self.name} histogram')
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            out.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        out.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        out.append(f'{self.name}_sum {self.sum:.9f}')
+        out.append(f'{self.name}_count {self.count}')
+
+
+backend_connect_seconds = Histogram(
+    'proxy_backend_connect_seconds',
+    'Tempo para abrir (e, no modo pool, autenticar) uma conexão com o PostgreSQL',
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+rewrite_seconds = Histogram(
+    'proxy_rewrite_seconds',
+    'Duração do reescritor de SQL (falhas do cache de reescrita)',
+    (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05),
+)
+drain_seconds = Histogram(
+    'proxy_drain_seconds',
+    'Espera em drain() quando o buffer de escrita passa do limite',
+    (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0),
+)
+_TLS_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+client_tls_handshake_seconds = Histogram(
+    'proxy_client_tls_handshake_seconds',
+    'Duração do handshake TLS com os clientes',
+    _TLS_BOUNDS,
+)
+backend_tls_handshake_seconds = Histogram(
+    'proxy_backend_tls_handshake_seconds',
+    'Duração do handshake TLS com o PostgreSQL',
+    _TLS_BOUNDS,
+)
+warm_backend_refill_seconds = Histogram(
+    'proxy_warm_backend_refill_seconds',
+    'Tempo para abrir (e negociar TLS, se ativo) uma conexão mantida pronta para novos clientes',
+    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0),
+)
+_HISTOGRAMS = (
+    backend_connect_seconds, rewrite_seconds, drain_seconds, client_tls_handshake_seconds,
+    backend_tls_handshake_seconds, warm_backend_refill_seconds,
+)
+
+# Estatísticas de server_stats() que são valores instantâneos; as demais são
+# contadores
+_GAUGE_STATS = {
+    'clients_active',
+    'clients_waiting',
+    'backend_connects_active',
+    'backend_connects_waiting',
+    'rewrite_cache_entries',
+    'rewrite_cache_bytes',
+    'parse_cache_entries',
+    'parse_cache_bytes',
+    'result_cache_entries',
+    'result_cache_bytes',
+    'auto_prepare_unpreparable',
+    'query_stats_entries',
+    'warm_backends_idle',
+    'trace_enabled',
+    'trace_spans_enabled',
+    'trace_connections',
+    'trace_events',
+    'pool_total',
+    'pool_idle',
+    'pool_waiting',
+    'pool_in_use',
+    'replica_healthy',
+    'replica_in_use',
+}
+
+
+def count_server_error(sqlstate: str) -> None:
+    server_errors_total[sqlstate] = server_errors_total.get(sqlstate, 0) + 1
+
+
+def _type_label(msg_type: int) -> str:
+    if 32 < msg_type < 127 and msg_type not in (34, 92):
+        return chr(msg_type)
+    return f'0x{msg_type:02x}'
+
+
+def render(stats: Dict[str, int]) -> str:
+    out: List[str] = []
+    for name, value in sorted(stats.items()):
+        if name in _GAUGE_STATS:
+            metric = f'proxy_{name}'
+            out.append(f'# TYPE {metric} gauge')
+        else:
+            metric = f'proxy_{name}' if name.endswith('_total') else f'proxy_{name}_total'
+            out.append(f'# TYPE {metric} counter')
+        out.append(f'{metric} {value}')
+
+    out.append('# TYPE proxy_bytes_total counter')
+    for direction, value in zip(_DIRECTIONS, bytes_total):
+        out.append(f'proxy_bytes_total{{direction="{direction}"}} {value}')
+    out.append('# TYPE proxy_messages_total counter')
+    for direction, counts in zip(_DIRECTIONS, messages_total):
+        for msg_type, value in enumerate(counts):
+            if value:
+                out.append(f'proxy_messages_total{{direction="{direction}",type="{_type_label(msg_type)}"}} {value}')
+    out.append('# TYPE proxy_rewrites_total counter')
+    for msg_type in (81, 80):
+        out.append(f'proxy_rewrites_total{{type="{chr(msg_type)}"}} {rewrites_total[msg_type]}')
+    out.append('# TYPE proxy_rewrite_rule_hits_total counter')
+    for rule, value in rewrite_rule_hits_total.items():
+        out.append(f'proxy_rewrite_rule_hits_total{{rule="{rule}"}} {value}')
+    out.append('# TYPE proxy_server_errors_total counter')
+    for sqlstate, value in sorted(server_errors_total.items()):
+        out.append(f'proxy_server_errors_total{{sqlstate="{sqlstate}"}} {value}')
+    out.append('# TYPE proxy_span_seconds_total counter')
+    for direction, seconds in zip(_DIRECTIONS, span_seconds_total):
+        for step, value in zip(SPAN_STEPS, seconds):
+            out.append(f'proxy_span_seconds_total{{direction="{direction}",step="{step}"}} {value:.9f}')
+    out.append('# TYPE proxy_span_reads_total counter')
+    for direction, value in zip(_DIRECTIONS, span_reads_total):
+        out.append(f'proxy_span_reads_total{{direction="{direction}"}} {value}')
+
+    for histogram in _HISTOGRAMS:
+        histogram.render(out)
+    out.append('')
+    return '\n'.join(out)
+
+
+# Rotas extras do endpoint: caminho -> função que recebe a query string e
+# devolve (Content-Type, corpo), direto ou por uma corrotina
+Routes = Dict[bytes, Callable[[bytes], Union[Tuple[bytes, bytes], Awaitable[Tuple[bytes, bytes]]]]]
+
+
+async def _handle_http(
+    stats_fn: Callable[[], Dict[str, int]],
+    routes: Routes,
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+) -> None:
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request_line.split()
+        path, _, query_string = parts[1].partition(b'?') if len(parts) >= 2 and parts[0] == b'GET' else (b'', b'', b'')
+        try:
+            if path == b'/metrics':
+                status = b'200 OK'
+                content_type = b'text/plain; version=0.0.4; charset=utf-8'
+                body = render(stats_fn()).encode('utf-8')
+            elif path in routes:
+                status = b'200 OK'
+                result = routes[path](query_string)
+                if asyncio.iscoroutine(result):
+                    result = await result
+                content_type, body = result
+            else:
+                status = b'404 Not Found'
+                content_type = b'text/plain; charset=utf-8'
+                body = b'not found\n'
+        except Exception:
+            _log.exception('Erro no endpoint de métricas (%s)', path.decode('ascii', errors='replace'))
+            status = b'500 Internal Server Error'
+            content_type = b'text/plain; charset=utf-8'
+            body = b'internal server error\n'
+        writer.write(
+            b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + content_type
+            + b'\r\nContent-Length: %d\r\nConnection: close\r\n\r\n' % len(body) + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(
+    host: str, port: int, stats_fn: Callable[[], Dict[str, int]], routes: Optional[Routes] = None
+) -> asyncio.AbstractServer:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        await _handle_http(stats_fn, routes or {}, reader, writer)
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,101 @@
+import base64
+import hashlib
+import hmac
+import os
+from typing import Dict, Tuple
+
+# Autenticação usada quando o próprio proxy abre conexões com o PostgreSQL
+# (modo pool) e quando valida a senha dos clientes.
+
+AUTH_OK = 0
+AUTH_CLEARTEXT = 3
+AUTH_MD5 = 5
+AUTH_SASL = 10
+AUTH_SASL_CONTINUE = 11
+AUTH_SASL_FINAL = 12
+
+SCRAM_MECHANISM = 'SCRAM-SHA-256'
+
+# PBKDF2 com 4096 iterações custa milissegundos; o resultado depende só de
+# (senha, sal, iterações), que se repetem a cada nova conexão do pool.
+_salted_password_cache: Dict[Tuple[str, bytes, int], bytes] = {}
+
+
+def is_md5_hash(password: str) -> bool:
+    return password.startswith('md5') and len(password) == 35
+
+
+def md5_password_hash(user: str, password: str) -> str:
+    # Formato armazenado pelo PostgreSQL: 'md5' + md5(senha + usuário)
+    if is_md5_hash(password):
+        return password
+    return 'md5' + hashlib.md5((password + user).encode('utf-8')).hexdigest()
+
+
+def md5_response(user: str, password: str, salt: bytes) -> str:
+    inner = md5_password_hash(user, password)[3:]
+    return 'md5' + hashlib.md5(inner.encode('ascii') + salt).hexdigest()
+
+
+def verify_md5_response(user: str, password: str, salt: bytes, response: str) -> bool:
+    return hmac.compare_digest(md5_response(user, password, salt), response)
+
+
+def verify_cleartext_password(user: str, password: str, response: str) -> bool:
+    # A senha enviada pelo cliente é sempre hasheada: um hash 'md5...' copiado
+    # do pg_authid ou do arquivo de usuários não vale como senha
+    received = 'md5' + hashlib.md5((response + user).encode('utf-8')).hexdigest()
+    return hmac.compare_digest(received, md5_password_hash(user, password))
+
+
+def _hmac(key: bytes, data: bytes) -> bytes:
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+
+def _salted_password(password: str, salt: bytes, iterations: int) -> bytes:
+    key = (password, salt, iterations)
+    salted = _salted_password_cache.get(key)
+    if salted is None:
+        salted = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations)
+        if len(_salted_password_cache) > 1024:
+            _salted_password_cache.clear()
+        _salted_password_cache[key] = salted
+    return salted
+
+
+# Lado cliente do SCRAM-SHA-256 (RFC 5802/7677), sem channel binding
+class ScramClient:
+    def __init__(self, password: str) -> None:
+        self.password = password
+        self.nonce = base64.b64encode(os.urandom(18)).decode('ascii')
+        self.client_first_bare = f'n=,r={self.nonce}'
+        self.server_signature = b''
+
+    def initial_response(self) -> bytes:
+        return ('n,,' + self.client_first_bare).encode('ascii')
+
+    def final_response(self, server_first: bytes) -> bytes:
+        server_first_text = server_first.decode('ascii')
+        attrs = dict(item.split('=', 1) for item in server_first_text.split(','))
+        server_nonce = attrs['r']
+        if not server_nonce.startswith(self.nonce):
+            raise ValueError('nonce SCRAM inválido recebido do servidor')
+        salt = base64.b64decode(attrs['s'])
+        iterations = int(attrs['i'])
+
+        salted = _salted_password(self.password, salt, iterations)
+        client_key = _hmac(salted, b'Client Key')
+        stored_key = hashlib.sha256(client_key).digest()
+        without_proof = f'c=biws,r={server_nonce}'
+        auth_message = f'{self.client_first_bare},{server_first_text},{without_proof}'.encode('ascii')
+        signature = _hmac(stored_key, auth_message)
+        proof = bytes(a ^ b for a, b in zip(client_key, signature))
+        self.server_signature = _hmac(_hmac(salted, b'Server Key'), auth_message)
+        return f'{without_proof},p={base64.b64encode(proof).decode("ascii")}'.encode('ascii')
+
+    def verify_final(self, server_final: bytes) -> None:
+        attrs = dict(item.split('=', 1) for item in server_final.decode('ascii').split(','))
+        if 'e' in attrs:
+            raise ValueError(f"SCRAM recusado pelo servidor: {attrs['e']}")
+        if not hmac.compare_digest(base64.b64decode(attrs.get('v', '')), self.server_signature):
+            raise ValueError('assinatura SCRAM do servidor inválida')
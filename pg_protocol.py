@@ -0,0 +1,144 @@
+import asyncio
+import struct
+import time
+from typing import Dict, Optional, Tuple
+
+from metrics import drain_seconds
+
+# Utilitários do protocolo v3 do PostgreSQL compartilhados pelo proxy.
+
+PROTOCOL_V3 = 196608
+CANCEL_REQUEST_CODE = 80877102
+GSSENC_REQUEST_CODE = 80877104
+
+unpack_uint32 = struct.Struct('!I').unpack_from
+pack_uint32 = struct.Struct('!I').pack
+_pack_cancel = struct.Struct('!IIII').pack
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Acumula o trecho final incompleto de uma leitura até que a mensagem que
+# atravessa leituras esteja inteira. Leituras que contêm só mensagens
+# completas (o caso comum) são processadas sem nenhuma cópia. Mensagens que
+# o laço não precisa inspecionar não são acumuladas: o que chegou segue
+# adiante e `skip` guarda quantos bytes do corpo ainda virão.
+class Framer:
+    __slots__ = ('pending', 'need', 'skip')
+
+    def __init__(self) -> None:
+        self.pending = bytearray()
+        self.need = 0
+        self.skip = 0
+
+    def feed(self, data: bytes) -> Optional[bytes]:
+        if not self.pending:
+            return data
+        self.pending += data
+        if len(self.pending) < self.need:
+            return None
+        data = bytes(self.pending)
+        self.pending.clear()
+        return data
+
+    def keep(self, data: bytes, pos: int, need: int) -> None:
+        self.pending += memoryview(data)[pos:]
+        self.need = need
+
+    def take_skip(self, n: int) -> int:
+        # Quantos bytes do início de uma leitura de `n` bytes ainda pertencem
+        # à mensagem repassada em streaming
+        skip = self.skip
+        if skip == 0:
+            return 0
+        if skip >= n:
+            self.skip = skip - n
+            return n
+        self.skip = 0
+        return skip
+
+    def stream(self, remaining: int) -> None:
+        self.skip = remaining
+
+
+async def write_coalesced(writer: asyncio.StreamWriter, chunks, high_water: int) -> float:
+    # Uma única chamada de escrita por leitura; drain só quando o buffer do
+    # transporte passou do limite (é o que drain() faria de qualquer forma).
+    # Devolve o tempo de espera no drain.
+    transport = writer.transport
+    if transport.is_closing():
+        raise ConnectionResetError('Conexão fechada')
+    if isinstance(chunks, list):
+        writer.writelines(chunks)
+    else:
+        writer.write(chunks)
+    if transport.get_write_buffer_size() > high_water:
+        started = time.perf_counter()
+        await writer.drain()
+        drained = time.perf_counter() - started
+        drain_seconds.observe(drained)
+        return drained
+    return 0.0
+
+
+def message(msg_type: bytes, body: bytes = b'') -> bytes:
+    return msg_type + pack_uint32(len(body) + 4) + body
+
+
+def error_response(code: str, text: str, severity: str = 'ERROR') -> bytes:
+    sev = severity.encode('ascii')
+    body = (
+        b'S' + sev + b'\x00V' + sev + b'\x00C' + code.encode('ascii') + b'\x00M'
+        + text.encode('utf-8') + b'\x00\x00'
+    )
+    return message(b'E', body)
+
+
+def parse_error_fields(body: bytes) -> Dict[str, str]:
+    fields = {}
+    for part in body.split(b'\x00'):
+        if not part:
+            continue
+        fields[chr(part[0])] = part[1:].decode('utf-8', errors='replace')
+    return fields
+
+
+def startup_message(params: Dict[str, str]) -> bytes:
+    body = b''.join(k.encode('utf-8') + b'\x00' + v.encode('utf-8') + b'\x00' for k, v in params.items()) + b'\x00'
+    return pack_uint32(8 + len(body)) + pack_uint32(PROTOCOL_V3) + body
+
+
+def parse_startup_params(body: bytes) -> Dict[str, str]:
+    # `body` é o conteúdo após o código de protocolo
+    parts = body.split(b'\x00')
+    params = {}
+    for i in range(0, len(parts) - 1, 2):
+        key = parts[i].decode('utf-8', errors='replace')
+        if not key:
+            break
+        params[key] = parts[i + 1].decode('utf-8', errors='replace')
+    return params
+
+
+def cancel_request(pid: int, secret: int) -> bytes:
+    return _pack_cancel(16, CANCEL_REQUEST_CODE, pid, secret)
+
+
+async def read_message(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    header = await reader.readexactly(5)
+    length = unpack_uint32(header, 1)[0]
+    if length < 4:
+        raise ProtocolError(f'mensagem com tamanho inválido ({length})')
+    return header[0], await reader.readexactly(length - 4)
+
+
+async def read_startup_packet(reader: asyncio.StreamReader) -> Tuple[int, bytes]:
+    # Retorna (código, corpo após o código) de um pacote sem byte de tipo
+    header = await reader.readexactly(8)
+    length, code = struct.unpack('!II', header)
+    if length < 8 or length > 10000:
+        raise ProtocolError(f'mensagem de inicialização com tamanho inválido ({length})')
+    return code, await reader.readexactly(length - 8)
+
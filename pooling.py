@@ -0,0 +1,942 @@
+import asyncio
+import os
+import shlex
+import struct
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
+
+from admission import IdleTracker, backend_connect_slots, configure_socket, track_idle, untrack_idle
+from auto_prepare import AUTO_PREPARE_ENABLED, AutoPrepare, ServerStatements
+from config import (
+    BACKEND_QUEUE_TIMEOUT,
+    POOL_CLIENT_AUTH,
+    POOL_CONNECT_TIMEOUT,
+    POOL_RESET_QUERY,
+    POOL_RESET_QUERY_ALWAYS,
+    REWRITE_MAX_MESSAGE_BYTES,
+    SSL_REQUEST_CODE,
+)
+from pg_auth import (
+    AUTH_CLEARTEXT,
+    AUTH_MD5,
+    AUTH_OK,
+    AUTH_SASL,
+    AUTH_SASL_CONTINUE,
+    AUTH_SASL_FINAL,
+    SCRAM_MECHANISM,
+    ScramClient,
+    is_md5_hash,
+    md5_response,
+    verify_cleartext_password,
+    verify_md5_response,
+)
+from metrics import (
+    CLIENT_TO_SERVER,
+    SERVER_TO_CLIENT,
+    backend_connect_seconds,
+    bytes_total,
+    messages_total,
+)
+from pg_protocol import (
+    CANCEL_REQUEST_CODE,
+    GSSENC_REQUEST_CODE,
+    PROTOCOL_V3,
+    Framer,
+    ProtocolError,
+    cancel_request,
+    error_response,
+    message,
+    pack_uint32,
+    parse_error_fields,
+    parse_startup_params,
+    read_message,
+    read_startup_packet,
+    startup_message,
+    unpack_uint32,
+    write_coalesced,
+)
+from proxy_logging import auth_log, conn_log, log_server_error, pool_log, rewrite_log
+from query_rewrite import CLIENT_BUFFERED_TYPES, PreparedStatements, note_oversized_message, rewrite_message
+from query_stats import COMPLETION_TYPES, QUERY_STATS_ENABLED, ConnectionQueryStats
+from result_cache import RESULT_CACHE_ENABLED, ConnectionCache
+from sql_rewriter import is_read_only_query
+from tls import (
+    CLIENT_TLS_ENABLED,
+    TLS_REQUIRED_ERROR,
+    accept_client_tls,
+    has_buffered_data,
+    negotiate_backend_tls,
+    plaintext_refused,
+    remember_backend_session,
+)
+
+# Pool de conexões autenticadas com o PostgreSQL, no estilo do pgbouncer.
+#
+# O proxy autentica o cliente com as senhas de POOL_USERS_FILE e entrega a ele
+# uma conexão já autenticada do pool de (usuário, banco, parâmetros). No modo
+# session a conexão fica com o cliente até ele desconectar; no modo
+# transaction ela volta ao pool a cada ReadyForQuery ociosa ('Z' com 'I').
+#
+# Com réplicas de leitura, cada réplica tem seu próprio BackendPool. No modo
+# transaction um 'Q' com um único SELECT fora de transação vai para a réplica
+# saudável com menos conexões em uso; sessões abertas com o parâmetro
+# proxy_read_only vão inteiras para as réplicas. Sem réplica saudável, tudo
+# fica com o primário.
+
+READ_SIZE = 65536
+
+PoolKey = Tuple[str, str, Tuple[Tuple[str, str], ...]]
+
+# Parâmetros de inicialização que não separam pools
+_IGNORED_STARTUP_PARAMS = {'user', 'database', 'application_name'}
+
+# Parâmetro de inicialização do próprio proxy (não vai para o backend) que
+# manda a sessão inteira para as réplicas
+READ_ONLY_PARAM = 'proxy_read_only'
+
+_pack_backend_key = struct.Struct('!II').pack
+
+
+class BackendStartupError(Exception):
+    # `error_message` é a ErrorResponse pronta para ser repassada ao cliente
+    def __init__(self, text: str, error_message: Optional[bytes] = None) -> None:
+        super().__init__(text)
+        self.error_message = error_message or error_response('08006', text)
+
+
+def load_userlist(path: str) -> Dict[str, str]:
+    users: Dict[str, str] = {}
+    if not path:
+        return users
+    for line in Path(path).read_text(encoding='utf-8').splitlines():
+        stripped = line.strip()
+        if not stripped or stripped.startswith(';') or stripped.startswith('#'):
+            continue
+        parts = shlex.split(stripped)
+        if len(parts) >= 2:
+            users[parts[0]] = parts[1]
+    hashed = sorted(user for user, password in users.items() if is_md5_hash(password))
+    if hashed:
+        pool_log.warning(
+            'POOL_USERS_FILE tem hash md5 para %s: esses usuários só conectam a backends com autenticação md5 '
+            '(SCRAM e senha em texto exigem a senha original)', ', '.join(hashed),
+        )
+    return users
+
+
+class BackendConnection:
+    __slots__ = (
+        'key', 'reader', 'writer', 'parameter_status', 'backend_pid', 'backend_secret',
+        'status', 'created_at', 'last_used', 'pool', 'auto_statements',
+    )
+
+    def __init__(self, key: PoolKey, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        # `pool` é o BackendPool de origem (primário ou réplica)
+        self.pool: Optional['BackendPool'] = None
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.parameter_status: List[bytes] = []
+        self.backend_pid = 0
+        self.backend_secret = 0
+        self.status = 73
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        # Statements criados pela promoção automática de consultas simples
+        self.auto_statements = ServerStatements() if AUTO_PREPARE_ENABLED else None
+
+    def is_usable(self) -> bool:
+        return not self.writer.transport.is_closing() and not self.reader.at_eof()
+
+    def close(self) -> None:
+        try:
+            self.writer.write(message(b'X'))
+            self.writer.close()
+        except Exception:
+            pass
+
+
+async def _authenticate_backend(conn: BackendConnection, user: str, password: Optional[str]) -> None:
+    scram: Optional[ScramClient] = None
+    while True:
+        msg_type, body = await read_message(conn.reader)
+        if msg_type == 82:
+            code = unpack_uint32(body, 0)[0]
+            if code == AUTH_OK:
+                continue
+            if password is None:
+                raise BackendStartupError(f'sem senha configurada para o usuário "{user}" em POOL_USERS_FILE')
+            if (code == AUTH_CLEARTEXT or code == AUTH_SASL) and is_md5_hash(password):
+                raise BackendStartupError(
+                    f'o backend pede {"SCRAM" if code == AUTH_SASL else "senha em texto"} para o usuário "{user}", '
+                    'mas POOL_USERS_FILE tem só o hash md5; use a senha original'
+                )
+            if code == AUTH_CLEARTEXT:
+                conn.writer.write(message(b'p', password.encode('utf-8') + b'\x00'))
+            elif code == AUTH_MD5:
+                conn.writer.write(message(b'p', md5_response(user, password, body[4:8]).encode('ascii') + b'\x00'))
+            elif code == AUTH_SASL:
+                mechanisms = body[4:].split(b'\x00')
+                if SCRAM_MECHANISM.encode('ascii') not in mechanisms:
+                    raise BackendStartupError('mecanismo SASL não suportado pelo proxy')
+                scram = ScramClient(password)
+                initial = scram.initial_response()
+                conn.writer.write(message(
+                    b'p', SCRAM_MECHANISM.encode('ascii') + b'\x00' + pack_uint32(len(initial)) + initial
+                ))
+            elif code == AUTH_SASL_CONTINUE and scram is not None:
+                conn.writer.write(message(b'p', scram.final_response(body[4:])))
+            elif code == AUTH_SASL_FINAL and scram is not None:
+                scram.verify_final(body[4:])
+            else:
+                raise BackendStartupError(f'método de autenticação {code} não suportado pelo proxy')
+            await conn.writer.drain()
+        elif msg_type == 83:
+            conn.parameter_status.append(message(b'S', body))
+        elif msg_type == 75:
+            conn.backend_pid, conn.backend_secret = struct.unpack('!II', body[:8])
+        elif msg_type == 90:
+            conn.status = body[0]
+            return
+        elif msg_type == 69:
+            fields = parse_error_fields(body)
+            raise BackendStartupError(fields.get('M', 'erro do servidor'), message(b'E', body))
+
+
+async def open_backend(
+    host: str, port: int, key: PoolKey, params: Dict[str, str], password: Optional[str]
+) -> BackendConnection:
+    reader, writer = await asyncio.open_connection(host, port)
+    configure_socket(writer)
+    conn = BackendConnection(key, reader, writer)
+    try:
+        await negotiate_backend_tls(reader, writer, host)
+        writer.write(startup_message(params))
+        await writer.drain()
+        await _authenticate_backend(conn, params['user'], password)
+    except BaseException:
+        writer.close()
+        raise
+    remember_backend_session(writer, host)
+    return conn
+
+
+class BackendPool:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        users: Dict[str, str],
+        pool_size: int,
+        max_backends: int,
+        reset_query: str = POOL_RESET_QUERY,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.users = users
+        self.pool_size = max(1, pool_size)
+        self.max_backends = max(1, max_backends)
+        self.reset_query = reset_query
+        self._idle: Dict[PoolKey, Deque[BackendConnection]] = {}
+        self._counts: Dict[PoolKey, int] = {}
+        self._total = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._parameter_status: Dict[PoolKey, List[bytes]] = {}
+        self.created = 0
+        self.reused = 0
+        self.waited = 0
+        self.queue_timeouts = 0
+        self.closed = 0
+        # Conexões entregues a clientes e ainda não devolvidas
+        self.in_use = 0
+        self.healthy = True
+
+    @staticmethod
+    def key_for(params: Dict[str, str]) -> Tuple[PoolKey, Dict[str, str]]:
+        user = params.get('user', '')
+        database = params.get('database') or user
+        extra = tuple(sorted((k, v) for k, v in params.items() if k not in _IGNORED_STARTUP_PARAMS))
+        backend_params = {'user': user, 'database': database}
+        backend_params.update(extra)
+        return (user, database, extra), backend_params
+
+    def _wake_one(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def _forget(self, conn: BackendConnection) -> None:
+        self._total -= 1
+        self._counts[conn.key] -= 1
+        self.closed += 1
+        conn.close()
+        self._wake_one()
+
+    def _evict_idle(self, except_key: PoolKey) -> bool:
+        # Com o limite total atingido, fecha uma conexão ociosa de outro pool
+        oldest: Optional[BackendConnection] = None
+        for key, idle in self._idle.items():
+            if key != except_key and idle and (oldest is None or idle[0].last_used < oldest.last_used):
+                oldest = idle[0]
+        if oldest is None:
+            return False
+        self._idle[oldest.key].popleft()
+        self._forget(oldest)
+        return True
+
+    async def acquire(self, key: PoolKey, params: Dict[str, str]) -> BackendConnection:
+        deadline = None
+        while True:
+            idle = self._idle.get(key)
+            while idle:
+                conn = idle.pop()
+                if conn.is_usable():
+                    self.reused += 1
+                    self.in_use += 1
+                    return conn
+                self._forget(conn)
+            if self._total < self.max_backends and self._counts.get(key, 0) < self.pool_size:
+                break
+            if self._total >= self.max_backends and self._evict_idle(key):
+                continue
+            self.waited += 1
+            loop = asyncio.get_running_loop()
+            if deadline is None and BACKEND_QUEUE_TIMEOUT > 0:
+                deadline = loop.time() + BACKEND_QUEUE_TIMEOUT
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, None if deadline is None else max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                self.queue_timeouts += 1
+                raise BackendStartupError(
+                    'tempo esgotado aguardando uma conexão livre no pool',
+                    error_response('53300', 'tempo esgotado aguardando uma conexão livre no pool do proxy', 'FATAL'),
+                )
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._wake_one()
+                raise
+
+        self._total += 1
+        self._counts[key] = self._counts.get(key, 0) + 1
+        try:
+            if not await backend_connect_slots.acquire(BACKEND_QUEUE_TIMEOUT):
+                raise BackendStartupError(
+                    'tempo esgotado aguardando vaga para conectar ao PostgreSQL',
+                    error_response('53300', 'tempo esgotado aguardando conexão com o PostgreSQL no proxy', 'FATAL'),
+                )
+            try:
+                started = time.perf_counter()
+                conn = await asyncio.wait_for(
+                    open_backend(self.host, self.port, key, params, self.users.get(key[0])),
+                    POOL_CONNECT_TIMEOUT,
+                )
+            finally:
+                backend_connect_slots.release()
+        except BaseException:
+            self._total -= 1
+            self._counts[key] -= 1
+            self._wake_one()
+            raise
+        backend_connect_seconds.observe(time.perf_counter() - started)
+        conn.pool = self
+        self.created += 1
+        self.in_use += 1
+        self._parameter_status[key] = conn.parameter_status
+        return conn
+
+    async def parameter_status(self, key: PoolKey, params: Dict[str, str]) -> List[bytes]:
+        # Mensagens ParameterStatus para o cliente; abre uma conexão na
+        # primeira vez que o pool é usado
+        cached = self._parameter_status.get(key)
+        if cached is not None:
+            return cached
+        conn = await self.acquire(key, params)
+        self.release(conn)
+        return conn.parameter_status
+
+    def release(self, conn: BackendConnection, reset: bool = False) -> None:
+        self.in_use -= 1
+        self._put_back(conn, reset)
+
+    def discard(self, conn: BackendConnection) -> None:
+        self.in_use -= 1
+        self._forget(conn)
+
+    def close_idle(self) -> None:
+        for idle in self._idle.values():
+            while idle:
+                self._forget(idle.pop())
+
+    def _put_back(self, conn: BackendConnection, reset: bool) -> None:
+        if not conn.is_usable() or conn.status != 73:
+            self._forget(conn)
+            return
+        if reset and self.reset_query:
+            asyncio.create_task(self._reset_and_release(conn))
+            return
+        conn.last_used = time.monotonic()
+        self._idle.setdefault(conn.key, deque()).append(conn)
+        self._wake_one()
+
+    async def _reset_and_release(self, conn: BackendConnection) -> None:
+        if conn.auto_statements is not None:
+            conn.auto_statements.clear()
+        try:
+            conn.writer.write(message(b'Q', self.reset_query.encode('utf-8') + b'\x00'))
+            await conn.writer.drain()
+            while True:
+                msg_type, body = await asyncio.wait_for(read_message(conn.reader), POOL_CONNECT_TIMEOUT)
+                if msg_type == 90:
+                    conn.status = body[0]
+                    break
+        except Exception as e:
+            pool_log.error('Erro executando reset da conexão do pool: %s', e)
+            self._forget(conn)
+            return
+        self._put_back(conn, False)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'total': self._total,
+            'idle': sum(len(idle) for idle in self._idle.values()),
+            'in_use': self.in_use,
+            'waiting': len(self._waiters),
+            'created': self.created,
+            'reused': self.reused,
+            'waited': self.waited,
+            'queue_timeouts': self.queue_timeouts,
+            'closed': self.closed,
+        }
+
+
+# Réplicas de leitura: escolhe a réplica saudável com menos conexões em uso
+# (empates em rodízio). A saúde é verificada periodicamente com um SSLRequest,
+# que o PostgreSQL responde sem registrar nada no log, e também quando abrir
+# uma conexão com a réplica falha.
+class ReplicaSet:
+    def __init__(self, pools: List[BackendPool]) -> None:
+        self.pools = pools
+        self._next = 0
+        self.routed = 0
+        self.fallbacks = 0
+
+    def pick(self) -> Optional[BackendPool]:
+        count = len(self.pools)
+        start = self._next
+        self._next = (start + 1) % count
+        best: Optional[BackendPool] = None
+        for i in range(count):
+            pool = self.pools[(start + i) % count]
+            if pool.healthy and (best is None or pool.in_use < best.in_use):
+                best = pool
+        if best is None:
+            self.fallbacks += 1
+        else:
+            self.routed += 1
+        return best
+
+    def mark_down(self, pool: BackendPool, reason: object) -> None:
+        if pool.healthy:
+            pool.healthy = False
+            pool_log.warning(
+                'Réplica %s:%s indisponível (%s); leituras seguem para o primário', pool.host, pool.port, reason
+            )
+        pool.close_idle()
+
+    def mark_up(self, pool: BackendPool) -> None:
+        if not pool.healthy:
+            pool.healthy = True
+            pool_log.info('Réplica %s:%s disponível novamente', pool.host, pool.port)
+
+    async def _check(self, pool: BackendPool) -> None:
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(pool.host, pool.port), POOL_CONNECT_TIMEOUT)
+            writer.write(pack_uint32(8) + pack_uint32(SSL_REQUEST_CODE))
+            answer = await asyncio.wait_for(reader.read(1), POOL_CONNECT_TIMEOUT)
+            if answer not in (b'S', b'N'):
+                raise ProtocolError('resposta inesperada ao SSLRequest')
+        except (OSError, asyncio.TimeoutError, ProtocolError) as e:
+            self.mark_down(pool, e or 'tempo esgotado')
+        else:
+            self.mark_up(pool)
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def check_health(self, interval: float) -> None:
+        while True:
+            await asyncio.gather(*(self._check(pool) for pool in self.pools))
+            await asyncio.sleep(interval)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'healthy': sum(1 for pool in self.pools if pool.healthy),
+            'in_use': sum(pool.in_use for pool in self.pools),
+            'reads': self.routed,
+            'fallbacks': self.fallbacks,
+        }
+
+
+# Chave de cancelamento falsa entregue ao cliente -> sessão
+_sessions_by_cancel_key: Dict[Tuple[int, int], 'PooledSession'] = {}
+
+
+async def _forward_cancel(body: bytes) -> None:
+    if len(body) < 8:
+        return
+    pid, secret = struct.unpack('!II', body[:8])
+    session = _sessions_by_cancel_key.get((pid, secret))
+    if session is None or session.backend is None:
+        return
+    backend = session.backend
+    try:
+        _, writer = await asyncio.open_connection(backend.pool.host, backend.pool.port)
+        writer.write(cancel_request(backend.backend_pid, backend.backend_secret))
+        await writer.drain()
+        writer.close()
+    except Exception as e:
+        pool_log.error('Erro encaminhando cancelamento: %s', e)
+
+
+class PooledSession:
+    def __init__(
+        self,
+        pool: BackendPool,
+        mode: str,
+        client_reader: asyncio.StreamReader,
+        client_writer: asyncio.StreamWriter,
+        replicas: Optional[ReplicaSet] = None,
+    ) -> None:
+        self.pool = pool
+        self.replicas = replicas
+        self.read_only = False
+        self.transaction_mode = mode == 'transaction'
+        self.client_reader = client_reader
+        self.client_writer = client_writer
+        self.key: Optional[PoolKey] = None
+        self.backend_params: Dict[str, str] = {}
+        self.backend: Optional[BackendConnection] = None
+        self.relay_task: Optional[asyncio.Task] = None
+        self.client_task: Optional[asyncio.Task] = None
+        self.relay_framer = Framer()
+        # Requisições ('Q', 'S', 'F') aguardando ReadyForQuery
+        self.pending = 0
+        # Mensagens do protocolo estendido enviadas depois do último Sync
+        self.unsynced = False
+        self.cancel_key = struct.unpack('!II', os.urandom(8))
+        self.idle: Optional[IdleTracker] = None
+        self.cache: Optional[ConnectionCache] = None
+        self.auto = AutoPrepare() if AUTO_PREPARE_ENABLED else None
+        self.query_stats = ConnectionQueryStats() if QUERY_STATS_ENABLED else None
+
+    async def _read_startup(self) -> Optional[Dict[str, str]]:
+        while True:
+            code, body = await read_startup_packet(self.client_reader)
+            tls_pending = CLIENT_TLS_ENABLED and self.client_writer.get_extra_info('ssl_object') is None
+            if code == SSL_REQUEST_CODE and tls_pending:
+                if has_buffered_data(self.client_reader):
+                    raise ProtocolError('dados do cliente enviados junto com o SSLRequest')
+                await accept_client_tls(self.client_writer)
+                continue
+            if code == SSL_REQUEST_CODE or code == GSSENC_REQUEST_CODE:
+                self.client_writer.write(b'N')
+                await self.client_writer.drain()
+                continue
+            if code == CANCEL_REQUEST_CODE:
+                await _forward_cancel(body)
+                return None
+            if plaintext_refused(self.client_writer, code):
+                self.client_writer.write(TLS_REQUIRED_ERROR)
+                await self.client_writer.drain()
+                return None
+            if code != PROTOCOL_V3:
+                raise ProtocolError(f'versão de protocolo não suportada ({code})')
+            return parse_startup_params(body)
+
+    async def _authenticate_client(self, user: str) -> bool:
+        if POOL_CLIENT_AUTH == 'trust':
+            return True
+        password = self.pool.users.get(user)
+        if POOL_CLIENT_AUTH == 'md5':
+            salt = os.urandom(4)
+            self.client_writer.write(message(b'R', pack_uint32(AUTH_MD5) + salt))
+        else:
+            self.client_writer.write(message(b'R', pack_uint32(AUTH_CLEARTEXT)))
+        await self.client_writer.drain()
+        msg_type, body = await read_message(self.client_reader)
+        response = body.rstrip(b'\x00').decode('utf-8', errors='replace')
+        if msg_type == 112 and password is not None:
+            if POOL_CLIENT_AUTH == 'md5':
+                if verify_md5_response(user, password, salt, response):
+                    return True
+            elif verify_cleartext_password(user, password, response):
+                return True
+        auth_log.warning('Autenticação do cliente falhou para o usuário "%s"', user)
+        self.client_writer.write(error_response(
+            '28P01', f'autenticação por senha falhou para o usuário "{user}"', 'FATAL'
+        ))
+        await self.client_writer.drain()
+        return False
+
+    def _attach(self, backend: BackendConnection) -> None:
+        self.backend = backend
+        if self.auto is not None:
+            self.auto.server = backend.auto_statements
+        self.relay_framer = Framer()
+        self.relay_task = asyncio.create_task(self._relay_backend(backend))
+
+    async def _acquire(self, read_only: bool = False) -> BackendConnection:
+        replicas = self.replicas
+        if replicas is not None and (read_only or self.read_only):
+            pool = replicas.pick()
+            if pool is not None:
+                try:
+                    backend = await pool.acquire(self.key, self.backend_params)
+                except (OSError, asyncio.TimeoutError) as e:
+                    replicas.mark_down(pool, e or 'tempo esgotado')
+                except BackendStartupError as e:
+                    # Réplica acessível, mas sem conexão para esta sessão (pool
+                    # cheio, erro de autenticação ou do servidor): a leitura
+                    # vai para o primário e a réplica continua em uso
+                    replicas.fallbacks += 1
+                    pool_log.warning('Réplica %s:%s recusou a conexão (%s); usando o primário', pool.host, pool.port, e)
+                else:
+                    self._attach(backend)
+                    return backend
+        backend = await self.pool.acquire(self.key, self.backend_params)
+        self._attach(backend)
+        return backend
+
+    async def _wait_replica_release(self) -> None:
+        # A réplica ainda responde a consultas já enviadas; a próxima
+        # mensagem precisa do primário, então espera a réplica voltar ao pool
+        relay_task = self.relay_task
+        if relay_task is not None:
+            try:
+                await asyncio.shield(relay_task)
+            except Exception:
+                pass
+
+    async def _relay_backend(self, backend: BackendConnection) -> None:
+        high_water = self.client_writer.transport.get_write_buffer_limits()[1]
+        framer = self.relay_framer
+        msg_counts = messages_total[SERVER_TO_CLIENT]
+        cache = self.cache
+        auto = self.auto
+        query_stats = self.query_stats
+        try:
+            while True:
+                data = await backend.reader.read(READ_SIZE)
+                if not data:
+                    raise ConnectionResetError('backend encerrou a conexão')
+                bytes_total[SERVER_TO_CLIENT] += len(data)
+                data = framer.feed(data)
+                if data is None:
+                    continue
+                n = len(data)
+                pos = framer.take_skip(n)
+                run_start = 0
+                need = 5
+                chunks = []
+                while n - pos >= 5:
+                    end = pos + 1 + unpack_uint32(data, pos + 1)[0]
+                    msg_type = data[pos]
+                    capturing = cache is not None and cache.capture is not None
+                    if end > n:
+                        # Só 'Z', 'E' e 'C' (e a resposta sendo guardada no cache
+                        # de resultados) são lidos; o resto segue em streaming
+                        if (
+                            (msg_type == 90 or msg_type == 69 or msg_type == 67 or capturing)
+                            and end - pos <= REWRITE_MAX_MESSAGE_BYTES
+                        ):
+                            need = end - pos
+                        else:
+                            msg_counts[msg_type] += 1
+                            if capturing:
+                                cache.capture = None
+                            framer.stream(end - n)
+                            pos = n
+                        break
+                    msg_counts[msg_type] += 1
+                    if auto is not None and auto.expected and not auto.server_message(data, pos, end):
+                        # Resposta a mensagens acrescentadas pelo proxy
+                        if pos > run_start:
+                            chunks.append(memoryview(data)[run_start:pos])
+                        run_start = pos = end
+                        continue
+                    if query_stats is not None and query_stats.pending and msg_type in COMPLETION_TYPES:
+                        query_stats.server_message(data, pos, end)
+                    if capturing:
+                        cache.server_message(data, pos, end)
+                    if msg_type == 90:
+                        backend.status = data[pos + 5]
+                        if self.pending > 0:
+                            self.pending -= 1
+                        if self.pending == 0 and self.idle is not None:
+                            self.idle.ready(backend.status)
+                        if cache is not None:
+                            cache.ready(backend.status)
+                    elif msg_type == 69:
+                        log_server_error(data[pos + 5:end])
+                    pos = end
+                if query_stats is not None:
+                    query_stats.advance(pos)
+                if pos < n:
+                    framer.keep(data, pos, need)
+                if run_start:
+                    if pos > run_start:
+                        chunks.append(memoryview(data)[run_start:pos])
+                    if chunks:
+                        await write_coalesced(self.client_writer, chunks, high_water)
+                elif pos < n:
+                    if pos == 0:
+                        continue
+                    await write_coalesced(self.client_writer, data[:pos], high_water)
+                else:
+                    await write_coalesced(self.client_writer, data, high_water)
+
+                if (
+                    self.transaction_mode
+                    and self.pending == 0
+                    and not self.unsynced
+                    and not framer.pending
+                    and not framer.skip
+                    and backend.status == 73
+                    and self.backend is backend
+                ):
+                    # Fim da transação: a conexão volta para o pool
+                    self.backend = None
+                    self.relay_task = None
+                    backend.pool.release(backend, reset=POOL_RESET_QUERY_ALWAYS)
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if self.backend is backend:
+                conn_log.error('Erro no fluxo servidor->cliente (pool): %s', e)
+                self.backend = None
+                self.relay_task = None
+                backend.pool.discard(backend)
+                if self.client_task is not None:
+                    self.client_task.cancel()
+
+    async def _client_loop(self) -> None:
+        framer = Framer()
+        statements = PreparedStatements()
+        msg_counts = messages_total[CLIENT_TO_SERVER]
+        idle = self.idle
+        while True:
+            data = await self.client_reader.read(READ_SIZE)
+            if not data:
+                return
+            bytes_total[CLIENT_TO_SERVER] += len(data)
+            if idle is not None:
+                idle.idle_since = 0.0
+            data = framer.feed(data)
+            if data is None:
+                continue
+
+            n = len(data)
+            view = memoryview(data)
+            pos = framer.take_skip(n)
+            run_start = 0
+            need = 5
+            chunks = []
+            terminate = False
+            while n - pos >= 5:
+                end = pos + 1 + unpack_uint32(data, pos + 1)[0]
+                msg_type = data[pos]
+                streamed = False
+                if end > n:
+                    if msg_type in CLIENT_BUFFERED_TYPES and end - pos <= REWRITE_MAX_MESSAGE_BYTES:
+                        need = end - pos
+                        break
+                    streamed = True
+                msg_counts[msg_type] += 1
+                if msg_type == 88:
+                    # Terminate não vai para o backend: a conexão fica no pool
+                    if pos > run_start:
+                        chunks.append(view[run_start:pos])
+                    terminate = True
+                    run_start = pos = end
+                    break
+                cache = self.cache
+                if cache is not None and streamed:
+                    if msg_type == 81 or msg_type == 80 or msg_type == 66:
+                        cache.oversized(msg_type, data, pos, n)
+                elif cache is not None and (msg_type == 81 or msg_type == 80 or msg_type == 66):
+                    cache.client_message(msg_type, data, pos, end)
+                    if (
+                        msg_type == 81
+                        and self.pending == 0
+                        and not self.unsynced
+                        and (self.backend is None or self.backend.status == 73)
+                    ):
+                        reply = cache.lookup(data, pos, end)
+                        if reply is not None:
+                            # Resposta do cache: nenhum backend é usado
+                            if pos > run_start:
+                                chunks.append(view[run_start:pos])
+                            run_start = pos = end
+                            self.client_writer.write(reply)
+                            if idle is not None:
+                                idle.ready(73)
+                            continue
+                backend = self.backend
+                if self.replicas is not None and self.transaction_mode and not self.read_only:
+                    read_only = (
+                        msg_type == 81 and not streamed and is_read_only_query(data[pos + 5:end - 1])
+                    )
+                    if backend is not None and backend.pool is not self.pool and not read_only:
+                        if pos > run_start:
+                            chunks.append(view[run_start:pos])
+                        run_start = pos
+                        if chunks:
+                            await write_coalesced(
+                                backend.writer, chunks, backend.writer.transport.get_write_buffer_limits()[1]
+                            )
+                            chunks = []
+                        await self._wait_replica_release()
+                        backend = self.backend
+                    if backend is None:
+                        await self._acquire(read_only)
+                elif backend is None:
+                    await self._acquire()
+                if msg_type == 81 or msg_type == 83 or msg_type == 70:
+                    self.pending += 1
+                    self.unsynced = False
+                elif msg_type in (80, 66, 69, 68, 67, 72):
+                    self.unsynced = True
+                auto = self.auto
+                if auto is not None and (msg_type != 81 or streamed):
+                    auto.client_message(msg_type)
+                query_stats = self.query_stats
+                if query_stats is not None and (streamed or (msg_type != 81 and msg_type != 80)):
+                    query_stats.client_message(msg_type, data, pos, end)
+                if streamed:
+                    # O restante da mensagem segue nas próximas leituras
+                    note_oversized_message(msg_type, end - pos)
+                    framer.stream(end - n)
+                    pos = n
+                    break
+                if msg_type == 81 or msg_type == 80:
+                    try:
+                        new_msg = rewrite_message(msg_type, data, pos, end, statements)
+                    except Exception as e:
+                        rewrite_log.error('Erro reescrevendo %s: %s', chr(msg_type), e)
+                        new_msg = None
+                    if query_stats is not None:
+                        if msg_type == 81:
+                            query_stats.simple_query(data[pos + 5:end - 1], new_msg is not None)
+                        else:
+                            query_stats.parse(data, pos, end, new_msg is not None)
+                    if auto is not None and msg_type == 81:
+                        promoted = auto.simple_query(new_msg[5:-1] if new_msg is not None else data[pos + 5:end - 1])
+                        if promoted is not None:
+                            new_msg = promoted
+                    if new_msg is not None:
+                        if pos > run_start:
+                            chunks.append(view[run_start:pos])
+                        chunks.append(new_msg)
+                        run_start = end
+                elif msg_type == 67:
+                    statements.close(data, pos, end)
+                pos = end
+
+            if pos < n and not terminate:
+                framer.keep(data, pos, need)
+            if pos > run_start:
+                chunks.append(view[run_start:pos])
+            if chunks and self.backend is not None:
+                backend = self.backend
+                await write_coalesced(backend.writer, chunks, backend.writer.transport.get_write_buffer_limits()[1])
+            if terminate:
+                return
+
+    async def run(self) -> None:
+        peer = self.client_writer.get_extra_info('peername')
+        conn_log.info('Cliente conectado (pool): %s', peer, extra={'peer': str(peer)})
+        try:
+            params = await self._read_startup()
+            if params is None:
+                return
+            read_only = params.pop(READ_ONLY_PARAM, None)
+            if read_only is not None:
+                self.read_only = read_only.strip().lower() in ('1', 'on', 'true', 'yes')
+            user = params.get('user', '')
+            if not user:
+                self.client_writer.write(error_response('28000', 'nenhum usuário informado na conexão', 'FATAL'))
+                return
+            if not await self._authenticate_client(user):
+                return
+            self.key, self.backend_params = self.pool.key_for(params)
+            if self.transaction_mode:
+                status_messages = await self.pool.parameter_status(self.key, self.backend_params)
+            else:
+                status_messages = (await self._acquire()).parameter_status
+            self.client_writer.write(
+                message(b'R', pack_uint32(AUTH_OK))
+                + b''.join(status_messages)
+                + message(b'K', _pack_backend_key(*self.cancel_key))
+                + message(b'Z', b'I')
+            )
+            await self.client_writer.drain()
+            _sessions_by_cancel_key[self.cancel_key] = self
+            self.idle = track_idle(self.client_writer)
+            if RESULT_CACHE_ENABLED:
+                self.cache = ConnectionCache(self.key)
+            self.client_task = asyncio.create_task(self._client_loop())
+            try:
+                await self.client_task
+            except asyncio.CancelledError:
+                pass
+        except BackendStartupError as e:
+            pool_log.error('Erro conectando ao PostgreSQL pelo pool: %s', e)
+            self.client_writer.write(e.error_message)
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            conn_log.error('Erro ao lidar com cliente %s (pool): %s', peer, e, extra={'peer': str(peer)})
+        finally:
+            await self._close()
+
+    async def _close(self) -> None:
+        _sessions_by_cancel_key.pop(self.cancel_key, None)
+        untrack_idle(self.idle)
+        relay_task = self.relay_task
+        if relay_task is not None:
+            relay_task.cancel()
+            try:
+                await relay_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        backend = self.backend
+        self.backend = None
+        if backend is not None:
+            relay_framer = self.relay_framer
+            if self.pending == 0 and not self.unsynced and not relay_framer.pending and not relay_framer.skip:
+                backend.pool.release(backend, reset=True)
+            else:
+                backend.pool.discard(backend)
+        try:
+            self.client_writer.close()
+            await self.client_writer.wait_closed()
+        except Exception:
+            pass
+
+
+async def handle_pooled_client(
+    pool: BackendPool,
+    mode: str,
+    client_reader: asyncio.StreamReader,
+    client_writer: asyncio.StreamWriter,
+    replicas: Optional[ReplicaSet] = None,
+) -> None:
+    await PooledSession(pool, mode, client_reader, client_writer, replicas).run()
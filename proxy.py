@@ -1,14 +1,19 @@
 import asyncio
 
-from config import PROXY_HOST, PROXY_PORT
+from config import PROXY_HOST, PROXY_PORT, PROXY_WORKERS
+from proxy_logging import setup_logging
 from proxy_server import run_server
+from workers import install_event_loop, run_workers
 
 
 def main() -> None:
+    setup_logging()
+    if PROXY_WORKERS > 1:
+        run_workers(PROXY_HOST, PROXY_PORT, PROXY_WORKERS)
+        return
+    install_event_loop()
     asyncio.run(run_server(PROXY_HOST, PROXY_PORT))
 
 
 if __name__ == '__main__':
     main()
-
-
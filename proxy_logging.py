@@ -0,0 +1,254 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from typing import Dict, Optional
+
+from config import (
+    DEBUG_LOG_QUERIES,
+    LOG_FORMAT,
+    LOG_LEVEL,
+    LOG_LEVELS,
+    LOG_MAX_QUERY_CHARS,
+    LOG_QUERY_FIRST_ONLY,
+    LOG_QUERY_SAMPLE_EVERY,
+    LOG_QUEUE_SIZE,
+)
+from metrics import count_server_error
+from pg_protocol import parse_error_fields
+from sql_rewriter import fingerprint
+
+# Logs do proxy: cada categoria tem seu logger ('proxy.<categoria>') com nível
+# próprio, e os registros vão para uma fila drenada por uma thread. O event
+# loop nunca espera pela escrita em stdout: a formatação (inclusive decodificar
+# o texto das consultas) acontece na thread, e com a fila cheia o registro é
+# descartado e contado em vez de bloquear.
+
+CATEGORIES = ('proxy', 'conn', 'auth', 'server', 'query', 'rewrite', 'pool', 'worker', 'stats')
+
+_LEVEL_NAMES = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+}
+
+# Campos extras (além da mensagem) incluídos na saída JSON
+_JSON_FIELDS = ('kind', 'fingerprint', 'sqlstate', 'severity', 'peer', 'worker')
+
+# Limite de fingerprints lembrados para a amostragem "primeira ocorrência"
+_MAX_SEEN_FINGERPRINTS = 10000
+
+
+def get_logger(category: str) -> logging.Logger:
+    return logging.getLogger('proxy.' + category)
+
+
+proxy_log = get_logger('proxy')
+conn_log = get_logger('conn')
+auth_log = get_logger('auth')
+server_log = get_logger('server')
+query_log = get_logger('query')
+rewrite_log = get_logger('rewrite')
+pool_log = get_logger('pool')
+worker_log = get_logger('worker')
+stats_log = get_logger('stats')
+
+
+# Texto de consulta decodificado e truncado só quando o registro é formatado
+# (na thread de escrita)
+class QueryText:
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        data = self.data
+        if LOG_MAX_QUERY_CHARS <= 0:
+            return data.decode('utf-8', errors='replace')
+        text = data[:LOG_MAX_QUERY_CHARS * 4].decode('utf-8', errors='replace')
+        if len(text) > LOG_MAX_QUERY_CHARS or len(data) > LOG_MAX_QUERY_CHARS * 4:
+            return f'{text[:LOG_MAX_QUERY_CHARS]}... ({len(data)} bytes)'
+        return text
+
+
+class _LazyFingerprint:
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+
+    def __str__(self) -> str:
+        return fingerprint(self.data)
+
+
+# Amostragem dos logs por consulta: 1 a cada N, ou só a primeira ocorrência
+# de cada fingerprint (o conjunto de vistos é limitado e zerado ao encher)
+class _QuerySampler:
+    __slots__ = ('every', 'first_only', 'counter', 'seen')
+
+    def __init__(self, every: int, first_only: bool) -> None:
+        self.every = max(1, every)
+        self.first_only = first_only
+        self.counter = 0
+        self.seen = set()
+
+    def should_log(self, query: bytes) -> bool:
+        if self.first_only:
+            fp = fingerprint(query)
+            if fp in self.seen:
+                return False
+            if len(self.seen) >= _MAX_SEEN_FINGERPRINTS:
+                self.seen.clear()
+            self.seen.add(fp)
+            return True
+        if self.every == 1:
+            return True
+        self.counter += 1
+        return self.counter % self.every == 1
+
+
+_query_sampler = _QuerySampler(LOG_QUERY_SAMPLE_EVERY, LOG_QUERY_FIRST_ONLY)
+_rewrite_sampler = _QuerySampler(LOG_QUERY_SAMPLE_EVERY, LOG_QUERY_FIRST_ONLY)
+
+
+def query_logging_enabled() -> bool:
+    return query_log.isEnabledFor(logging.INFO)
+
+
+def log_query(kind: str, query: bytes) -> None:
+    if not query_log.isEnabledFor(logging.INFO) or not _query_sampler.should_log(query):
+        return
+    query_log.info(
+        'Query original (%s): %s', kind, QueryText(query),
+        extra={'kind': kind, 'fingerprint': _LazyFingerprint(query)},
+    )
+
+
+def log_rewrite(kind: str, query: bytes, new_query: bytes) -> None:
+    if not rewrite_log.isEnabledFor(logging.INFO) or not _rewrite_sampler.should_log(query):
+        return
+    rewrite_log.info(
+        'Rewrite %s: %s -> %s', kind, QueryText(query), QueryText(new_query),
+        extra={'kind': kind, 'fingerprint': _LazyFingerprint(query)},
+    )
+
+
+# ErrorResponse do servidor (corpo da mensagem 'E'): métrica por SQLSTATE e
+# log, nos modos direto e pool
+def log_server_error(body: bytes) -> None:
+    try:
+        fields = parse_error_fields(body)
+        sev = fields.get('S', 'error')
+        msg = fields.get('M', '')
+        code = fields.get('C', '')
+        count_server_error(code)
+        server_log.warning('Erro do servidor [%s %s]: %s', sev, code, msg, extra={'sqlstate': code, 'severity': sev})
+    except Exception:
+        server_log.warning('Erro do servidor (E) recebido')
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'category': record.name.rpartition('.')[2],
+            'pid': record.process,
+            'msg': record.getMessage(),
+        }
+        fields = record.__dict__
+        for name in _JSON_FIELDS:
+            value = fields.get(name)
+            if value is not None:
+                entry[name] = value if isinstance(value, (int, float, str)) else str(value)
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # A formatação fica para a thread de escrita
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _category_levels() -> Dict[str, int]:
+    # Sem DEBUG_LOG_QUERIES os logs de consultas ficam desligados, a menos
+    # que LOG_LEVELS diga o contrário
+    levels = {'query': logging.INFO if DEBUG_LOG_QUERIES else logging.WARNING}
+    for item in LOG_LEVELS.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        category, _, level = item.partition('=')
+        category = category.strip().lower()
+        level = level.strip().lower()
+        if category not in CATEGORIES or level not in _LEVEL_NAMES:
+            raise RuntimeError(
+                f"Valor inválido em LOG_LEVELS: '{item}'. Use categoria=nível com categorias "
+                f"{', '.join(CATEGORIES)} e níveis {', '.join(_LEVEL_NAMES)}."
+            )
+        levels[category] = _LEVEL_NAMES[level]
+    return levels
+
+
+_handler: Optional[_DroppingQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_pid: Optional[int] = None
+
+
+def setup_logging() -> None:
+    # Idempotente por processo: depois de um fork o trabalhador chama de novo
+    # e ganha fila e thread próprias (a thread do pai não existe no filho)
+    global _handler, _listener, _setup_pid
+    if _setup_pid == os.getpid():
+        return
+    root = logging.getLogger('proxy')
+    if _handler is not None:
+        root.removeHandler(_handler)
+    log_queue: queue.Queue = queue.Queue(max(0, LOG_QUEUE_SIZE))
+    _handler = _DroppingQueueHandler(log_queue)
+    root.addHandler(_handler)
+    root.setLevel(_LEVEL_NAMES[LOG_LEVEL])
+    root.propagate = False
+    levels = _category_levels()
+    for category in CATEGORIES:
+        get_logger(category).setLevel(levels.get(category, logging.NOTSET))
+
+    stream = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream.setFormatter(_JsonFormatter())
+    else:
+        stream.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s[%(process)d]: %(message)s'))
+    _listener = logging.handlers.QueueListener(log_queue, stream)
+    _listener.start()
+    if _setup_pid is None:
+        atexit.register(shutdown_logging)
+    _setup_pid = os.getpid()
+
+
+def shutdown_logging() -> None:
+    # Esvazia a fila; chamar antes de os._exit
+    global _listener
+    if _listener is not None and _setup_pid == os.getpid():
+        _listener.stop()
+        _listener = None
+
+
+def logging_stats() -> Dict[str, int]:
+    return {'log_dropped': _handler.dropped if _handler is not None else 0}
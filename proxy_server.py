@@ -1,223 +1,556 @@
 import asyncio
-import struct
-from typing import Tuple
+import functools
+import re
+import socket
+import time
+from typing import Dict, Optional, Tuple
 
-from config import PG_HOST, PG_PORT, SSL_REQUEST_CODE, DEBUG_LOG_QUERIES
-from sql_rewriter import rewrite_schema_table
+from admission import (
+    IdleTracker,
+    admission_stats,
+    backend_connect_slots,
+    client_slots,
+    configure_socket,
+    idle_timeouts_enabled,
+    reap_idle_clients,
+    reject_client,
+    track_idle,
+    untrack_idle,
+)
+from auto_prepare import AUTO_PREPARE_ENABLED, AutoPrepare, ServerStatements, auto_prepare_stats
+from capture import CAPTURE_ENABLED, ConnectionCapture, capture_stats, start_capture, stop_capture
+from config import (
+    PG_HOST,
+    PG_PORT,
+    SSL_REQUEST_CODE,
+    SERVER_PASSTHROUGH,
+    SERVER_PASSTHROUGH_SNIFF_ERRORS,
+    POOL_MODE,
+    POOL_USERS_FILE,
+    POOL_SIZE,
+    POOL_MAX_BACKENDS,
+    METRICS_HOST,
+    METRICS_PORT,
+    REWRITE_MAX_MESSAGE_BYTES,
+    CLIENT_QUEUE_TIMEOUT,
+    BACKEND_QUEUE_TIMEOUT,
+    PG_REPLICAS,
+    REPLICA_HEALTH_INTERVAL,
+    QUERY_STATS_MAX_ENTRIES,
+    QUERY_STATS_DUMP_INTERVAL,
+    CLIENT_TLS_REQUIRED,
+    BACKEND_TLS_MODE,
+    WARM_BACKENDS,
+    WARM_BACKEND_MAX_AGE,
+)
+from metrics import (
+    CLIENT_TO_SERVER,
+    SERVER_TO_CLIENT,
+    backend_connect_seconds,
+    bytes_total,
+    messages_total,
+    start_metrics_server,
+)
+from pg_protocol import Framer, ProtocolError, unpack_uint32, write_coalesced
+from pooling import BackendPool, ReplicaSet, handle_pooled_client, load_userlist
+from proxy_logging import (
+    auth_log,
+    conn_log,
+    log_server_error,
+    logging_stats,
+    pool_log,
+    proxy_log,
+    rewrite_log,
+    server_log,
+    stats_log,
+)
+from query_rewrite import (
+    CLIENT_BUFFERED_TYPES,
+    PreparedStatements,
+    active_rules,
+    note_oversized_message,
+    parse_cache_stats,
+    rewrite_cache_stats,
+    rewrite_message,
+)
+from query_stats import (
+    COMPLETION_TYPES,
+    QUERY_STATS_ENABLED,
+    ConnectionQueryStats,
+    dump_query_stats,
+    queries_page,
+    query_stats_stats,
+)
+from result_cache import RESULT_CACHE_ENABLED, ConnectionCache, result_cache_stats, startup_scope
+from tls import (
+    BACKEND_TLS_ENABLED,
+    CLIENT_TLS_ENABLED,
+    TLS_REQUIRED_ERROR,
+    accept_client_tls,
+    has_buffered_data,
+    load_tls_contexts,
+    negotiate_backend_tls,
+    plaintext_refused,
+    remember_backend_session,
+    tls_stats,
+)
+from tracing import (
+    ConnectionTrace,
+    install_signal_handlers,
+    profile_page,
+    record_read,
+    trace_page,
+    trace_state,
+    tracing_stats,
+)
+from warm_backends import WarmBackends
 
 
-async def _forward_server_to_client(server_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
-    buffer = bytearray()
+READ_SIZE = 65536
+RAW_READ_SIZE = 262144
+
+# Mensagens do servidor que o laço precisa inteiras ('R', 'E', 'Z' e 'C'); as
+# demais seguem em streaming mesmo incompletas
+_SERVER_BUFFERED_TYPES = frozenset(b'REZC')
+# O cache de resultados, a promoção a statements preparados e as estatísticas
+# por consulta precisam enquadrar as respostas, então desligam o repasse direto
+_SERVER_PASSTHROUGH = (
+    SERVER_PASSTHROUGH and not RESULT_CACHE_ENABLED and not AUTO_PREPARE_ENABLED and not QUERY_STATS_ENABLED
+)
+
+
+def _log_server_message(msg_type: int, body: bytes) -> None:
+    if msg_type == 82:
+        if len(body) < 4:
+            return
+        auth_code = unpack_uint32(body, 0)[0]
+        if auth_code == 0:
+            auth_log.info('Auth: AuthenticationOk')
+        elif auth_code == 3:
+            auth_log.info('Auth: CleartextPassword requisitado')
+        elif auth_code == 5:
+            auth_log.info('Auth: MD5Password requisitado')
+        elif auth_code == 10:
+            auth_log.info('Auth: SASL/SCRAM requisitado')
+        elif auth_code == 11:
+            auth_log.info('Auth: SASLContinue')
+        elif auth_code == 12:
+            auth_log.info('Auth: SASLFinal')
+        else:
+            auth_log.info('Auth: código %s', auth_code)
+    else:
+        log_server_error(body)
+
+
+# Detecção aproximada de ErrorResponse no modo de repasse direto: campos
+# S (severidade), V opcional, C (SQLSTATE) e M (mensagem), na ordem enviada
+# pelo PostgreSQL. Erros divididos entre duas leituras não são registrados.
+# Como os bytes não são enquadrados, o padrão também pode aparecer dentro de
+# um DataRow: a detecção só gera log, nunca a métrica por SQLSTATE.
+_ERROR_SNIFF_RE = re.compile(
+    rb'E(?s:.{4})S([A-Z]+)\x00(?:V[A-Z]+\x00)?C([0-9A-Z]{5})\x00M([^\x00]*)\x00'
+)
+
+
+def _sniff_server_errors(data: bytes) -> None:
+    for m in _ERROR_SNIFF_RE.finditer(data):
+        sev = m.group(1).decode('ascii')
+        code = m.group(2).decode('ascii')
+        msg = m.group(3).decode('utf-8', errors='replace')
+        server_log.warning('Erro do servidor [%s %s]: %s', sev, code, msg, extra={'sqlstate': code, 'severity': sev})
+
+
+async def _relay_raw(
+    server_reader: asyncio.StreamReader,
+    client_writer: asyncio.StreamWriter,
+    high_water: int,
+    tracker: Optional[IdleTracker],
+    trace: Optional[ConnectionTrace] = None,
+) -> None:
+    # Depois da autenticação nada do servidor precisa ser reescrito: os bytes
+    # seguem em leituras grandes, sem enquadramento de mensagens.
+    while True:
+        data = await server_reader.read(RAW_READ_SIZE)
+        if not data:
+            return
+        timing = trace_state.spans or (trace is not None and trace.enabled)
+        if timing:
+            started = time.perf_counter()
+        bytes_total[SERVER_TO_CLIENT] += len(data)
+        if SERVER_PASSTHROUGH_SNIFF_ERRORS and b'E' in data:
+            _sniff_server_errors(data)
+        if tracker is not None:
+            tracker.ready_raw(data)
+        if timing:
+            framed = time.perf_counter()
+        drained = await write_coalesced(client_writer, data, high_water)
+        if timing:
+            record_read(
+                trace, SERVER_TO_CLIENT, len(data), framed - started, 0.0,
+                time.perf_counter() - framed - drained, drained,
+            )
+
+
+async def _forward_server_to_client(
+    server_reader: asyncio.StreamReader,
+    client_writer: asyncio.StreamWriter,
+    tracker: Optional[IdleTracker] = None,
+    cache: Optional[ConnectionCache] = None,
+    auto: Optional[AutoPrepare] = None,
+    query_stats: Optional[ConnectionQueryStats] = None,
+    trace: Optional[ConnectionTrace] = None,
+) -> None:
+    high_water = client_writer.transport.get_write_buffer_limits()[1]
+    framer = Framer()
+    authenticated = False
+    msg_counts = messages_total[SERVER_TO_CLIENT]
     try:
         while True:
-            data = await server_reader.read(65536)
+            data = await server_reader.read(READ_SIZE)
             if not data:
                 break
-            buffer.extend(data)
+            # Spans e trace: uma flag por leitura quando desligados
+            tracing = trace is not None and trace.enabled
+            timing = tracing or trace_state.spans
+            if timing:
+                started = time.perf_counter()
+            bytes_total[SERVER_TO_CLIENT] += len(data)
+            data = framer.feed(data)
+            if data is None:
+                continue
 
-            while True:
-                if len(buffer) < 5:
-                    break
-                msg_type = chr(buffer[0])
-                msg_len = struct.unpack('!I', buffer[1:5])[0]
-                total_len = 1 + msg_len
-                if len(buffer) < total_len:
-                    break
-                body = bytes(buffer[5:total_len])
-
-                if msg_type == 'R' and len(body) >= 4:
-                    auth_code = struct.unpack('!I', body[:4])[0]
-                    if auth_code == 0:
-                        print('Auth: AuthenticationOk')
-                    elif auth_code == 3:
-                        print('Auth: CleartextPassword requisitado')
-                    elif auth_code == 5:
-                        print('Auth: MD5Password requisitado')
-                    elif auth_code == 10:
-                        print('Auth: SASL/SCRAM requisitado')
-                    elif auth_code == 11:
-                        print('Auth: SASLContinue')
-                    elif auth_code == 12:
-                        print('Auth: SASLFinal')
+            n = len(data)
+            pos = framer.take_skip(n)
+            run_start = 0
+            need = 5
+            chunks = []
+            passthrough = False
+            while n - pos >= 5:
+                end = pos + 1 + unpack_uint32(data, pos + 1)[0]
+                msg_type = data[pos]
+                capturing = cache is not None and cache.capture is not None
+                if end > n:
+                    if (msg_type in _SERVER_BUFFERED_TYPES or capturing) and end - pos <= REWRITE_MAX_MESSAGE_BYTES:
+                        need = end - pos
                     else:
-                        print(f'Auth: código {auth_code}')
-                elif msg_type == 'E':
-                    try:
-                        parts = body.split(b'\x00')
-                        fields = {}
-                        for part in parts:
-                            if not part:
-                                continue
-                            k = chr(part[0])
-                            v = part[1:].decode('utf-8', errors='replace')
-                            fields[k] = v
-                        sev = fields.get('S', 'error')
-                        msg = fields.get('M', '')
-                        code = fields.get('C', '')
-                        print(f'Erro do servidor [{sev} {code}]: {msg}')
-                    except Exception:
-                        print('Erro do servidor (E) recebido')
-
-                try:
-                    client_writer.write(buffer[:total_len])
-                    await client_writer.drain()
-                except (ConnectionResetError, BrokenPipeError):
+                        msg_counts[msg_type] += 1
+                        if tracing:
+                            trace.message(SERVER_TO_CLIENT, msg_type, end - pos)
+                        if capturing:
+                            cache.capture = None
+                        framer.stream(end - n)
+                        pos = n
+                    break
+                msg_counts[msg_type] += 1
+                if tracing:
+                    trace.message(SERVER_TO_CLIENT, msg_type, end - pos)
+                if auto is not None and auto.expected and not auto.server_message(data, pos, end):
+                    # Resposta a mensagens acrescentadas pelo proxy
+                    if pos > run_start:
+                        chunks.append(memoryview(data)[run_start:pos])
+                    run_start = pos = end
+                    continue
+                if query_stats is not None and query_stats.pending and msg_type in COMPLETION_TYPES:
+                    query_stats.server_message(data, pos, end)
+                if capturing:
+                    cache.server_message(data, pos, end)
+                # 'R' (autenticação) e 'E' (erro) são apenas registrados
+                if msg_type == 82 or msg_type == 69:
+                    _log_server_message(msg_type, data[pos + 5:end])
+                    if msg_type == 82 and end - pos >= 9 and unpack_uint32(data, pos + 5)[0] == 0:
+                        authenticated = True
+                elif msg_type == 90:
+                    if tracker is not None:
+                        tracker.ready(data[pos + 5])
+                    if cache is not None:
+                        cache.ready(data[pos + 5])
+                    if authenticated and _SERVER_PASSTHROUGH:
+                        # Primeiro ReadyForQuery após AuthenticationOk: o
+                        # restante da leitura já segue sem enquadramento
+                        passthrough = True
+                        pos = n
+                        break
+                pos = end
+
+            if query_stats is not None:
+                query_stats.advance(pos)
+            if pos < n:
+                framer.keep(data, pos, need)
+            if run_start:
+                if pos > run_start:
+                    chunks.append(memoryview(data)[run_start:pos])
+                if not chunks:
+                    continue
+                data = chunks
+            elif pos < n:
+                if pos == 0:
+                    continue
+                data = data[:pos]
+            try:
+                if timing:
+                    framed = time.perf_counter()
+                drained = await write_coalesced(client_writer, data, high_water)
+                if timing:
+                    record_read(
+                        trace, SERVER_TO_CLIENT, n, framed - started, 0.0, time.perf_counter() - framed - drained, drained
+                    )
+                if passthrough:
+                    await _relay_raw(server_reader, client_writer, high_water, tracker, trace)
                     return
-                del buffer[:total_len]
+            except (ConnectionResetError, BrokenPipeError):
+                return
     except Exception as e:
-        print(f'Erro no fluxo servidor->cliente: {e}')
+        conn_log.error('Erro no fluxo servidor->cliente: %s', e)
 
 
-async def _forward_client_to_server(client_reader: asyncio.StreamReader, server_writer: asyncio.StreamWriter, client_writer: asyncio.StreamWriter) -> None:
-    buffer = bytearray()
+async def _forward_client_to_server(
+    client_reader: asyncio.StreamReader,
+    server_writer: asyncio.StreamWriter,
+    client_writer: asyncio.StreamWriter,
+    tracker: Optional[IdleTracker] = None,
+    cache: Optional[ConnectionCache] = None,
+    auto: Optional[AutoPrepare] = None,
+    query_stats: Optional[ConnectionQueryStats] = None,
+    capture: Optional[ConnectionCapture] = None,
+    trace: Optional[ConnectionTrace] = None,
+) -> None:
+    high_water = server_writer.transport.get_write_buffer_limits()[1]
+    framer = Framer()
+    statements = PreparedStatements()
     startup_phase = True
+    msg_counts = messages_total[CLIENT_TO_SERVER]
     try:
         while True:
-            chunk = await client_reader.read(65536)
-            if not chunk:
+            data = await client_reader.read(READ_SIZE)
+            if not data:
                 break
-            buffer.extend(chunk)
+            tracing = trace is not None and trace.enabled
+            timing = tracing or trace_state.spans
+            if timing:
+                started = time.perf_counter()
+                rewriting = 0.0
+            bytes_total[CLIENT_TO_SERVER] += len(data)
+            if tracker is not None:
+                tracker.idle_since = 0.0
+            data = framer.feed(data)
+            if data is None:
+                continue
 
+            n = len(data)
+            view = memoryview(data)
+            pos = framer.take_skip(n)
+            if capture is not None and pos:
+                capture.continuation(data, pos)
+            run_start = 0
+            need = 5
+            chunks = []
             while True:
                 if startup_phase:
-                    if len(buffer) < 8:
+                    if n - pos < 8:
+                        need = 8
                         break
-                    msg_len = struct.unpack('!I', buffer[0:4])[0]
-                    if len(buffer) < msg_len:
+                    msg_len = unpack_uint32(data, pos)[0]
+                    if msg_len < 8:
+                        raise ValueError(f'mensagem de inicialização com tamanho inválido ({msg_len})')
+                    end = pos + msg_len
+                    if end > n:
+                        need = end - pos
                         break
-                    code = struct.unpack('!I', buffer[4:8])[0]
-                    if msg_len == 8 and code == SSL_REQUEST_CODE:
-                        client_writer.write(b'N')
+                    code = unpack_uint32(data, pos + 4)[0]
+                    if end - pos == 8 and code == SSL_REQUEST_CODE:
+                        if pos > run_start:
+                            chunks.append(view[run_start:pos])
+                        run_start = end
+                        if CLIENT_TLS_ENABLED and client_writer.get_extra_info('ssl_object') is None:
+                            if end != n or has_buffered_data(client_reader):
+                                raise ProtocolError('dados do cliente enviados junto com o SSLRequest')
+                            await accept_client_tls(client_writer)
+                        else:
+                            client_writer.write(b'N')
+                            await client_writer.drain()
+                    elif plaintext_refused(client_writer, code):
+                        client_writer.write(TLS_REQUIRED_ERROR)
                         await client_writer.drain()
-                        del buffer[:8]
-                        continue
-                    else:
-                        try:
-                            server_writer.write(buffer[:msg_len])
-                            await server_writer.drain()
-                        except (ConnectionResetError, BrokenPipeError):
-                            return
-                        del buffer[:msg_len]
-                        if code != SSL_REQUEST_CODE:
-                            startup_phase = False
-                        continue
-
-                if len(buffer) < 5:
+                        return
+                    elif code != SSL_REQUEST_CODE:
+                        startup_phase = False
+                        if cache is not None:
+                            cache.scope = startup_scope(data[pos + 8:end])
+                        if capture is not None:
+                            capture.startup(data, pos, end)
+                    pos = end
+                    continue
+
+                if n - pos < 5:
+                    need = 5
                     break
-                msg_type = chr(buffer[0])
-                msg_len = struct.unpack('!I', buffer[1:5])[0]
-                total_len = 1 + msg_len
-                if len(buffer) < total_len:
+                end = pos + 1 + unpack_uint32(data, pos + 1)[0]
+                msg_type = data[pos]
+                if end > n:
+                    if msg_type in CLIENT_BUFFERED_TYPES and end - pos <= REWRITE_MAX_MESSAGE_BYTES:
+                        need = end - pos
+                    else:
+                        msg_counts[msg_type] += 1
+                        if tracing:
+                            trace.message(CLIENT_TO_SERVER, msg_type, end - pos)
+                        if tracker is not None:
+                            tracker.request(msg_type)
+                        if auto is not None:
+                            auto.client_message(msg_type)
+                        if query_stats is not None:
+                            query_stats.client_message(msg_type, data, pos, end)
+                        if cache is not None and (msg_type == 81 or msg_type == 80 or msg_type == 66):
+                            cache.oversized(msg_type, data, pos, n)
+                        if capture is not None:
+                            capture.message(data, pos, n)
+                        note_oversized_message(msg_type, end - pos)
+                        framer.stream(end - n)
+                        pos = n
                     break
-                body = bytes(buffer[5:total_len])
-
-                if msg_type == 'Q':
+                msg_counts[msg_type] += 1
+                if tracing:
+                    trace.message(CLIENT_TO_SERVER, msg_type, end - pos)
+                if capture is not None:
+                    capture.message(data, pos, end)
+                if cache is not None and (msg_type == 81 or msg_type == 80 or msg_type == 66):
+                    cache.client_message(msg_type, data, pos, end)
+                    if msg_type == 81 and tracker.pending == 0 and not tracker.unsynced and tracker.status == 73:
+                        reply = cache.lookup(data, pos, end)
+                        if reply is not None:
+                            # Resposta do cache: a consulta não vai ao servidor
+                            if pos > run_start:
+                                chunks.append(view[run_start:pos])
+                            run_start = pos = end
+                            client_writer.write(reply)
+                            tracker.ready(73)
+                            continue
+                if tracker is not None:
+                    tracker.request(msg_type)
+                if auto is not None and msg_type != 81:
+                    auto.client_message(msg_type)
+                if query_stats is not None and msg_type != 81 and msg_type != 80:
+                    query_stats.client_message(msg_type, data, pos, end)
+                if msg_type == 81 or msg_type == 80:
+                    if timing:
+                        rewrite_started = time.perf_counter()
                     try:
-                        nul_idx = body.find(b'\x00')
-                        if nul_idx == -1:
-                            try:
-                                server_writer.write(buffer[:total_len])
-                                await server_writer.drain()
-                            except (ConnectionResetError, BrokenPipeError):
-                                return
-                        else:
-                            query_bytes = body[:nul_idx]
-                            tail = body[nul_idx + 1:]
-                            query = query_bytes.decode('utf-8', errors='replace')
-                            if DEBUG_LOG_QUERIES:
-                                print(f'Query original (Q): {query}')
-                            new_query = rewrite_schema_table(query)
-                            if new_query != query:
-                                print(f'Rewrite Q: {query} -> {new_query}')
-                            new_query_bytes = new_query.encode('utf-8')
-                            new_body = new_query_bytes + b'\x00' + tail
-                            new_len = 4 + len(new_body)
-                            try:
-                                server_writer.write(bytes([ord('Q')]) + struct.pack('!I', new_len) + new_body)
-                                await server_writer.drain()
-                            except (ConnectionResetError, BrokenPipeError):
-                                return
+                        new_msg = rewrite_message(msg_type, data, pos, end, statements)
                     except Exception as e:
-                        print(f'Erro reescrevendo Q: {e}')
-                        try:
-                            server_writer.write(buffer[:total_len])
-                            await server_writer.drain()
-                        except (ConnectionResetError, BrokenPipeError):
-                            return
-                elif msg_type == 'P':
-                    try:
-                        nul1 = body.find(b'\x00')
-                        if nul1 == -1:
-                            try:
-                                server_writer.write(buffer[:total_len])
-                                await server_writer.drain()
-                            except (ConnectionResetError, BrokenPipeError):
-                                return
+                        rewrite_log.error('Erro reescrevendo %s: %s', chr(msg_type), e)
+                        new_msg = None
+                    if timing:
+                        rewriting += time.perf_counter() - rewrite_started
+                    if query_stats is not None:
+                        if msg_type == 81:
+                            query_stats.simple_query(data[pos + 5:end - 1], new_msg is not None)
                         else:
-                            name = body[:nul1 + 1]
-                            rest = body[nul1 + 1:]
-                            nul2 = rest.find(b'\x00')
-                            if nul2 == -1:
-                                try:
-                                    server_writer.write(buffer[:total_len])
-                                    await server_writer.drain()
-                                except (ConnectionResetError, BrokenPipeError):
-                                    return
-                            else:
-                                query_bytes = rest[:nul2]
-                                tail = rest[nul2 + 1:]
-                                query = query_bytes.decode('utf-8', errors='replace')
-                                if DEBUG_LOG_QUERIES:
-                                    print(f'Query original (P): {query}')
-                                new_query = rewrite_schema_table(query)
-                                if new_query != query:
-                                    print(f'Rewrite P: {query} -> {new_query}')
-                                new_query_bytes = new_query.encode('utf-8')
-                                new_body = name + new_query_bytes + b'\x00' + tail
-                                new_len = 4 + len(new_body)
-                                try:
-                                    server_writer.write(bytes([ord('P')]) + struct.pack('!I', new_len) + new_body)
-                                    await server_writer.drain()
-                                except (ConnectionResetError, BrokenPipeError):
-                                    return
-                    except Exception as e:
-                        print(f'Erro reescrevendo P: {e}')
-                        try:
-                            server_writer.write(buffer[:total_len])
-                            await server_writer.drain()
-                        except (ConnectionResetError, BrokenPipeError):
-                            return
-                else:
-                    try:
-                        server_writer.write(buffer[:total_len])
-                        await server_writer.drain()
-                    except (ConnectionResetError, BrokenPipeError):
-                        return
+                            query_stats.parse(data, pos, end, new_msg is not None)
+                    if auto is not None and msg_type == 81:
+                        promoted = auto.simple_query(new_msg[5:-1] if new_msg is not None else data[pos + 5:end - 1])
+                        if promoted is not None:
+                            new_msg = promoted
+                    if new_msg is not None:
+                        if pos > run_start:
+                            chunks.append(view[run_start:pos])
+                        chunks.append(new_msg)
+                        run_start = end
+                elif msg_type == 67:
+                    statements.close(data, pos, end)
+                pos = end
 
-                del buffer[:total_len]
+            if capture is not None:
+                capture.flush()
+            if pos < n:
+                framer.keep(data, pos, need)
+            if run_start == 0 and pos == n:
+                out = data
+            else:
+                if pos > run_start:
+                    chunks.append(view[run_start:pos])
+                if not chunks:
+                    continue
+                out = chunks
+            try:
+                if timing:
+                    framed = time.perf_counter()
+                drained = await write_coalesced(server_writer, out, high_water)
+            except (ConnectionResetError, BrokenPipeError):
+                return
+            if timing:
+                record_read(
+                    trace, CLIENT_TO_SERVER, n, framed - started - rewriting, rewriting,
+                    time.perf_counter() - framed - drained, drained,
+                )
     except Exception as e:
-        print(f'Erro no fluxo cliente->servidor: {e}')
+        conn_log.error('Erro no fluxo cliente->servidor: %s', e)
 
 
 async def handle_client(client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
     peer = client_writer.get_extra_info('peername')
-    print(f'Cliente conectado: {peer}')
+    conn_log.info('Cliente conectado: %s', peer, extra={'peer': str(peer)})
+    server_writer = None
+    tracker = None
+    capture = None
+    trace = ConnectionTrace(peer)
     try:
-        server_reader, server_writer = await asyncio.open_connection(PG_HOST, PG_PORT)
-        print(f'Conectado ao PostgreSQL real em {PG_HOST}:{PG_PORT}')
+        warm = _warm_backends.take() if _warm_backends is not None else None
+        if warm is not None:
+            server_reader, server_writer = warm
+        else:
+            if not await backend_connect_slots.acquire(BACKEND_QUEUE_TIMEOUT):
+                conn_log.warning(
+                    'Tempo esgotado aguardando vaga para conectar ao PostgreSQL (cliente %s)', peer,
+                    extra={'peer': str(peer)},
+                )
+                await reject_client(
+                    client_reader, client_writer, '53300', 'tempo esgotado aguardando conexão com o PostgreSQL no proxy'
+                )
+                return
+            try:
+                started = time.perf_counter()
+                server_reader, server_writer = await asyncio.open_connection(PG_HOST, PG_PORT)
+            finally:
+                backend_connect_slots.release()
+            backend_connect_seconds.observe(time.perf_counter() - started)
+            configure_socket(server_writer)
+            await negotiate_backend_tls(server_reader, server_writer, PG_HOST)
+        conn_log.info('Conectado ao PostgreSQL real em %s:%s', PG_HOST, PG_PORT)
 
-        t1 = asyncio.create_task(_forward_client_to_server(client_reader, server_writer, client_writer))
-        t2 = asyncio.create_task(_forward_server_to_client(server_reader, client_writer))
+        tracker = track_idle(client_writer)
+        cache = None
+        if RESULT_CACHE_ENABLED:
+            # O cache usa o estado da conexão (pendências e status) do tracker
+            cache = ConnectionCache()
+            if tracker is None:
+                tracker = IdleTracker(client_writer)
+        auto = AutoPrepare(ServerStatements()) if AUTO_PREPARE_ENABLED else None
+        query_stats = ConnectionQueryStats() if QUERY_STATS_ENABLED else None
+        capture = ConnectionCapture() if CAPTURE_ENABLED else None
+        t1 = asyncio.create_task(
+            _forward_client_to_server(
+                client_reader, server_writer, client_writer, tracker, cache, auto, query_stats, capture, trace
+            )
+        )
+        t2 = asyncio.create_task(
+            _forward_server_to_client(server_reader, client_writer, tracker, cache, auto, query_stats, trace)
+        )
         done, pending = await asyncio.wait({t1, t2}, return_when=asyncio.FIRST_COMPLETED)
         for task in pending:
             task.cancel()
             try:
                 await task
-            except Exception:
+            except (asyncio.CancelledError, Exception):
                 pass
     except Exception as e:
-        print(f'Erro ao lidar com cliente {peer}: {e}')
+        conn_log.error('Erro ao lidar com cliente %s: %s', peer, e, extra={'peer': str(peer)})
     finally:
+        untrack_idle(tracker)
+        trace.close()
+        if capture is not None:
+            capture.close()
+        if server_writer is not None:
+            remember_backend_session(server_writer, PG_HOST)
+            server_writer.close()
         try:
             client_writer.close()
             await client_writer.drain()
@@ -225,11 +558,135 @@ async def handle_client(client_reader: asyncio.StreamReader, client_writer: asyn
             pass
 
 
-async def run_server(host: str, port: int) -> Tuple[str, int]:
-    server = await asyncio.start_server(handle_client, host, port)
+_connection_stats: Dict[str, int] = {'clients_active': 0, 'clients_total': 0}
+_pool: Optional[BackendPool] = None
+_replicas: Optional[ReplicaSet] = None
+_warm_backends: Optional[WarmBackends] = None
+
+
+def server_stats() -> Dict[str, int]:
+    stats = dict(_connection_stats)
+    for name, value in rewrite_cache_stats().items():
+        stats[f'rewrite_cache_{name}'] = value
+    for name, value in parse_cache_stats().items():
+        stats[f'parse_cache_{name}'] = value
+    if RESULT_CACHE_ENABLED:
+        for name, value in result_cache_stats().items():
+            stats[f'result_cache_{name}'] = value
+    if AUTO_PREPARE_ENABLED:
+        for name, value in auto_prepare_stats().items():
+            stats[f'auto_prepare_{name}'] = value
+    if QUERY_STATS_ENABLED:
+        for name, value in query_stats_stats().items():
+            stats[f'query_stats_{name}'] = value
+    if CAPTURE_ENABLED:
+        for name, value in capture_stats().items():
+            stats[f'capture_{name}'] = value
+    if CLIENT_TLS_ENABLED or BACKEND_TLS_ENABLED:
+        for name, value in tls_stats().items():
+            stats[f'tls_{name}'] = value
+    if _warm_backends is not None:
+        for name, value in _warm_backends.stats().items():
+            stats[f'warm_backends_{name}'] = value
+    for name, value in tracing_stats().items():
+        stats[f'trace_{name}'] = value
+    stats.update(logging_stats())
+    stats.update(admission_stats())
+    if _pool is not None:
+        for name, value in _pool.stats().items():
+            stats[f'pool_{name}'] = value
+    if _replicas is not None:
+        for name, value in _replicas.stats().items():
+            stats[f'replica_{name}'] = value
+    return stats
+
+
+async def _track_client(handler, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter) -> None:
+    configure_socket(client_writer)
+    if not await client_slots.acquire(CLIENT_QUEUE_TIMEOUT):
+        peer = client_writer.get_extra_info('peername')
+        conn_log.warning('Limite de clientes atingido, recusando %s', peer, extra={'peer': str(peer)})
+        await reject_client(client_reader, client_writer, '53300', 'limite de conexões do proxy atingido')
+        return
+    _connection_stats['clients_active'] += 1
+    _connection_stats['clients_total'] += 1
+    try:
+        await handler(client_reader, client_writer)
+    finally:
+        _connection_stats['clients_active'] -= 1
+        client_slots.release()
+
+
+async def run_server(
+    host: str, port: int, reuse_port: bool = False, sock: Optional[socket.socket] = None, worker_index: int = 0
+) -> Tuple[str, int]:
+    global _pool, _replicas, _warm_backends
+    load_tls_contexts()
+    if POOL_MODE == 'off':
+        handler = handle_client
+        if WARM_BACKENDS > 0:
+            _warm_backends = WarmBackends(PG_HOST, PG_PORT, WARM_BACKENDS, WARM_BACKEND_MAX_AGE)
+    else:
+        users = load_userlist(POOL_USERS_FILE)
+        _pool = BackendPool(PG_HOST, PG_PORT, users, POOL_SIZE, POOL_MAX_BACKENDS)
+        if PG_REPLICAS:
+            _replicas = ReplicaSet([
+                BackendPool(host, port, users, POOL_SIZE, POOL_MAX_BACKENDS) for host, port in PG_REPLICAS
+            ])
+        handler = functools.partial(handle_pooled_client, _pool, POOL_MODE, replicas=_replicas)
+    handler = functools.partial(_track_client, handler)
+    if sock is not None:
+        server = await asyncio.start_server(handler, sock=sock)
+    else:
+        server = await asyncio.start_server(handler, host, port, reuse_port=reuse_port or None)
     addrs = ', '.join(str(sock.getsockname()) for sock in server.sockets or [])
-    print(f'Proxy rodando em {addrs} (ssl preferido será negado com N)')
-    async with server:
-        await server.serve_forever()
+    if CLIENT_TLS_ENABLED:
+        proxy_log.info(
+            'Proxy rodando em %s (TLS com clientes %s)', addrs, 'exigido' if CLIENT_TLS_REQUIRED else 'aceito'
+        )
+    else:
+        proxy_log.info('Proxy rodando em %s (ssl preferido será negado com N)', addrs)
+    if BACKEND_TLS_ENABLED:
+        proxy_log.info('TLS com o PostgreSQL: %s', BACKEND_TLS_MODE)
+    if POOL_MODE != 'off':
+        pool_log.info(
+            'Pool de conexões ativo (modo %s, %s por usuário/banco, máximo %s)', POOL_MODE, POOL_SIZE, POOL_MAX_BACKENDS
+        )
+    rewrite_log.info('Regras de reescrita: %s', ', '.join(rule.name for rule in active_rules.rules) or 'nenhuma')
+    if _replicas is not None:
+        pool_log.info('Réplicas de leitura: %s', ', '.join(f'{host}:{port}' for host, port in PG_REPLICAS))
+    metrics_server = None
+    if METRICS_PORT > 0:
+        metrics_port = METRICS_PORT + worker_index
+        routes = {b'/trace': trace_page, b'/profile': profile_page}
+        if QUERY_STATS_ENABLED:
+            routes[b'/queries'] = queries_page
+        metrics_server = await start_metrics_server(METRICS_HOST, metrics_port, server_stats, routes)
+        proxy_log.info('Métricas em http://%s:%s/metrics', METRICS_HOST, metrics_port)
+    background = []
+    if idle_timeouts_enabled():
+        background.append(asyncio.create_task(reap_idle_clients()))
+    if _replicas is not None:
+        background.append(asyncio.create_task(_replicas.check_health(max(1, REPLICA_HEALTH_INTERVAL))))
+    if _warm_backends is not None:
+        conn_log.info('Mantendo %s conexões com o PostgreSQL prontas para novos clientes', WARM_BACKENDS)
+        background.append(asyncio.create_task(_warm_backends.run()))
+    start_capture()
+    install_signal_handlers()
+    if QUERY_STATS_ENABLED:
+        stats_log.info('Estatísticas por consulta ativas (até %s consultas)', QUERY_STATS_MAX_ENTRIES)
+        if QUERY_STATS_DUMP_INTERVAL > 0:
+            background.append(asyncio.create_task(dump_query_stats(QUERY_STATS_DUMP_INTERVAL)))
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        for task in background:
+            task.cancel()
+        if metrics_server is not None:
+            metrics_server.close()
+        if _warm_backends is not None:
+            _warm_backends.close()
+        stop_capture()
 
 
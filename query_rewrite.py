@@ -0,0 +1,196 @@
+import re
+import time
+from typing import Dict, Optional, Tuple
+
+from config import (
+    PARSE_CACHE_MAX_BYTES,
+    PARSE_CACHE_MAX_ENTRIES,
+    PARSE_CACHE_MAX_STATEMENTS,
+    REWRITE_CACHE_MAX_BYTES,
+    REWRITE_CACHE_MAX_ENTRIES,
+    REWRITE_MAX_MESSAGE_BYTES,
+    REWRITE_RULES_FILE,
+)
+from lru_cache import LRUCache
+from metrics import rewrite_rule_hits_total, rewrite_seconds, rewrites_total
+from pg_protocol import pack_uint32
+from proxy_logging import log_query, log_rewrite, query_logging_enabled, rewrite_log
+from rewrite_rules import load_rules
+
+
+_MISSING = object()
+
+# Regras em uso pelo proxy, com os acertos expostos nas métricas
+active_rules = load_rules(REWRITE_RULES_FILE, rewrite_rule_hits_total)
+
+# Cache compartilhado por todas as conexões: o mesmo texto de consulta chega
+# milhares de vezes e a reescrita é determinística.
+_rewrite_cache = LRUCache(REWRITE_CACHE_MAX_ENTRIES, REWRITE_CACHE_MAX_BYTES)
+
+# Cache de Parse: corpo do 'P' original -> (mensagem 'P' reescrita já montada,
+# ou None se não muda; consulta original e reescrita, para o log). Drivers
+# reenviam o mesmo Parse a cada conexão ou a cada Execute, e aí basta uma
+# consulta ao dict.
+ParseEntry = Tuple[Optional[bytes], Optional[Tuple[bytes, bytes]]]
+_parse_cache = LRUCache(PARSE_CACHE_MAX_ENTRIES, PARSE_CACHE_MAX_BYTES)
+
+# Mensagens do cliente que precisam estar inteiras (reescrita de 'Q'/'P' e
+# acompanhamento de Close); as demais seguem em streaming mesmo incompletas
+CLIENT_BUFFERED_TYPES = frozenset(b'QPC')
+
+_DEALLOCATE_RE = re.compile(
+    rb'\s*(?:discard\s+all|deallocate\s+(?:prepare\s+)?(?:(all)\b|"((?:[^"]|"")*)"|([^\s;]+)))',
+    re.IGNORECASE,
+)
+
+
+def _rewrite_query_cached(query_bytes: bytes) -> Optional[bytes]:
+    # Retorna None quando a consulta não precisa de reescrita
+    if not active_rules.needs_rewrite(query_bytes):
+        return None
+    cached = _rewrite_cache.get(query_bytes, _MISSING)
+    if cached is not _MISSING:
+        return cached
+    started = time.perf_counter()
+    new_query_bytes = active_rules.rewrite(query_bytes)
+    rewrite_seconds.observe(time.perf_counter() - started)
+    if new_query_bytes is query_bytes:
+        _rewrite_cache.put(query_bytes, None, len(query_bytes))
+        return None
+    _rewrite_cache.put(query_bytes, new_query_bytes, len(query_bytes) + len(new_query_bytes))
+    return new_query_bytes
+
+
+def rewrite_cache_stats() -> Dict[str, int]:
+    return _rewrite_cache.stats()
+
+
+def parse_cache_stats() -> Dict[str, int]:
+    return _parse_cache.stats()
+
+
+def _rewrite_parse(data: bytes, start: int, end: int) -> ParseEntry:
+    body_start = start + 5
+    nul1 = data.find(b'\x00', body_start, end)
+    if nul1 == -1:
+        return None, None
+    nul2 = data.find(b'\x00', nul1 + 1, end)
+    if nul2 == -1:
+        return None, None
+    query_bytes = data[nul1 + 1:nul2]
+    new_query_bytes = _rewrite_query_cached(query_bytes)
+    if new_query_bytes is None:
+        return None, None
+    name = data[body_start:nul1 + 1]
+    tail = data[nul2:end]
+    new_msg = b'P' + pack_uint32(4 + len(name) + len(new_query_bytes) + len(tail)) + name + new_query_bytes + tail
+    return new_msg, (query_bytes, new_query_bytes)
+
+
+def _parse_entry(body: bytes, data: bytes, start: int, end: int) -> ParseEntry:
+    entry = _parse_cache.get(body)
+    if entry is None:
+        entry = _rewrite_parse(data, start, end)
+        size = len(body)
+        if entry[0] is not None:
+            size += len(entry[0]) + len(entry[1][1])
+        _parse_cache.put(body, entry, size)
+    return entry
+
+
+def _finish_parse(entry: ParseEntry, data: bytes, start: int, end: int) -> Optional[bytes]:
+    rewrite = entry[1]
+    if rewrite is not None:
+        log_query('P', rewrite[0])
+        log_rewrite('P', rewrite[0], rewrite[1])
+        rewrites_total[80] += 1
+    elif query_logging_enabled():
+        parts = data[start + 5:end].split(b'\x00', 2)
+        if len(parts) == 3:
+            log_query('P', parts[1])
+    return entry[0]
+
+
+# Statements preparados de uma conexão do cliente: nome -> (corpo do 'P',
+# entrada do cache). Um Parse repetido com o mesmo nome e o mesmo corpo (o
+# statement sem nome é reenviado a cada Execute por vários drivers) não
+# precisa nem do hash do corpo. Close, DEALLOCATE e DISCARD ALL removem os
+# nomes; acima de PARSE_CACHE_MAX_STATEMENTS os mais antigos são esquecidos.
+class PreparedStatements:
+    __slots__ = ('statements',)
+
+    def __init__(self) -> None:
+        self.statements: Dict[bytes, Tuple[bytes, ParseEntry]] = {}
+
+    def parse(self, data: bytes, start: int, end: int) -> Optional[bytes]:
+        body_start = start + 5
+        nul = data.find(b'\x00', body_start, end)
+        if nul == -1:
+            return None
+        name = data[body_start:nul]
+        body = data[body_start:end]
+        statements = self.statements
+        known = statements.get(name)
+        if known is not None and known[0] == body:
+            entry = known[1]
+        else:
+            entry = _parse_entry(body, data, start, end)
+            if PARSE_CACHE_MAX_STATEMENTS > 0:
+                if known is None and len(statements) >= PARSE_CACHE_MAX_STATEMENTS:
+                    del statements[next(iter(statements))]
+                statements[name] = (body, entry)
+        return _finish_parse(entry, data, start, end)
+
+    def close(self, data: bytes, start: int, end: int) -> None:
+        # Close ('C'): 'S' + nome fecha um statement; 'P' + nome fecha um portal
+        if end - start > 6 and data[start + 5] == 83:
+            self.statements.pop(data[start + 6:end - 1], None)
+
+    def simple_query(self, query_bytes: bytes) -> None:
+        m = _DEALLOCATE_RE.match(query_bytes)
+        if m is None:
+            return
+        quoted, plain = m.group(2), m.group(3)
+        if quoted is not None:
+            self.statements.pop(quoted.replace(b'""', b'"'), None)
+        elif plain is not None:
+            self.statements.pop(plain.lower(), None)
+        else:
+            self.statements.clear()
+
+
+def note_oversized_message(msg_type: int, size: int) -> None:
+    if msg_type == 81 or msg_type == 80:
+        rewrite_log.warning(
+            'Mensagem %s de %s bytes acima de REWRITE_MAX_MESSAGE_BYTES: repassada sem reescrita', chr(msg_type), size
+        )
+
+
+def rewrite_message(
+    msg_type: int, data: bytes, start: int, end: int, statements: Optional[PreparedStatements] = None
+) -> Optional[bytes]:
+    # Retorna a mensagem 'Q'/'P' reescrita completa, ou None para encaminhar a
+    # original sem alterações
+    if end - start > REWRITE_MAX_MESSAGE_BYTES:
+        note_oversized_message(msg_type, end - start)
+        return None
+    body_start = start + 5
+    if msg_type == 81:
+        nul = data.find(b'\x00', body_start, end)
+        if nul == -1:
+            return None
+        query_bytes = data[body_start:nul]
+        log_query('Q', query_bytes)
+        if statements is not None and statements.statements:
+            statements.simple_query(query_bytes)
+        new_query_bytes = _rewrite_query_cached(query_bytes)
+        if new_query_bytes is None:
+            return None
+        log_rewrite('Q', query_bytes, new_query_bytes)
+        rewrites_total[81] += 1
+        tail = data[nul:end]
+        return b'Q' + pack_uint32(4 + len(new_query_bytes) + len(tail)) + new_query_bytes + tail
+
+    if statements is not None:
+        return statements.parse(data, start, end)
+    return _finish_parse(_parse_entry(data[body_start:end], data, start, end), data, start, end)
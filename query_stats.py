@@ -0,0 +1,289 @@
+import asyncio
+import bisect
+import json
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from config import QUERY_STATS_MAX_ENTRIES, QUERY_STATS_TOP
+from lru_cache import LRUCache
+from proxy_logging import stats_log
+from sql_rewriter import normalize_query, normalized_fingerprint
+
+# Estatísticas por consulta, no estilo do pg_stat_statements: cada consulta é
+# agrupada pelo fingerprint do texto normalizado (o mesmo dos logs) e acumula
+# execuções, erros, quantas foram reescritas, tempo do envio ao fim da
+# resposta (com histograma), linhas (do CommandComplete) e bytes recebidos do
+# servidor. Numa 'Q' o tempo vai até o ReadyForQuery; no protocolo estendido
+# cada Execute termina no seu CommandComplete (ou erro). Os bytes de cada
+# resposta vêm das posições no fluxo do servidor, sem olhar cada DataRow.
+
+QUERY_STATS_ENABLED = QUERY_STATS_MAX_ENTRIES > 0
+
+_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Texto normalizado guardado por consulta
+_MAX_QUERY_TEXT = 2048
+# Statements e portais nomeados lembrados por conexão
+_MAX_STATEMENTS = 1024
+_MAX_PORTALS = 64
+_ROW_COMMANDS = frozenset((b'SELECT', b'INSERT', b'UPDATE', b'DELETE', b'MERGE', b'COPY', b'FETCH', b'MOVE'))
+
+# Mensagens do servidor que interessam: CommandComplete, ErrorResponse,
+# EmptyQueryResponse, PortalSuspended e ReadyForQuery
+COMPLETION_TYPES = frozenset(b'CEIsZ')
+
+# (fingerprint, texto normalizado)
+QueryInfo = Tuple[str, bytes]
+# Consulta de uma requisição e se foi reescrita
+TrackedQuery = Tuple[Optional[QueryInfo], bool]
+
+_infos = LRUCache(4096, 8 * 1024 * 1024)
+
+
+def query_info(query: bytes) -> QueryInfo:
+    info = _infos.get(query)
+    if info is None:
+        normalized = normalize_query(query)
+        info = (normalized_fingerprint(normalized), normalized[:_MAX_QUERY_TEXT])
+        _infos.put(query, info, len(query) + len(info[1]))
+    return info
+
+
+def _command_rows(tag: bytes) -> int:
+    # "SELECT 5", "INSERT 0 3", "UPDATE 2"...
+    parts = tag.split()
+    if parts and parts[0] in _ROW_COMMANDS and parts[-1].isdigit():
+        return int(parts[-1])
+    return 0
+
+
+class QueryEntry:
+    __slots__ = ('fingerprint', 'query', 'calls', 'errors', 'rewritten', 'seconds', 'max_seconds', 'rows', 'bytes', 'buckets')
+
+    def __init__(self, fingerprint: str, query: bytes) -> None:
+        self.fingerprint = fingerprint
+        self.query = query
+        self.calls = 0
+        self.errors = 0
+        self.rewritten = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(_BOUNDS) + 1)
+
+    def add(self, seconds: float, rows: int, nbytes: int, error: bool, rewritten: bool) -> None:
+        self.calls += 1
+        self.errors += error
+        self.rewritten += rewritten
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        self.rows += rows
+        self.bytes += nbytes
+        self.buckets[bisect.bisect_left(_BOUNDS, seconds)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        # Limite superior do bucket que contém o percentil (o máximo no último)
+        target = fraction * self.calls
+        cumulative = 0
+        for bound, count in zip(_BOUNDS, self.buckets):
+            cumulative += count
+            if cumulative >= target:
+                return min(bound, self.max_seconds)
+        return self.max_seconds
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            'fingerprint': self.fingerprint,
+            'query': self.query.decode('utf-8', errors='replace'),
+            'calls': self.calls,
+            'errors': self.errors,
+            'rewritten': self.rewritten,
+            'total_ms': round(self.seconds * 1000, 3),
+            'mean_ms': round(self.seconds * 1000 / self.calls, 3) if self.calls else 0.0,
+            'max_ms': round(self.max_seconds * 1000, 3),
+            'p50_ms': round(self.percentile(0.5) * 1000, 3),
+            'p95_ms': round(self.percentile(0.95) * 1000, 3),
+            'p99_ms': round(self.percentile(0.99) * 1000, 3),
+            'rows': self.rows,
+            'bytes': self.bytes,
+        }
+
+
+_entries: Dict[str, QueryEntry] = {}
+_stats = {'evictions': 0}
+
+_SORT_KEYS = {
+    'total': lambda entry: entry.seconds,
+    'calls': lambda entry: entry.calls,
+    'mean': lambda entry: entry.seconds / entry.calls if entry.calls else 0.0,
+    'max': lambda entry: entry.max_seconds,
+    'p95': lambda entry: entry.percentile(0.95),
+    'rows': lambda entry: entry.rows,
+    'bytes': lambda entry: entry.bytes,
+    'errors': lambda entry: entry.errors,
+}
+
+
+def _evict() -> None:
+    # Como o pg_stat_statements: ao encher, saem de uma vez as 5% menos executadas
+    victims = sorted(_entries.values(), key=lambda entry: entry.calls)[:max(1, len(_entries) // 20)]
+    for entry in victims:
+        del _entries[entry.fingerprint]
+    _stats['evictions'] += len(victims)
+
+
+def _record(info: QueryInfo, rewritten: bool, seconds: float, rows: int, nbytes: int, error: bool) -> None:
+    entry = _entries.get(info[0])
+    if entry is None:
+        if len(_entries) >= QUERY_STATS_MAX_ENTRIES:
+            _evict()
+        entry = _entries[info[0]] = QueryEntry(info[0], info[1])
+    entry.add(seconds, rows, nbytes, error, rewritten)
+
+
+# Requisição aguardando ReadyForQuery: uma 'Q' (uma consulta, registrada no
+# ReadyForQuery) ou o lote até um Sync (uma consulta por Execute)
+class _Request:
+    __slots__ = ('simple', 'queries', 'started', 'rows', 'error')
+
+    def __init__(self, simple: bool, queries: List[TrackedQuery]) -> None:
+        self.simple = simple
+        self.queries = queries
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.error = False
+
+
+# Acompanhamento numa conexão do cliente. `received` conta os bytes do
+# servidor já processados pelo laço e `mark` é onde terminou a última
+# resposta registrada.
+class ConnectionQueryStats:
+    __slots__ = ('pending', 'statements', 'portals', 'batch', 'received', 'mark')
+
+    def __init__(self) -> None:
+        self.pending: Deque[_Request] = deque()
+        self.statements: Dict[bytes, TrackedQuery] = {}
+        self.portals: Dict[bytes, TrackedQuery] = {}
+        self.batch: List[TrackedQuery] = []
+        self.received = 0
+        self.mark = 0
+
+    def _push(self, request: _Request) -> None:
+        if not self.pending:
+            self.mark = self.received
+        self.pending.append(request)
+
+    def simple_query(self, query: bytes, rewritten: bool) -> None:
+        self._push(_Request(True, [(query_info(query), rewritten)]))
+
+    def parse(self, data: bytes, start: int, end: int, rewritten: bool) -> None:
+        name_end = data.find(b'\x00', start + 5, end)
+        query_end = data.find(b'\x00', name_end + 1, end)
+        if name_end == -1 or query_end == -1:
+            return
+        statements = self.statements
+        name = data[start + 5:name_end]
+        if name not in statements and len(statements) >= _MAX_STATEMENTS:
+            del statements[next(iter(statements))]
+        statements[name] = (query_info(data[name_end + 1:query_end]), rewritten)
+
+    def client_message(self, msg_type: int, data: bytes, start: int, end: int) -> None:
+        # Bind, Execute, Sync, FunctionCall e 'Q' repassada em streaming
+        end = min(end, len(data))
+        if msg_type == 66:
+            portal_end = data.find(b'\x00', start + 5, end)
+            name_end = data.find(b'\x00', portal_end + 1, end)
+            if portal_end == -1 or name_end == -1:
+                return
+            portals = self.portals
+            if len(portals) >= _MAX_PORTALS:
+                portals.clear()
+            portals[data[start + 5:portal_end]] = self.statements.get(data[portal_end + 1:name_end], (None, False))
+        elif msg_type == 69:
+            portal_end = data.find(b'\x00', start + 5, end)
+            self.batch.append(self.portals.get(data[start + 5:portal_end], (None, False)))
+        elif msg_type == 83:
+            self._push(_Request(False, self.batch))
+            self.batch = []
+        elif msg_type == 81 or msg_type == 70:
+            self._push(_Request(True, []))
+
+    def advance(self, processed: int) -> None:
+        # Fim de uma leitura do servidor: `processed` bytes consumidos
+        self.received += processed
+
+    def server_message(self, data: bytes, start: int, end: int) -> None:
+        # Chamado para as mensagens de COMPLETION_TYPES enquanto há pendências
+        request = self.pending[0]
+        msg_type = data[start]
+        if msg_type == 90:
+            self.pending.popleft()
+            if request.simple and request.queries:
+                self._finish(request, end)
+            else:
+                self.mark = self.received + end
+            return
+        if msg_type == 69:
+            request.error = True
+        elif msg_type == 67:
+            request.rows += _command_rows(data[start + 5:end - 1])
+        if not request.simple and request.queries:
+            self._finish(request, end)
+
+    def _finish(self, request: _Request, end: int) -> None:
+        now = time.perf_counter()
+        position = self.received + end
+        info, rewritten = request.queries.pop(0)
+        if info is not None:
+            _record(info, rewritten, now - request.started, request.rows, position - self.mark, request.error)
+        self.mark = position
+        request.started = now
+        request.rows = 0
+        request.error = False
+
+
+def top_queries(sort: str = 'total', limit: int = QUERY_STATS_TOP) -> List[QueryEntry]:
+    return sorted(_entries.values(), key=_SORT_KEYS[sort], reverse=True)[:max(0, limit)]
+
+
+def queries_page(query_string: bytes) -> Tuple[bytes, bytes]:
+    # GET /queries?sort=total|calls|mean|max|p95|rows|bytes|errors&limit=N
+    params = parse_qs(query_string.decode('ascii', errors='replace'))
+    sort = params.get('sort', ['total'])[0]
+    if sort not in _SORT_KEYS:
+        sort = 'total'
+    try:
+        limit = int(params.get('limit', [QUERY_STATS_TOP])[0])
+    except ValueError:
+        limit = QUERY_STATS_TOP
+    body = json.dumps(
+        {'sort': sort, 'entries': len(_entries), 'queries': [entry.as_dict() for entry in top_queries(sort, limit)]},
+        ensure_ascii=False,
+    )
+    return b'application/json; charset=utf-8', body.encode('utf-8')
+
+
+async def dump_query_stats(interval: float) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        top = top_queries('total', QUERY_STATS_TOP)
+        if not top:
+            continue
+        stats_log.info('Consultas com maior tempo total (%s de %s acompanhadas):', len(top), len(_entries))
+        for entry in top:
+            stats_log.info(
+                '%s calls=%s total=%.1fms mean=%.2fms p95=%.2fms max=%.2fms rows=%s bytes=%s erros=%s reescritas=%s: %s',
+                entry.fingerprint, entry.calls, entry.seconds * 1000, entry.seconds * 1000 / entry.calls,
+                entry.percentile(0.95) * 1000, entry.max_seconds * 1000, entry.rows, entry.bytes, entry.errors,
+                entry.rewritten, entry.query.decode('utf-8', errors='replace'),
+                extra={'fingerprint': entry.fingerprint},
+            )
+
+
+def query_stats_stats() -> Dict[str, int]:
+    stats = dict(_stats)
+    stats['entries'] = len(_entries)
+    return stats
@@ -0,0 +1,308 @@
+import re
+import time
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from config import (
+    RESULT_CACHE_FINGERPRINTS,
+    RESULT_CACHE_MAX_BYTES,
+    RESULT_CACHE_MAX_ENTRIES,
+    RESULT_CACHE_MAX_ENTRY_BYTES,
+    RESULT_CACHE_TABLES,
+    RESULT_CACHE_TTL,
+)
+from lru_cache import LRUCache
+from pg_protocol import message, parse_startup_params
+from sql_rewriter import fingerprint, is_read_only_query
+
+# Cache de resultados de consultas simples ('Q') de leitura, opcional. Só
+# entram consultas da allowlist (por tabela ou por fingerprint) feitas fora de
+# transação e sem outras requisições pendentes na conexão; a resposta inteira
+# do servidor (RowDescription, DataRow e CommandComplete) é guardada com TTL e
+# devolvida ao cliente sem passar pelo backend. Escritas vistas pelo proxy
+# (em qualquer conexão deste processo) invalidam as entradas das tabelas
+# afetadas quando são enviadas e de novo quando a transação que as fez
+# termina; escritas feitas por fora só aparecem depois do TTL.
+
+RESULT_CACHE_ENABLED = RESULT_CACHE_TTL > 0 and bool(RESULT_CACHE_TABLES.strip() or RESULT_CACHE_FINGERPRINTS.strip())
+
+_READY_IDLE = message(b'Z', b'I')
+# Mensagens que podem fazer parte de uma resposta guardada ('T', 'D', 'C')
+_CACHEABLE_TYPES = frozenset(b'TDC')
+
+# Identificador SQL: entre aspas ou sem aspas (schemas numéricos incluídos)
+_IDENT = rb'(?:"(?:[^"]|"")+"|[A-Za-z0-9_\x80-\xff][A-Za-z0-9_$\x80-\xff]*)'
+_QUALIFIED = _IDENT + rb'(?:\s*\.\s*' + _IDENT + rb')*'
+_IDENT_RE = re.compile(_IDENT)
+# Tabelas lidas: depois de FROM/JOIN e nas listas "FROM a, b"
+_FROM_RE = re.compile(rb'\b(?:from|join)\s+(?:only\s+|lateral\s+)?(' + _QUALIFIED + rb')', re.IGNORECASE)
+_FROM_LIST_RE = re.compile(
+    rb'(?:\s+(?:as\s+)?' + _IDENT + rb')?\s*,\s*(?:only\s+|lateral\s+)?(' + _QUALIFIED + rb')', re.IGNORECASE
+)
+# Tabelas escritas
+_WRITE_TARGET_RE = re.compile(
+    rb'\b(?:insert\s+into|update|delete\s+from|merge\s+into|copy|truncate(?:\s+table)?'
+    rb'|(?:alter|drop)\s+table(?:\s+if\s+exists)?)\s+(?:only\s+)?(' + _QUALIFIED + rb')',
+    re.IGNORECASE,
+)
+
+CacheKey = Tuple[Hashable, bytes]
+
+
+def _table_name(qualified: bytes) -> Tuple[bytes, bytes]:
+    # (nome completo, nome da tabela) normalizados como o PostgreSQL faz:
+    # sem aspas vira minúsculas, entre aspas fica como está
+    parts = []
+    for m in _IDENT_RE.finditer(qualified):
+        ident = m.group(0)
+        if ident.startswith(b'"'):
+            parts.append(ident[1:-1].replace(b'""', b'"'))
+        else:
+            parts.append(ident.lower())
+    return b'.'.join(parts), parts[-1]
+
+
+def _parse_allowlist(raw: str) -> Tuple[Set[bytes], Set[bytes]]:
+    qualified: Set[bytes] = set()
+    bare: Set[bytes] = set()
+    for item in raw.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        full, base = _table_name(item.encode('utf-8'))
+        (qualified if full != base else bare).add(full)
+    return qualified, bare
+
+
+_allowed_qualified, _allowed_bare = _parse_allowlist(RESULT_CACHE_TABLES)
+_allowed_fingerprints = {item.strip().lower() for item in RESULT_CACHE_FINGERPRINTS.split(',') if item.strip()}
+
+_cache = LRUCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRY_BYTES)
+# Consulta -> tabelas lidas (None = não cacheável); evita repetir a análise
+_decisions = LRUCache(8192, 4 * 1024 * 1024)
+# Tabela -> chaves guardadas que dependem dela, e contador de invalidações
+# (uma captura iniciada antes de uma escrita não é guardada)
+_by_table: Dict[bytes, Set[CacheKey]] = {}
+_generations: Dict[bytes, int] = {}
+# Contador de esvaziamentos completos (escritas cujas tabelas não se conhecem)
+_flushes = [0]
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'expired': 0, 'invalidations': 0}
+
+
+def _read_tables(query: bytes) -> List[Tuple[bytes, bytes]]:
+    tables = []
+    for m in _FROM_RE.finditer(query):
+        tables.append(_table_name(m.group(1)))
+        pos = m.end()
+        while True:
+            more = _FROM_LIST_RE.match(query, pos)
+            if more is None:
+                break
+            tables.append(_table_name(more.group(1)))
+            pos = more.end()
+    return tables
+
+
+def _analyze(query: bytes) -> Optional[Tuple[bytes, ...]]:
+    # Tabelas (nome sem schema) de uma consulta cacheável, ou None
+    if not is_read_only_query(query):
+        return None
+    tables = _read_tables(query)
+    if _allowed_fingerprints and fingerprint(query) in _allowed_fingerprints:
+        return tuple({base for _, base in tables})
+    if not tables:
+        return None
+    for full, base in tables:
+        if full not in _allowed_qualified and base not in _allowed_bare:
+            return None
+    return tuple({base for _, base in tables})
+
+
+def _cacheable(query: bytes) -> Optional[Tuple[bytes, ...]]:
+    decision = _decisions.get(query, False)
+    if decision is False:
+        decision = _analyze(query)
+        _decisions.put(query, decision, len(query))
+    return decision
+
+
+def startup_scope(body: bytes) -> Hashable:
+    # Resultados só são compartilhados entre sessões com o mesmo usuário,
+    # banco e parâmetros de inicialização
+    params = parse_startup_params(body)
+    user = params.get('user', '')
+    extra = tuple(sorted((k, v) for k, v in params.items() if k not in ('user', 'database', 'application_name')))
+    return user, params.get('database') or user, extra
+
+
+# Resposta sendo capturada para uma consulta que não estava no cache
+class ResultCapture:
+    __slots__ = ('key', 'tables', 'generations', 'chunks', 'size')
+
+    def __init__(self, key: CacheKey, tables: Tuple[bytes, ...]) -> None:
+        self.key = key
+        self.tables = tables
+        self.generations = (_flushes[0],) + tuple(_generations.get(table, 0) for table in tables)
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+    def add(self, data: bytes, start: int, end: int) -> bool:
+        # False quando a resposta não pode ser guardada (erro, aviso, COPY,
+        # grande demais)
+        if data[start] not in _CACHEABLE_TYPES:
+            return False
+        self.size += end - start
+        if self.size > RESULT_CACHE_MAX_ENTRY_BYTES:
+            return False
+        self.chunks.append(data[start:end])
+        return True
+
+    def finish(self, status: int) -> None:
+        if status != 73 or not self.chunks:
+            return
+        if self.generations != (_flushes[0],) + tuple(_generations.get(table, 0) for table in self.tables):
+            return
+        reply = b''.join(self.chunks) + _READY_IDLE
+        _cache.put(self.key, (time.monotonic() + RESULT_CACHE_TTL, reply), len(reply) + len(self.key[1]))
+        for table in self.tables:
+            keys = _by_table.setdefault(table, set())
+            keys.add(self.key)
+            if len(keys) > 2 * RESULT_CACHE_MAX_ENTRIES:
+                # Esquece chaves já removidas do cache (expiradas ou despejadas)
+                _by_table[table] = {key for key in keys if key in _cache}
+        _stats['stores'] += 1
+
+
+def _lookup(scope: Hashable, query: bytes) -> Tuple[Optional[bytes], Optional[ResultCapture]]:
+    # (resposta pronta, None) num acerto; (None, captura) numa falha
+    # cacheável; (None, None) se a consulta não entra no cache
+    key = (scope, query)
+    entry = _cache.get(key)
+    if entry is not None:
+        if entry[0] > time.monotonic():
+            _stats['hits'] += 1
+            return entry[1], None
+        _cache.pop(key)
+        _stats['expired'] += 1
+    tables = _cacheable(query)
+    if tables is None:
+        return None, None
+    _stats['misses'] += 1
+    return None, ResultCapture(key, tables)
+
+
+# Estado do cache numa conexão de cliente: escopo das chaves, a resposta
+# sendo capturada, as tabelas escritas por cada statement preparado e as
+# escritas da transação em andamento (None = tabelas desconhecidas). Só se
+# consulta o cache com a conexão ociosa fora de transação, então a próxima
+# ReadyForQuery encerra a captura.
+class ConnectionCache:
+    __slots__ = ('scope', 'capture', 'statements', 'written')
+
+    def __init__(self, scope: Optional[Hashable] = None) -> None:
+        self.scope = scope
+        self.capture: Optional[ResultCapture] = None
+        self.statements: Dict[bytes, Optional[Tuple[bytes, ...]]] = {}
+        self.written: Optional[Set[bytes]] = set()
+
+    def lookup(self, data: bytes, start: int, end: int) -> Optional[bytes]:
+        if self.scope is None:
+            return None
+        reply, self.capture = _lookup(self.scope, data[start + 5:end - 1])
+        return reply
+
+    def server_message(self, data: bytes, start: int, end: int) -> None:
+        # Chamado para cada mensagem do servidor enquanto há captura
+        capture = self.capture
+        if data[start] == 90:
+            self.capture = None
+            capture.finish(data[start + 5])
+        elif not capture.add(data, start, end):
+            self.capture = None
+
+    def client_message(self, msg_type: int, data: bytes, start: int, end: int) -> None:
+        # 'Q' e 'P' com escrita invalidam as tabelas escritas; o 'Bind' de um
+        # statement preparado que escreve invalida de novo a cada execução
+        if msg_type == 81:
+            tables = _write_tables(data[start + 5:end - 1])
+        elif msg_type == 80:
+            name_end = data.find(b'\x00', start + 5, end)
+            query_end = data.find(b'\x00', name_end + 1, end)
+            if name_end == -1 or query_end == -1:
+                return
+            name = data[start + 5:name_end]
+            tables = _write_tables(data[name_end + 1:query_end])
+            if tables == ():
+                self.statements.pop(name, None)
+                return
+            self.statements[name] = tables
+        else:
+            portal_end = data.find(b'\x00', start + 5, end)
+            name_end = data.find(b'\x00', portal_end + 1, end)
+            if portal_end == -1 or name_end == -1:
+                return
+            tables = self.statements.get(data[portal_end + 1:name_end], ())
+        if tables != ():
+            self._wrote(tables)
+
+    def oversized(self, msg_type: int, data: bytes, start: int, end: int) -> None:
+        # 'Q', 'P' ou 'B' grande demais para ser lida inteira (só os bytes até
+        # `end` chegaram): sem o texto, qualquer tabela pode ter sido escrita
+        if msg_type == 66:
+            portal_end = data.find(b'\x00', start + 5, end)
+            name_end = data.find(b'\x00', portal_end + 1, end)
+            if portal_end != -1 and name_end != -1:
+                tables = self.statements.get(data[portal_end + 1:name_end], ())
+                if tables != ():
+                    self._wrote(tables)
+                return
+        elif msg_type == 80:
+            name_end = data.find(b'\x00', start + 5, end)
+            if name_end != -1:
+                self.statements[data[start + 5:name_end]] = None
+        self._wrote(None)
+
+    def ready(self, status: int) -> None:
+        # ReadyForQuery do servidor: fora de transação, as escritas feitas
+        # nela já estão visíveis para as outras conexões, então as entradas
+        # guardadas enquanto ela estava aberta são invalidadas de novo
+        if status == 73 and (self.written is None or self.written):
+            _invalidate(self.written)
+            self.written = set()
+
+    def _wrote(self, tables: Optional[Tuple[bytes, ...]]) -> None:
+        _invalidate(tables)
+        if tables is None:
+            self.written = None
+        elif self.written is not None:
+            self.written.update(tables)
+
+
+def _write_tables(query: bytes) -> Tuple[bytes, ...]:
+    # Tabelas (nome sem schema) escritas pela consulta; vazio para leituras
+    if is_read_only_query(query):
+        return ()
+    return tuple({_table_name(m.group(1))[1] for m in _WRITE_TARGET_RE.finditer(query)})
+
+
+def _invalidate(tables: Optional[Iterable[bytes]]) -> None:
+    # None esvazia o cache inteiro
+    if tables is None:
+        _flushes[0] += 1
+        _stats['invalidations'] += len(_cache)
+        _cache.clear()
+        _by_table.clear()
+        return
+    for table in tables:
+        _generations[table] = _generations.get(table, 0) + 1
+        keys = _by_table.pop(table, None)
+        if keys:
+            for key in keys:
+                if _cache.pop(key) is not None:
+                    _stats['invalidations'] += 1
+
+
+def result_cache_stats() -> Dict[str, int]:
+    stats = dict(_stats)
+    stats['entries'] = len(_cache)
+    stats['bytes'] = _cache.current_bytes
+    return stats
@@ -0,0 +1,263 @@
+import argparse
+import gzip
+import heapq
+import os
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from rewrite_rules import RewriteRules, load_rules
+
+# Reescrita em lote de consultas tiradas de arquivos ou da entrada padrão,
+# para validar mudanças no reescritor antes de colocá-las no proxy. As
+# consultas são lidas em streaming, agrupadas em blocos e reescritas num pool
+# de processos; só alguns blocos ficam em andamento de cada vez, então a
+# memória não depende do tamanho da entrada. Saída: diffs das consultas
+# alteradas (--diff), contagens, acertos por regra, as consultas mais lentas
+# e, com --baseline-rules, as consultas cuja reescrita muda em relação a um
+# conjunto de regras de base (nesse caso o código de saída é 1 se houver
+# alguma, servindo de teste de regressão). Só depende do motor de regras, não
+# da configuração do proxy.
+#
+#   python rewrite_batch.py consultas.sql --diff
+#   python rewrite_batch.py --format pglog postgresql-*.log.gz --rules novas.json --baseline-rules atuais.json
+#   zcat proxy.log.gz | python rewrite_batch.py --format proxylog -
+
+# Linhas com consulta no log do PostgreSQL (log_statement ou
+# log_min_duration_statement, e o STATEMENT que acompanha um erro); as linhas
+# seguintes começadas por tab continuam a consulta
+_PGLOG_RE = re.compile(rb'(?:LOG:\s+(?:duration: [0-9.]+ ms\s+)?(?:statement|execute [^:]+)|STATEMENT):\s+(.*)')
+# Consultas no log do próprio proxy (categoria query)
+_PROXYLOG_RE = re.compile(rb'Query original \([A-Z]\): (.*)')
+# Trecho da consulta mostrado na lista das mais lentas
+_SLOW_QUERY_CHARS = 160
+
+# (arquivo, linha) de uma consulta
+Location = Tuple[int, int]
+
+
+def _open_input(path: str) -> BinaryIO:
+    if path == '-':
+        return sys.stdin.buffer
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_queries(stream: BinaryIO, input_format: str) -> Iterator[Tuple[int, bytes]]:
+    # (linha, consulta) de cada consulta da entrada
+    if input_format == 'lines':
+        for number, line in enumerate(stream, 1):
+            query = line.rstrip(b'\r\n')
+            if query.strip():
+                yield number, query
+        return
+    if input_format == 'proxylog':
+        for number, line in enumerate(stream, 1):
+            m = _PROXYLOG_RE.search(line)
+            if m is not None:
+                yield number, m.group(1).rstrip(b'\r\n')
+        return
+    current: Optional[List[bytes]] = None
+    start = 0
+    for number, line in enumerate(stream, 1):
+        if current is not None and line.startswith(b'\t'):
+            current.append(line[1:].rstrip(b'\r\n'))
+            continue
+        if current is not None:
+            yield start, b'\n'.join(current)
+            current = None
+        m = _PGLOG_RE.search(line)
+        if m is not None:
+            current = [m.group(1).rstrip(b'\r\n')]
+            start = number
+    if current is not None:
+        yield start, b'\n'.join(current)
+
+
+class ChunkResult:
+    __slots__ = ('count', 'bytes', 'changed', 'divergent', 'slowest', 'seconds', 'hits')
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.bytes = 0
+        # (local, original, reescrita)
+        self.changed: List[Tuple[Location, bytes, bytes]] = []
+        # (local, original, regras, base)
+        self.divergent: List[Tuple[Location, bytes, bytes, bytes]] = []
+        # (segundos, local, consulta truncada)
+        self.slowest: List[Tuple[float, Location, bytes]] = []
+        self.seconds = 0.0
+        self.hits: Dict[str, int] = {}
+
+
+_rules: Optional[RewriteRules] = None
+_baseline: Optional[RewriteRules] = None
+
+
+def _init_worker(rules_file: str, baseline_file: Optional[str]) -> None:
+    global _rules, _baseline
+    _rules = load_rules(rules_file)
+    _baseline = load_rules(baseline_file) if baseline_file is not None else None
+
+
+def _rewrite_chunk(chunk: List[Tuple[Location, bytes]], top: int) -> ChunkResult:
+    rules = _rules
+    baseline = _baseline
+    before = dict(rules.hits)
+    result = ChunkResult()
+    result.count = len(chunk)
+    slowest = result.slowest
+    perf_counter = time.perf_counter
+    for location, query in chunk:
+        result.bytes += len(query)
+        started = perf_counter()
+        rewritten = rules.rewrite(query)
+        elapsed = perf_counter() - started
+        result.seconds += elapsed
+        if rewritten is not query:
+            result.changed.append((location, query, rewritten))
+        if baseline is not None:
+            expected = baseline.rewrite(query)
+            if expected != rewritten:
+                result.divergent.append((location, query, rewritten, expected))
+        if len(slowest) < top:
+            heapq.heappush(slowest, (elapsed, location, query[:_SLOW_QUERY_CHARS]))
+        elif top and elapsed > slowest[0][0]:
+            heapq.heapreplace(slowest, (elapsed, location, query[:_SLOW_QUERY_CHARS]))
+    result.hits = {name: hits - before.get(name, 0) for name, hits in rules.hits.items() if hits != before.get(name, 0)}
+    return result
+
+
+def _chunks(paths: List[str], input_format: str, size: int) -> Iterator[List[Tuple[Location, bytes]]]:
+    chunk: List[Tuple[Location, bytes]] = []
+    for index, path in enumerate(paths):
+        stream = _open_input(path)
+        try:
+            for number, query in read_queries(stream, input_format):
+                chunk.append(((index, number), query))
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+        finally:
+            if stream is not sys.stdin.buffer:
+                stream.close()
+    if chunk:
+        yield chunk
+
+
+# Totais e saída incremental dos diffs, na ordem da entrada
+class BatchReport:
+    def __init__(self, paths: List[str], out: BinaryIO, diffs: bool, top: int) -> None:
+        self.paths = paths
+        self.out = out
+        self.diffs = diffs
+        self.top = top
+        self.count = 0
+        self.changed = 0
+        self.divergent = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.hits: Dict[str, int] = {}
+        self.slowest: List[Tuple[float, Location, bytes]] = []
+
+    def _where(self, location: Location) -> bytes:
+        return f'{self.paths[location[0]]}:{location[1]}'.encode('utf-8', errors='replace')
+
+    def add(self, result: ChunkResult) -> None:
+        self.count += result.count
+        self.bytes += result.bytes
+        self.changed += len(result.changed)
+        self.divergent += len(result.divergent)
+        self.seconds += result.seconds
+        for name, hits in result.hits.items():
+            self.hits[name] = self.hits.get(name, 0) + hits
+        for item in result.slowest:
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, item)
+            elif item[0] > self.slowest[0][0]:
+                heapq.heapreplace(self.slowest, item)
+        out = self.out
+        if self.diffs:
+            for location, query, rewritten in result.changed:
+                out.write(
+                    b'@@ ' + self._where(location) + b'\n- ' + _indent(query) + b'\n+ ' + _indent(rewritten) + b'\n'
+                )
+        for location, query, rewritten, expected in result.divergent:
+            out.write(
+                b'!! ' + self._where(location) + b' diverge da base\n  original: ' + _indent(query)
+                + b'\n  regras:   ' + _indent(rewritten) + b'\n  base:     ' + _indent(expected) + b'\n'
+            )
+
+    def summary(self, elapsed: float, jobs: int, baseline: bool) -> str:
+        lines = [
+            f'consultas: {self.count} ({self.bytes / 1e6:,.1f} MB) em {elapsed:.2f}s '
+            f'({self.count / elapsed:,.0f}/s, {jobs} processos)',
+            f'alteradas: {self.changed}, inalteradas: {self.count - self.changed}',
+            'regras: ' + (', '.join(f'{name}={hits}' for name, hits in sorted(self.hits.items())) or 'nenhum acerto'),
+        ]
+        if baseline:
+            lines.append(f'divergências com as regras de base: {self.divergent}')
+        if self.count:
+            lines.append(f'tempo médio do reescritor: {self.seconds / self.count * 1e6:.2f}us por consulta')
+        if self.slowest:
+            lines.append('mais lentas:')
+            for seconds, location, query in sorted(self.slowest, reverse=True):
+                text = query.decode('utf-8', errors='replace').replace('\n', ' ')
+                lines.append(f'  {seconds * 1e6:9.1f}us  {self._where(location).decode()}  {text}')
+        return '\n'.join(lines)
+
+
+def _indent(query: bytes) -> bytes:
+    return query.replace(b'\n', b'\n  ')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Reescrita em lote de consultas SQL (validação do reescritor)')
+    parser.add_argument('inputs', nargs='+', help='arquivos de entrada (.gz aceito) ou - para a entrada padrão')
+    parser.add_argument(
+        '--format', choices=['lines', 'pglog', 'proxylog'], default='lines',
+        help='uma consulta por linha, log do PostgreSQL ou log de consultas do proxy',
+    )
+    parser.add_argument('--rules', default='', help='arquivo de regras (como REWRITE_RULES_FILE; padrão: só as embutidas)')
+    parser.add_argument('--jobs', type=int, default=0, help='processos (padrão: um por CPU; 1 roda sem pool)')
+    parser.add_argument('--chunk', type=int, default=2000, help='consultas por bloco enviado a um processo')
+    parser.add_argument('--diff', action='store_true', help='escreve na saída padrão o diff das consultas alteradas')
+    parser.add_argument(
+        '--baseline-rules', nargs='?', const='', metavar='ARQUIVO',
+        help='compara com as regras deste arquivo (sem arquivo: só as embutidas); código de saída 1 se houver diferença',
+    )
+    parser.add_argument('--top', type=int, default=10, help='quantas consultas mais lentas mostrar')
+    args = parser.parse_args()
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+    # Valida as regras antes de subir os processos
+    _init_worker(args.rules, args.baseline_rules)
+    out = sys.stdout.buffer
+    report = BatchReport(args.inputs, out, args.diff, max(0, args.top))
+    chunks = _chunks(args.inputs, args.format, max(1, args.chunk))
+    started = time.perf_counter()
+    if jobs == 1:
+        for chunk in chunks:
+            report.add(_rewrite_chunk(chunk, report.top))
+    else:
+        with ProcessPoolExecutor(jobs, initializer=_init_worker, initargs=(args.rules, args.baseline_rules)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_rewrite_chunk, chunk, report.top))
+                if len(pending) >= jobs * 2:
+                    report.add(pending.popleft().result())
+            while pending:
+                report.add(pending.popleft().result())
+    out.flush()
+    baseline = args.baseline_rules is not None
+    print(report.summary(max(time.perf_counter() - started, 1e-9), jobs, baseline), file=sys.stderr)
+    if baseline and report.divergent:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,442 @@
+import json
+import re
+from itertools import groupby
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+
+# Motor de regras de reescrita. Cada regra é um padrão de tokens SQL com
+# marcadores ({nome}, {nome:word}, {nome:int}, {nome=palavra}) e um modelo de
+# substituição.
+# Na carga, cada padrão vira uma expressão regular que respeita os limites
+# dos tokens, e todas elas são unidas numa única expressão de varredura junto
+# com os trechos que nunca são alterados (literais, comentários,
+# dollar-quotes e identificadores entre aspas). A reescrita é uma passada de
+# `finditer` sobre essa expressão; um pré-filtro com as âncoras de todas as
+# regras descarta numa só busca as consultas que nenhuma regra pode casar.
+# Cada grupo de alternativas só é tentado nas posições cujo caractere pode
+# começá-las. Padrões que começam por um marcador de identificador
+# (`{a}.codlig`) podem começar em qualquer palavra, o que deixa a varredura
+# bem mais lenta: eles só são tentados no início de um identificador seguido
+# do primeiro caractere do token seguinte, e só entram na expressão quando a
+# sua palavra fixa mais longa aparece na consulta (há uma expressão compilada
+# para cada combinação dessas palavras).
+# O módulo não depende da configuração do proxy: as regras em uso pelo proxy
+# são carregadas em query_rewrite.py, e rewrite_batch.py carrega as suas.
+#
+# Semântica dos padrões:
+# - entre os tokens só pode haver espaço em branco (comentários impedem o
+#   casamento) e a substituição sai exatamente como escrita no modelo;
+# - palavras casam ignorando maiúsculas; identificadores entre aspas também,
+#   e podem conter marcadores ("{schema:int}.{tabela:word}");
+# - {nome} casa um identificador (com ou sem aspas), {nome:word} só sem aspas
+#   e {nome:int} um número inteiro; um nome repetido exige o mesmo texto;
+# - {nome=palavra} casa a palavra fixa como um token comum e a captura como
+#   foi escrita, para a substituição manter as maiúsculas da consulta;
+# - {nome:ws} fica entre dois tokens e captura o espaço em branco (talvez
+#   vazio) entre eles, para a substituição manter o espaçamento original;
+# - quando mais de uma regra casa na mesma posição vale o padrão com mais
+#   tokens e, no empate, a regra definida antes.
+
+RuleSpec = Dict[str, Union[str, List[str], bool]]
+
+# Reescritas padrão do proxy: schema numérico entre aspas e comparação
+# codlig/matricula com cast para text (nas duas ordens), mantendo o espaço em
+# volta do '=' e a grafia de `codlig` (`A.CodLig` vira `A.CodLig::text`).
+# Diferenças intencionais em relação ao reescritor anterior
+# (bench/legacy_rewriter.py), que varria caractere a caractere:
+# - dígitos no meio de um identificador não são schema: `t1.codlig` e
+#   `_10.x` ficam como estão (antes viravam `t"1"."codlig"` e `_"10"."x"`),
+#   então `t1.codlig = t2.matricula` vira `t1.codlig::text = t2."matricula"`;
+# - letras não ASCII fazem parte do identificador: `10.tábela` vira
+#   `"10"."tábela"` (antes `"10"."t"ábela`) e `"5.té"` vira `"5"."té"`
+#   (antes ficava igual);
+# - literais com escapes (E'...\'...') são reconhecidos; antes o reescritor
+#   se perdia no \' e podia alterar o literal ou parar de reescrever o resto;
+# - na comparação, os aliases podem estar entre aspas (`"A".codlig = ...`,
+#   antes ignorado) mas precisam ser identificadores (`12x.codlig = ...`,
+#   antes reescrito, fica igual), e espaço em volta dos pontos é aceito e
+#   removido (`a . codlig = b . matricula` vira `a.codlig::text = b."matricula"`).
+DEFAULT_RULES: List[RuleSpec] = [
+    {'name': 'schema_numerico', 'match': '{schema:int}.{tabela:word}', 'replace': '"{schema}"."{tabela}"'},
+    {'name': 'schema_numerico_aspas', 'match': '"{schema:int}.{tabela:word}"', 'replace': '"{schema}"."{tabela}"'},
+    {'name': 'matricula_aspas', 'match': '"matricula"', 'replace': '"matricula"'},
+    {
+        'name': 'codlig_matricula',
+        'match': ['{a}.{c=codlig}{l:ws}={r:ws}{b}.matricula', '{a}.{c=codlig}{l:ws}={r:ws}{b}."matricula"'],
+        'replace': '{a}.{c}::text{l}={r}{b}."matricula"',
+    },
+    {
+        'name': 'matricula_codlig',
+        'match': '{a}.matricula{l:ws}={r:ws}{b}.{c=codlig}',
+        'replace': '{a}."matricula"{l}={r}{b}.{c}::text',
+    },
+]
+
+_WS = rb'[\t\n\x0b\x0c\r\x1c-\x1f ]'
+_WORD = rb'[A-Za-z_\x80-\xff][A-Za-z0-9_$\x80-\xff]*'
+_QUOTED = rb'"[^"]*(?:""[^"]*)*"(?!")'
+_NOT_AFTER_WORD = rb'(?<![A-Za-z0-9_$\x80-\xff])'
+_NOT_BEFORE_WORD = rb'(?![A-Za-z0-9_$\x80-\xff])'
+_OP_CHAR = rb'(?:[+*<>=~!@#%^&|`?]|-(?!-)|/(?!\*))'
+_DOLLAR_TAG = rb'\$(?:[A-Za-z_\x80-\xff][A-Za-z0-9_\x80-\xff]*)?\$'
+# Guardas da varredura: padrões que começam por marcador de identificador só
+# são tentados no início de um token, e os trechos ignorados só nos
+# caracteres que podem abri-los
+_TOKEN_START = rb'(?:' + _NOT_AFTER_WORD + rb'(?=[A-Za-z_\x80-\xff])|(?="))'
+_SKIP_CHARS = rb'\-/\'"$eE'
+_SKIP_START = rb'(?=[' + _SKIP_CHARS + rb'])'
+# Acima disso as alternativas que dependem de palavras fixas ficam sempre na
+# varredura, para não compilar uma expressão por combinação
+_MAX_GATES = 8
+
+# Tokens de um padrão
+_PATTERN_TOKEN_RE = re.compile(
+    rb'(?P<ws>' + _WS + rb'+)'
+    rb'|(?P<ph>\{[A-Za-z_][A-Za-z0-9_]*(?::[a-z]+|=' + _WORD + rb')?\})'
+    rb"|(?P<str>'[^']*(?:''[^']*)*'(?!'))"
+    rb'|(?P<quoted>' + _QUOTED + rb')'
+    rb'|(?P<word>' + _WORD + rb')'
+    rb'|(?P<int>[0-9]+)'
+    rb'|(?P<op>::|' + _OP_CHAR + rb'+)'
+    rb'|(?P<other>[(),;\[\].:])'
+)
+_PLACEHOLDER_RE = re.compile(rb'\{([A-Za-z_][A-Za-z0-9_]*)(?::([a-z]+)|=(' + _WORD + rb'))?\}')
+_PLACEHOLDER_TYPES = {
+    'ident': _NOT_AFTER_WORD + _WORD + rb'|' + _QUOTED,
+    'word': _NOT_AFTER_WORD + _WORD,
+    'int': _NOT_AFTER_WORD + rb'[0-9]+' + _NOT_BEFORE_WORD,
+    'ws': _WS + rb'*',
+}
+# Marcadores no pré-filtro, sem as verificações de limite de token; no
+# início da âncora basta o último caractere do marcador
+_LOOSE_PLACEHOLDER_TYPES = {'ident': _WORD + rb'|' + _QUOTED, 'word': _WORD, 'int': rb'[0-9]+', 'ws': _WS + rb'*'}
+_LOOSE_LAST_CHAR = {'ident': rb'[A-Za-z0-9_$\x80-\xff"]', 'word': rb'[A-Za-z0-9_$\x80-\xff]', 'int': rb'[0-9]'}
+# Marcadores dentro de identificadores entre aspas
+_QUOTED_PLACEHOLDER_TYPES = {'ident': _WORD, 'word': _WORD, 'int': rb'[0-9]+'}
+
+# Trechos copiados sem análise; uma abertura sem fechamento encerra a varredura
+_SKIP = (
+    rb"(?P<skip>" + _NOT_AFTER_WORD + rb"[eE]'(?:[^'\\]|\\.|'')*'(?!')"
+    rb"|'[^']*(?:''[^']*)*'(?!')"
+    rb'|--[^\n]*'
+    rb'|/\*[^*]*\*+(?:[^*/][^*]*\*+)*/'
+    rb'|' + _NOT_AFTER_WORD + rb'\$(?P<tag>(?:[A-Za-z_\x80-\xff][A-Za-z0-9_\x80-\xff]*)?)\$(?s:.*?)\$(?P=tag)\$'
+    rb'|' + _QUOTED + rb')'
+    rb"|(?P<open>/\*|'|\"|" + _NOT_AFTER_WORD + _DOLLAR_TAG + rb')'
+)
+
+
+class RuleError(ValueError):
+    pass
+
+
+class Rule:
+    __slots__ = ('name', 'template', 'tail', 'hits')
+
+    def __init__(self, name: str, replace: bytes) -> None:
+        self.name = name
+        # Modelo: pares (texto fixo, marcador seguinte) e o texto final
+        self.template: List[Tuple[bytes, bytes]] = []
+        last = 0
+        for m in _PLACEHOLDER_RE.finditer(replace):
+            self.template.append((replace[last:m.start()], m.group(1)))
+            last = m.end()
+        self.tail = replace[last:]
+        self.hits = 0
+
+    def render(self, m: 're.Match', groups: Tuple[str, ...]) -> bytes:
+        # `groups`: grupo da expressão de cada marcador do modelo, em ordem
+        parts = []
+        for (text, _), group in zip(self.template, groups):
+            parts.append(text)
+            parts.append(m.group(group))
+        parts.append(self.tail)
+        return b''.join(parts)
+
+
+def _placeholder_type(m: 're.Match', types: Dict[str, bytes]) -> bytes:
+    if m.group(3) is not None:
+        return b'(?i:' + re.escape(m.group(3)) + b')'
+    ph_type = (m.group(2) or b'ident').decode('ascii')
+    if ph_type not in types:
+        raise RuleError(f'tipo de marcador desconhecido: {ph_type}')
+    return types[ph_type]
+
+
+def _case_chars(char: bytes) -> bytes:
+    # Conteúdo de classe com as duas caixas de um caractere
+    if char.isalpha():
+        return char.lower() + char.upper()
+    return re.escape(char)
+
+
+def _compile_pattern(
+    pattern: bytes, prefix: str
+) -> Tuple[bytes, bytes, Dict[bytes, str], int, Tuple[Optional[bytes], Optional[bytes]], Optional[bytes]]:
+    # Expressão exata do padrão (grupos nomeados com `prefix`), âncora para o
+    # pré-filtro, grupo de cada marcador, número de tokens, classes do
+    # primeiro caractere dos dois primeiros tokens (None para marcador de
+    # identificador) e a palavra fixa mais longa
+    parts: List[bytes] = []
+    loose: List[bytes] = []
+    groups: Dict[bytes, str] = {}
+    words: List[bytes] = []
+    # Posições de `parts` ocupadas por {nome:ws}
+    spaces: Set[int] = set()
+    # Classe do primeiro caractere de cada token (None para identificadores)
+    starts: List[Optional[bytes]] = []
+    # Tokens de `loose` na âncora sem palavra fixa: até o primeiro token fixo
+    anchor_tokens = 0
+
+    def placeholder(name: bytes, body: bytes) -> bytes:
+        if name in groups:
+            return b'(?P=' + groups[name].encode('ascii') + b')'
+        groups[name] = f'{prefix}_{name.decode("ascii")}'
+        return b'(?P<' + groups[name].encode('ascii') + b'>' + body + b')'
+
+    pos = 0
+    while pos < len(pattern):
+        m = _PATTERN_TOKEN_RE.match(pattern, pos)
+        if m is None:
+            raise RuleError(f'trecho não suportado no padrão: {pattern[pos:].decode("utf-8", "replace")!r}')
+        pos = m.end()
+        kind = m.lastgroup
+        text = m.group()
+        if kind == 'ws':
+            continue
+        fixed = True
+        if kind == 'ph':
+            ph = _PLACEHOLDER_RE.fullmatch(text)
+            body = _placeholder_type(ph, _PLACEHOLDER_TYPES)
+            if ph.group(3) is not None:
+                words.append(ph.group(3).lower())
+                body = _NOT_AFTER_WORD + body + _NOT_BEFORE_WORD
+                loose.append(re.escape(ph.group(3)))
+                starts.append(_case_chars(ph.group(3)[:1]))
+            else:
+                ph_type = (ph.group(2) or b'ident').decode('ascii')
+                if ph_type == 'ws':
+                    spaces.add(len(parts))
+                else:
+                    starts.append(b'0-9' if ph_type == 'int' else None)
+                if not parts and ph_type in _LOOSE_LAST_CHAR:
+                    loose.append(_LOOSE_LAST_CHAR[ph_type])
+                else:
+                    loose.append(b'(?:' + _LOOSE_PLACEHOLDER_TYPES[ph_type] + b')')
+                fixed = False
+            parts.append(placeholder(ph.group(1), body))
+        elif kind == 'quoted':
+            content = text[1:-1].replace(b'""', b'"')
+            exact = []
+            approx = []
+            # Textos fixos antes de cada marcador e depois do último
+            texts = []
+            last = 0
+            for ph in _PLACEHOLDER_RE.finditer(content):
+                body = _placeholder_type(ph, _QUOTED_PLACEHOLDER_TYPES)
+                texts.append(re.escape(content[last:ph.start()]))
+                exact.append(texts[-1] + placeholder(ph.group(1), body))
+                approx.append(texts[-1] + body)
+                last = ph.end()
+            texts.append(re.escape(content[last:]))
+            parts.append(b'"(?i:' + b''.join(exact) + texts[-1] + b')"(?!")')
+            if approx:
+                # Na âncora basta ir até o texto fixo depois do 1º marcador
+                loose.append(b'"' + approx[0] + texts[1])
+            else:
+                loose.append(b'"' + texts[0] + b'"')
+                if re.fullmatch(_WORD, content):
+                    words.append(content.lower())
+            starts.append(b'"')
+        elif kind == 'word':
+            words.append(text.lower())
+            parts.append(_NOT_AFTER_WORD + b'(?i:' + re.escape(text) + b')' + _NOT_BEFORE_WORD)
+            loose.append(re.escape(text))
+            starts.append(_case_chars(text[:1]))
+        elif kind == 'int':
+            parts.append(_NOT_AFTER_WORD + text + _NOT_BEFORE_WORD)
+            loose.append(text)
+            starts.append(text[:1])
+        elif kind == 'op':
+            parts.append(rb'(?<!' + _OP_CHAR + rb')' + re.escape(text) + rb'(?!' + _OP_CHAR + rb')')
+            loose.append(re.escape(text))
+            starts.append(re.escape(text[:1]))
+        else:
+            parts.append(re.escape(text))
+            loose.append(re.escape(text))
+            starts.append(re.escape(text[:1]))
+        if fixed and not anchor_tokens:
+            anchor_tokens = len(loose)
+    if not parts:
+        raise RuleError('padrão vazio')
+    if 0 in spaces or len(parts) - 1 in spaces or any(i + 1 in spaces for i in spaces):
+        raise RuleError('marcador :ws precisa ficar entre dois tokens')
+
+    def join(items: List[bytes]) -> bytes:
+        # Espaço opcional entre tokens, exceto em volta de um {nome:ws}
+        joined = [items[0]]
+        for i in range(1, len(items)):
+            if i not in spaces and i - 1 not in spaces:
+                joined.append(_WS + b'*')
+            joined.append(items[i])
+        return b''.join(joined)
+
+    # Uma palavra fixa basta como âncora; sem ela, o padrão até o primeiro
+    # token fixo (ou inteiro, se só tem marcadores)
+    word = max(words, key=len) if words else None
+    anchor = re.escape(word) if word is not None else join(loose[:anchor_tokens or len(loose)])
+    starts.append(None)
+    return join(parts), anchor, groups, len(parts) - len(spaces), (starts[0], starts[1]), word
+
+
+class RewriteRules:
+    def __init__(self, specs: List[RuleSpec], hits: Optional[Dict[str, int]] = None) -> None:
+        self.rules: List[Rule] = []
+        self.hits = hits if hits is not None else {}
+        # Alternativa da varredura -> (regra, grupo de cada marcador do modelo)
+        self._alternatives: Dict[str, Tuple[Rule, Tuple[str, ...]]] = {}
+        # (prioridade, ordem, alternativa, expressão, classes iniciais, palavra fixa)
+        compiled: List[Tuple[int, int, str, bytes, Tuple[Optional[bytes], Optional[bytes]], Optional[bytes]]] = []
+        anchors = set()
+        for spec in specs:
+            name = spec.get('name')
+            try:
+                if not isinstance(name, str) or not name:
+                    raise RuleError('regra sem "name"')
+                if any(rule.name == name for rule in self.rules):
+                    raise RuleError('nome repetido')
+                match = spec.get('match')
+                patterns = [match] if isinstance(match, str) else match
+                replace = spec.get('replace')
+                if not patterns or not all(isinstance(p, str) for p in patterns) or not isinstance(replace, str):
+                    raise RuleError('"match" (texto ou lista) e "replace" (texto) são obrigatórios')
+                rule = Rule(name, replace.encode('utf-8'))
+                used = {placeholder for _, placeholder in rule.template}
+                for pattern in patterns:
+                    alternative = f'r{len(compiled)}'
+                    regex, anchor, groups, count, starts, word = _compile_pattern(pattern.encode('utf-8'), alternative)
+                    missing = used - set(groups)
+                    if missing:
+                        raise RuleError(
+                            'marcadores da substituição ausentes no padrão: '
+                            + ', '.join(sorted(m.decode('ascii') for m in missing))
+                        )
+                    re.compile(regex)
+                    compiled.append((-count, len(compiled), alternative, regex, starts, word))
+                    self._alternatives[alternative] = (rule, tuple(groups[name] for _, name in rule.template))
+                    anchors.add(anchor)
+            except (RuleError, re.error) as e:
+                raise RuleError(f'regra {name!r}: {e}') from None
+            self.rules.append(rule)
+            self.hits.setdefault(name, 0)
+        # Padrões mais longos primeiro; no empate, a ordem de definição
+        compiled.sort()
+        self._compiled = compiled
+        gates = {word for _, _, _, _, starts, word in compiled if starts[0] is None and word is not None}
+        self._gates = sorted(gates) if len(gates) <= _MAX_GATES else []
+        # Máscara das palavras de `_gates` presentes -> varredura
+        self._scanners: Dict[int, 're.Pattern'] = {}
+        self._build_scanner((1 << len(self._gates)) - 1)
+        self.prefilter = re.compile(b'|'.join(sorted(anchors)) or rb'(?!)', re.IGNORECASE)
+
+    def _build_scanner(self, mask: int) -> 're.Pattern':
+        # Varredura com as alternativas que podem casar quando as palavras de
+        # `_gates` marcadas em `mask` (e só elas) aparecem na consulta.
+        # Alternativas seguidas do mesmo tipo (começando ou não por
+        # identificador) dividem um guarda, sem mudar a ordem de prioridade.
+        present = {word for i, word in enumerate(self._gates) if mask & (1 << i)}
+        selected = [
+            entry for entry in self._compiled
+            if entry[4][0] is not None or entry[5] is None or not self._gates or entry[5] in present
+        ]
+        branches = []
+        for lead, run in groupby(selected, key=lambda entry: entry[4][0] is None):
+            entries = list(run)
+            group = b'|'.join(b'(?P<' + alt.encode('ascii') + b'>' + regex + b')' for _, _, alt, regex, _, _ in entries)
+            if lead:
+                seconds = {starts[1] for _, _, _, _, starts, _ in entries}
+                guard = _TOKEN_START
+                if None not in seconds:
+                    guard += (
+                        b'(?=(?:' + _WORD + b'|' + _QUOTED + b')' + _WS + b'*[' + b''.join(sorted(seconds)) + b'])'
+                    )
+            else:
+                guard = b'(?=[' + b''.join(sorted({starts[0] for _, _, _, _, starts, _ in entries})) + b'])'
+            branches.append(guard + b'(?:' + group + b')')
+        branches.append(_SKIP_START + b'(?:' + _SKIP + b')')
+        pattern = b'|'.join(branches)
+        if all(entry[4][0] is not None for entry in selected):
+            # Sem identificador no início, um guarda geral descarta antes as
+            # posições que nenhum grupo aceita
+            starts = {entry[4][0] for entry in selected}
+            pattern = b'(?=[' + b''.join(sorted(starts)) + _SKIP_CHARS + b'])(?:' + pattern + b')'
+        scanner = re.compile(pattern)
+        self._scanners[mask] = scanner
+        return scanner
+
+    def needs_rewrite(self, query: bytes) -> bool:
+        return self.prefilter.search(query) is not None
+
+    def rewrite(self, query: bytes) -> bytes:
+        # Retorna o próprio objeto `query` quando nada muda
+        if self.prefilter.search(query) is None:
+            return query
+        mask = 0
+        if self._gates:
+            lowered = query.lower()
+            bit = 1
+            for word in self._gates:
+                if word in lowered:
+                    mask |= bit
+                bit <<= 1
+        scanner = self._scanners.get(mask) or self._build_scanner(mask)
+        out = []
+        copied = 0
+        alternatives = self._alternatives
+        for m in scanner.finditer(query):
+            kind = m.lastgroup
+            if kind == 'skip':
+                continue
+            if kind == 'open':
+                break
+            rule, groups = alternatives[kind]
+            replacement = rule.render(m, groups)
+            start, end = m.span()
+            if replacement == query[start:end]:
+                continue
+            out.append(query[copied:start])
+            out.append(replacement)
+            copied = end
+            rule.hits += 1
+            self.hits[rule.name] += 1
+        if not out:
+            return query
+        out.append(query[copied:])
+        return b''.join(out)
+
+
+def load_rule_specs(path: str) -> List[RuleSpec]:
+    # Regras padrão seguidas das do arquivo. Uma regra do arquivo com o nome
+    # de uma padrão a substitui; {"name": ..., "enabled": false} a desativa.
+    specs = {spec['name']: spec for spec in DEFAULT_RULES}
+    if path:
+        try:
+            loaded = json.loads(Path(path).read_text(encoding='utf-8'))
+        except (OSError, ValueError) as e:
+            raise RuntimeError(f'Não foi possível ler o arquivo de regras de reescrita ({path}): {e}')
+        if not isinstance(loaded, list) or not all(isinstance(spec, dict) for spec in loaded):
+            raise RuntimeError(f'O arquivo de regras de reescrita ({path}) deve conter uma lista JSON de regras.')
+        for spec in loaded:
+            specs.pop(spec.get('name'), None)
+            if spec.get('enabled', True):
+                specs[spec.get('name')] = spec
+    return list(specs.values())
+
+
+def load_rules(path: str, hits: Optional[Dict[str, int]] = None) -> RewriteRules:
+    try:
+        return RewriteRules(load_rule_specs(path), hits)
+    except RuleError as e:
+        raise RuntimeError(f'Regra de reescrita inválida ({path or "regras padrão"}): {e}')
+
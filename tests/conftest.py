@@ -0,0 +1,22 @@
+import os
+import sys
+from pathlib import Path
+
+# Os módulos do proxy leem a configuração do ambiente ao serem importados;
+# os testes fixam os valores (um .env não os sobrescreve), com o cache de
+# resultados ligado para a tabela `contas` e a promoção automática a
+# statements preparados na terceira execução.
+_TEST_ENV = {
+    'PG_HOST': '127.0.0.1',
+    'PG_PORT': '5432',
+    'PROXY_HOST': '127.0.0.1',
+    'PROXY_PORT': '6432',
+    'SSL_REQUEST_CODE': '80877103',
+    'DEBUG_LOG_QUERIES': 'false',
+    'RESULT_CACHE_TABLES': 'contas',
+    'RESULT_CACHE_TTL': '60',
+    'AUTO_PREPARE_THRESHOLD': '3',
+}
+os.environ.update(_TEST_ENV)
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
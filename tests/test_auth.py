@@ -0,0 +1,75 @@
+import base64
+import hashlib
+import hmac
+
+import pytest
+
+from pg_auth import (
+    ScramClient,
+    is_md5_hash,
+    md5_password_hash,
+    md5_response,
+    verify_cleartext_password,
+    verify_md5_response,
+)
+from pooling import load_userlist
+
+_HASH = 'md5' + hashlib.md5(b'secretapp').hexdigest()
+
+
+def test_md5_hash_format():
+    assert md5_password_hash('app', 'secret') == _HASH
+    assert md5_password_hash('app', _HASH) == _HASH
+    assert is_md5_hash(_HASH)
+    assert not is_md5_hash('secret') and not is_md5_hash('md5secret')
+
+
+def test_md5_response():
+    salt = b'\x01\x02\x03\x04'
+    expected = 'md5' + hashlib.md5(_HASH[3:].encode('ascii') + salt).hexdigest()
+    assert md5_response('app', 'secret', salt) == expected
+    assert md5_response('app', _HASH, salt) == expected
+    assert verify_md5_response('app', _HASH, salt, expected)
+    assert not verify_md5_response('app', 'outra', salt, expected)
+
+
+@pytest.mark.parametrize('stored', ['secret', _HASH])
+def test_cleartext_password(stored):
+    assert verify_cleartext_password('app', stored, 'secret')
+    assert not verify_cleartext_password('app', stored, 'errada')
+    # O hash não vale como senha
+    assert not verify_cleartext_password('app', stored, _HASH)
+
+
+def test_scram_exchange():
+    # Lado servidor do SCRAM-SHA-256 (RFC 5802) com o verificador do pg_authid
+    salt, iterations = b'salsalsal', 4096
+    salted = hashlib.pbkdf2_hmac('sha256', b'secret', salt, iterations)
+    stored_key = hashlib.sha256(hmac.new(salted, b'Client Key', 'sha256').digest()).digest()
+    server_key = hmac.new(salted, b'Server Key', 'sha256').digest()
+
+    client = ScramClient('secret')
+    client_first_bare = client.initial_response().decode('ascii')[3:]
+    nonce = client_first_bare.split('r=', 1)[1] + 'servidor'
+    server_first = f'r={nonce},s={base64.b64encode(salt).decode("ascii")},i={iterations}'
+    final = client.final_response(server_first.encode('ascii')).decode('ascii')
+    without_proof, proof = final.rsplit(',p=', 1)
+    auth_message = f'{client_first_bare},{server_first},{without_proof}'.encode('ascii')
+    signature = hmac.new(stored_key, auth_message, 'sha256').digest()
+    client_key = bytes(a ^ b for a, b in zip(base64.b64decode(proof), signature))
+    assert hashlib.sha256(client_key).digest() == stored_key
+
+    server_signature = hmac.new(server_key, auth_message, 'sha256').digest()
+    client.verify_final(b'v=' + base64.b64encode(server_signature))
+    with pytest.raises(ValueError, match='assinatura SCRAM do servidor inválida'):
+        client.verify_final(b'v=' + base64.b64encode(bytes(32)))
+    with pytest.raises(ValueError, match='SCRAM recusado pelo servidor'):
+        client.verify_final(b'e=invalid-proof')
+
+
+def test_load_userlist(tmp_path, caplog):
+    path = tmp_path / 'userlist.txt'
+    path.write_text(f'; comentário\n"app" "secret"\n"leitor" "{_HASH}"\n\n', encoding='utf-8')
+    assert load_userlist(str(path)) == {'app': 'secret', 'leitor': _HASH}
+    assert 'hash md5 para leitor' in caplog.text
+    assert load_userlist('') == {}
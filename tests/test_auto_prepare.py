@@ -0,0 +1,104 @@
+import pytest
+
+import auto_prepare
+from auto_prepare import AutoPrepare, ServerStatements, parameterize
+from pg_protocol import error_response, message
+
+# AUTO_PREPARE_THRESHOLD=3 (conftest.py)
+_QUERY = b'select * from contas where id = 42'
+_ROWS = [message(b'T', b'\x00\x00'), message(b'D', b'\x00\x00'), message(b'C', b'SELECT 1\x00')]
+_READY = message(b'Z', b'I')
+
+
+@pytest.fixture(autouse=True)
+def _forget_unpreparable():
+    auto_prepare._unpreparable.clear()
+
+
+def _forwarded(prepare, replies):
+    # Mensagens do servidor que seguem para o cliente
+    data = b''.join(replies)
+    out = []
+    pos = 0
+    while pos < len(data):
+        end = pos + 1 + int.from_bytes(data[pos + 1:pos + 5], 'big')
+        if prepare.server_message(data, pos, end):
+            out.append(data[pos:end])
+        pos = end
+    return out
+
+
+@pytest.mark.parametrize('query, expected', [
+    (
+        b"select * from contas where id = 42 and nome = 'O''Brien'",
+        (b'select * from contas where id = $1 and nome = $2', (23, 0), [b'42', b"O'Brien"]),
+    ),
+    (b'insert into t values (3000000000, 1.5)', (b'insert into t values ($1, $2)', (20, 1700), [b'3000000000', b'1.5'])),
+    (
+        b"select * from t where d > date '2020-01-01' order by 1",
+        (b"select * from t where d > date '2020-01-01' order by 1", (), []),
+    ),
+    (b'select * from t where id = 5;  ', (b'select * from t where id = $1;  ', (23,), [b'5'])),
+    (b'select 1; select 2', None),
+    (b"select 'abc", None),
+    (b'create table x (a int)', None),
+])
+def test_parameterize(query, expected):
+    assert parameterize(query) == expected
+
+
+def test_repeated_query_is_prepared_and_executed():
+    prepare = AutoPrepare(ServerStatements())
+    for _ in range(2):
+        assert prepare.simple_query(_QUERY) is None
+        assert _forwarded(prepare, _ROWS + [_READY]) == _ROWS + [_READY]
+
+    sent = prepare.simple_query(_QUERY)
+    assert sent.startswith(message(b'P', b'proxy_auto_1\x00select * from contas where id = $1\x00\x00\x01\x00\x00\x00\x17'))
+    assert sent.endswith(message(b'S') + message(b'Q', _QUERY + b'\x00'))
+    # ParseComplete e o ReadyForQuery da preparação não chegam ao cliente
+    assert _forwarded(prepare, [message(b'1'), _READY] + _ROWS + [_READY]) == _ROWS + [_READY]
+
+    sent = prepare.simple_query(b'select * from contas where id = 7')
+    assert sent.startswith(message(b'B', b'\x00proxy_auto_1\x00\x00\x00\x00\x01\x00\x00\x00\x017\x00\x00'))
+    assert _forwarded(prepare, [message(b'2')] + _ROWS + [_READY]) == _ROWS + [_READY]
+    assert not prepare.expected
+
+
+def test_refused_parse_is_not_retried():
+    prepare = AutoPrepare(ServerStatements())
+    for _ in range(2):
+        prepare.simple_query(_QUERY)
+        _forwarded(prepare, _ROWS + [_READY])
+    prepare.simple_query(_QUERY)
+    refused = error_response('42P18', 'could not determine data type of parameter $1')
+    assert _forwarded(prepare, [refused, _READY] + _ROWS + [_READY]) == _ROWS + [_READY]
+    for _ in range(5):
+        assert prepare.simple_query(_QUERY) is None
+        _forwarded(prepare, _ROWS + [_READY])
+
+
+def test_stale_statement_is_prepared_again():
+    server = ServerStatements()
+    prepare = AutoPrepare(server)
+    for _ in range(2):
+        prepare.simple_query(_QUERY)
+        _forwarded(prepare, _ROWS + [_READY])
+    prepare.simple_query(_QUERY)
+    _forwarded(prepare, [message(b'1'), _READY] + _ROWS + [_READY])
+    assert list(server.names.values()) == [b'proxy_auto_1']
+    prepare.simple_query(_QUERY)
+    stale = error_response('26000', 'prepared statement "proxy_auto_1" does not exist')
+    assert _forwarded(prepare, [stale, _READY]) == [stale, _READY]
+    assert not server.names
+
+
+def test_no_promotion_inside_transaction_or_extended_protocol():
+    prepare = AutoPrepare(ServerStatements())
+    prepare.status = ord('T')
+    for _ in range(5):
+        assert prepare.simple_query(_QUERY) is None
+        prepare.expected.clear()
+    prepare.status = 73
+    prepare.client_message(ord('P'))
+    assert prepare.simple_query(_QUERY) is None
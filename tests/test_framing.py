@@ -0,0 +1,108 @@
+import random
+
+from admission import READY_FOR_QUERY_HEADER, IdleTracker
+from pg_protocol import Framer, error_response, message, parse_error_fields, unpack_uint32
+
+
+def _frame(chunks, max_message=None):
+    # Laço de enquadramento dos repasses do proxy: mensagens inteiras numa
+    # lista; as maiores que `max_message` seguem em streaming e entram como
+    # (tipo, bytes recebidos na leitura em que começaram)
+    framer = Framer()
+    messages = []
+    for chunk in chunks:
+        data = framer.feed(chunk)
+        if data is None:
+            continue
+        n = len(data)
+        pos = framer.take_skip(n)
+        need = 5
+        while pos < n:
+            if n - pos < 5:
+                need = 5
+                break
+            end = pos + 1 + unpack_uint32(data, pos + 1)[0]
+            if end > n:
+                if max_message is not None and end - pos > max_message:
+                    messages.append((data[pos:pos + 1], n - pos))
+                    framer.stream(end - n)
+                    pos = n
+                    break
+                need = end - pos
+                break
+            messages.append(data[pos:end])
+            pos = end
+        if pos < n:
+            framer.keep(data, pos, need)
+    return messages
+
+
+def _split(stream, rng):
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        size = rng.choice((1, 2, 3, 5, 7, 64, 4096))
+        chunks.append(stream[pos:pos + size])
+        pos += size
+    return chunks
+
+
+def test_framer_reassembles_messages_split_anywhere():
+    sent = [message(b'Q', b'select %d\x00' % i) for i in range(50)] + [message(b'D', b'x' * 3000), message(b'S')]
+    stream = b''.join(sent)
+    rng = random.Random(1)
+    for _ in range(200):
+        assert _frame(_split(stream, rng)) == sent
+    assert _frame([stream]) == sent
+
+
+def test_framer_streams_oversized_message():
+    big = message(b'Q', b'x' * 10000 + b'\x00')
+    after = message(b'S')
+    chunks = [big[:100], big[100:6000], big[6000:] + after[:2], after[2:]]
+    assert _frame(chunks, max_message=1000) == [(b'Q', 100), after]
+
+
+def test_idle_tracker_counts_split_ready_for_query():
+    ready = READY_FOR_QUERY_HEADER + b'T'
+    reply = message(b'C', b'SELECT 1\x00') + ready
+    for cut in range(1, len(reply)):
+        tracker = IdleTracker(writer=None)
+        tracker.request(ord('Q'))
+        tracker.idle_since = 0.0
+        tracker.ready_raw(reply[:cut])
+        # Com o cabeçalho inteiro na primeira leitura a resposta já é contada,
+        # mas o cliente só fica ocioso quando o status chega
+        assert tracker.pending == (0 if cut == len(reply) - 1 else 1)
+        assert tracker.idle_since == 0.0
+        tracker.ready_raw(reply[cut:])
+        assert tracker.pending == 0
+        assert tracker.idle_since > 0
+        assert tracker.status == ord('T')
+
+
+def test_idle_tracker_waits_for_last_ready_for_query():
+    tracker = IdleTracker(writer=None)
+    tracker.request(ord('Q'))
+    tracker.request(ord('Q'))
+    tracker.idle_since = 0.0
+    tracker.ready_raw(READY_FOR_QUERY_HEADER + b'I' + message(b'C', b'SELECT 1\x00'))
+    assert tracker.pending == 1 and tracker.idle_since == 0.0
+    tracker.ready_raw(READY_FOR_QUERY_HEADER + b'E')
+    assert tracker.pending == 0 and tracker.status == ord('E')
+
+
+def test_extended_query_counts_only_sync():
+    tracker = IdleTracker(writer=None)
+    for msg_type in b'PBDE':
+        tracker.request(msg_type)
+    assert tracker.pending == 0 and tracker.unsynced
+    tracker.request(ord('S'))
+    assert tracker.pending == 1 and not tracker.unsynced
+
+
+def test_error_response_fields():
+    data = error_response('42P01', 'relação "x" não existe')
+    assert data[:1] == b'E' and unpack_uint32(data, 1)[0] == len(data) - 1
+    fields = parse_error_fields(data[5:])
+    assert fields['C'] == '42P01' and fields['S'] == 'ERROR' and fields['M'] == 'relação "x" não existe'
@@ -0,0 +1,149 @@
+import pytest
+
+import result_cache
+from pg_protocol import message
+from result_cache import ConnectionCache
+
+# RESULT_CACHE_TABLES=contas (conftest.py)
+_SCOPE = ('app', 'app', ())
+_SELECT = message(b'Q', b'select * from contas\x00')
+_REPLY = (
+    message(b'T', b'\x00\x01id\x00' + bytes(18))
+    + message(b'D', b'\x00\x01\x00\x00\x00\x011')
+    + message(b'C', b'SELECT 1\x00')
+)
+_IDLE = ord('I')
+_IN_TRANSACTION = ord('T')
+
+
+@pytest.fixture(autouse=True)
+def _empty_cache():
+    result_cache._cache.clear()
+    result_cache._by_table.clear()
+    result_cache._generations.clear()
+    yield
+    result_cache._cache.clear()
+
+
+def _query(conn, data=_SELECT, reply=_REPLY):
+    # Consulta com a conexão ociosa: a resposta guardada, ou None depois de
+    # repassar `reply` pela captura
+    cached = conn.lookup(data, 0, len(data))
+    if cached is None:
+        _reply(conn, reply)
+    return cached
+
+
+def _reply(conn, reply):
+    stream = reply + message(b'Z', b'I')
+    pos = 0
+    while conn.capture is not None and pos < len(stream):
+        end = pos + 1 + int.from_bytes(stream[pos + 1:pos + 5], 'big')
+        conn.server_message(stream, pos, end)
+        pos = end
+
+
+def _send(conn, data):
+    conn.client_message(data[0], data, 0, len(data))
+
+
+def _parse(name, query):
+    return message(b'P', name + b'\x00' + query + b'\x00\x00\x00')
+
+
+def _bind(name):
+    return message(b'B', b'\x00' + name + b'\x00\x00\x00\x00\x00\x00\x00')
+
+
+def _cached():
+    return _query(ConnectionCache(_SCOPE)) is not None
+
+
+def test_select_is_stored_and_served():
+    assert _query(ConnectionCache(_SCOPE)) is None
+    assert _query(ConnectionCache(_SCOPE)) == _REPLY + message(b'Z', b'I')
+    assert _query(ConnectionCache(('outro', 'app', ()))) is None
+
+
+def test_error_reply_is_not_stored():
+    _query(ConnectionCache(_SCOPE), reply=message(b'E', b'C42P01\x00\x00'))
+    assert not _cached()
+
+
+def test_simple_write_invalidates():
+    _cached()
+    _send(ConnectionCache(_SCOPE), message(b'Q', b'update contas set saldo = 0\x00'))
+    assert not _cached()
+    _send(ConnectionCache(_SCOPE), message(b'Q', b'update outras set saldo = 0\x00'))
+    assert _cached()
+
+
+def test_named_statement_invalidates_on_every_bind():
+    writer = ConnectionCache(_SCOPE)
+    _send(writer, _parse(b'w', b'insert into contas values ($1)'))
+    _send(writer, _parse(b'r', b'select * from contas'))
+    _cached()
+    _send(writer, _bind(b'w'))
+    assert not _cached()
+    _send(writer, _bind(b'r'))
+    assert _cached()
+    _send(writer, _bind(b'w'))
+    assert not _cached()
+    # O nome reaproveitado para uma leitura deixa de invalidar
+    _send(writer, _parse(b'w', b'select 1'))
+    _cached()
+    _send(writer, _bind(b'w'))
+    assert _cached()
+
+
+def test_transaction_writes_invalidate_again_at_commit():
+    writer = ConnectionCache(_SCOPE)
+    _send(writer, message(b'Q', b'begin; delete from contas\x00'))
+    writer.ready(_IN_TRANSACTION)
+    # Outra conexão ainda vê os dados de antes do commit e os guarda
+    _cached()
+    assert _cached()
+    writer.ready(_IN_TRANSACTION)
+    assert _cached()
+    writer.ready(_IDLE)
+    assert not _cached()
+    writer.ready(_IDLE)
+    assert _cached()
+
+
+def test_oversized_query_flushes_everything():
+    reader = ConnectionCache(_SCOPE)
+    _cached()
+    assert reader.lookup(_SELECT, 0, len(_SELECT)) is not None
+    big = message(b'Q', b'insert into x values (' + b'1,' * 100 + b'1)\x00')
+    ConnectionCache(_SCOPE).oversized(ord('Q'), big, 0, 20)
+    assert result_cache.result_cache_stats()['entries'] == 0
+    # Uma captura em andamento durante o esvaziamento não é guardada
+    capturing = ConnectionCache(('outro', 'app', ()))
+    capturing.lookup(_SELECT, 0, len(_SELECT))
+    ConnectionCache(_SCOPE).oversized(ord('Q'), big, 0, 20)
+    _reply(capturing, _REPLY)
+    assert result_cache.result_cache_stats()['entries'] == 0
+
+
+def test_oversized_bind_and_parse():
+    writer = ConnectionCache(_SCOPE)
+    _send(writer, _parse(b'r', b'select * from contas'))
+    _cached()
+    # Bind grande de um statement conhecido: só as tabelas dele
+    writer.oversized(ord('B'), _bind(b'r'), 0, 9)
+    assert _cached()
+    # Parse grande: o statement passa a ter tabelas desconhecidas
+    writer.oversized(ord('P'), _parse(b'r', b'x' * 100), 0, 12)
+    _cached()
+    _send(writer, _bind(b'r'))
+    assert not _cached()
+
+
+def test_flush_inside_transaction_is_repeated_at_commit():
+    writer = ConnectionCache(_SCOPE)
+    writer.oversized(ord('Q'), message(b'Q', b'x' * 100), 0, 20)
+    writer.ready(_IN_TRANSACTION)
+    _cached()
+    writer.ready(_IDLE)
+    assert not _cached()
@@ -0,0 +1,93 @@
+import pytest
+
+from bench.legacy_rewriter import rewrite_schema_table_bytes
+from bench.rewriter import build_corpus
+from bench.rewriter_diff import classify, random_queries
+from rewrite_rules import DEFAULT_RULES, RewriteRules, RuleError
+
+_DEFAULT = RewriteRules(DEFAULT_RULES)
+
+
+def test_bytes_rewriter_matches_str_version():
+    # O teste diferencial de bench/rewriter_diff.py com semente fixa: só as
+    # divergências intencionais (codlig/matricula e unicode) são aceitas
+    unexpected = []
+    for query in random_queries(20000, seed=1, max_fragments=14):
+        result = classify(query)
+        if result is not None and result[0] == 'unexpected':
+            unexpected.append((query, result[1], result[2]))
+    assert unexpected == []
+
+
+def test_default_rules_match_bytes_rewriter_on_bench_corpus():
+    for query in build_corpus(400):
+        assert _DEFAULT.rewrite(query) == rewrite_schema_table_bytes(query)
+
+
+@pytest.mark.parametrize('query, expected', [
+    (b'select 10.tab, "10.tab"', b'select "10"."tab", "10"."tab"'),
+    (b'a.codlig = b.matricula', b'a.codlig::text = b."matricula"'),
+    (b'a.codlig=b."matricula"', b'a.codlig::text=b."matricula"'),
+    (b'b.matricula  =a.codlig', b'b."matricula"  =a.codlig::text'),
+    (b'select "Matricula"', b'select "matricula"'),
+    (b"select '5.x', 5.x -- 5.x\n", b'select \'5.x\', "5"."x" -- 5.x\n'),
+    (b'select $$5.x$$, $f$a.codlig = b.matricula$f$', b'select $$5.x$$, $f$a.codlig = b.matricula$f$'),
+    (b"/* a.codlig = b.matricula */ '10.x", b"/* a.codlig = b.matricula */ '10.x"),
+    (b'select 1', b'select 1'),
+])
+def test_default_rules(query, expected):
+    assert _DEFAULT.rewrite(query) == expected
+    assert _DEFAULT.needs_rewrite(query) or query == expected
+
+
+# Diferenças intencionais em relação ao reescritor anterior, descritas no
+# README e junto de DEFAULT_RULES: (consulta, saída das regras, saída antiga)
+@pytest.mark.parametrize('query, expected, legacy', [
+    (b't1.codlig = t2.matricula', b't1.codlig::text = t2."matricula"', b't"1"."codlig" = t"2"."matricula"'),
+    ('select 10.tábela'.encode(), 'select "10"."tábela"'.encode(), 'select "10"."t"ábela'.encode()),
+    ('"5.té"'.encode(), '"5"."té"'.encode(), '"5.té"'.encode()),
+    (b"select E'a\\'5.x', 5.x", b'select E\'a\\\'5.x\', "5"."x"', b'select E\'a\\\'"5"."x"\', 5.x'),
+    (b'"A".codlig = b.matricula', b'"A".codlig::text = b."matricula"', b'"A".codlig = b.matricula'),
+    (b'12x.codlig = b.matricula', b'12x.codlig = b.matricula', b'12x.codlig::text = b."matricula"'),
+    (b'a . codlig = b . matricula', b'a.codlig::text = b."matricula"', b'a . codlig = b . matricula'),
+])
+def test_documented_divergences(query, expected, legacy):
+    assert _DEFAULT.rewrite(query) == expected
+    assert rewrite_schema_table_bytes(query) == legacy
+
+
+@pytest.mark.parametrize('query, expected', [
+    (b'A.CodLig = b.matricula', b'A.CodLig::text = b."matricula"'),
+    (b'a.CODLIG = b."MATRICULA"', b'a.CODLIG::text = b."matricula"'),
+    (b'b.Matricula  =a.CODLIG', b'b."matricula"  =a.CODLIG::text'),
+])
+def test_codlig_keeps_query_spelling(query, expected):
+    assert _DEFAULT.rewrite(query) == expected
+    assert rewrite_schema_table_bytes(query) == expected
+
+
+def test_custom_rules():
+    hits = {}
+    rules = RewriteRules(DEFAULT_RULES + [
+        {'name': 'nvl', 'match': 'nvl(', 'replace': 'coalesce('},
+        {'name': 'mesmo_alias', 'match': '{a}.{b} = {a}.{c}', 'replace': '{a}.{b} = {c}'},
+        {'name': 'tipo', 'match': '{k=foo}{s:ws}.{t:word}', 'replace': '{k}{s}::{t}'},
+        {'name': 'antiga', 'match': '"{nome:word}_old"', 'replace': '"{nome}_new"'},
+    ], hits)
+    assert rules.rewrite(b'select NVL(a, 1)') == b'select coalesce(a, 1)'
+    assert rules.rewrite(b'x.a = x.b and x.a = y.b') == b'x.a = b and x.a = y.b'
+    assert rules.rewrite(b'fOO  .bar, "fOO".bar') == b'fOO  ::bar, "fOO".bar'
+    assert rules.rewrite(b'select * from "t_old", t_old') == b'select * from "t_new", t_old'
+    assert rules.rewrite(b'select 5.x') == b'select "5"."x"'
+    assert not rules.needs_rewrite(b'select a from b')
+    assert hits['nvl'] == 1 and hits['mesmo_alias'] == 1 and hits['schema_numerico'] == 1
+
+
+@pytest.mark.parametrize('spec, error', [
+    ({'name': 'e', 'match': '{a:float}', 'replace': 'x'}, 'tipo de marcador desconhecido: float'),
+    ({'name': 'e', 'match': "'x", 'replace': 'x'}, 'trecho não suportado no padrão'),
+    ({'name': 'e', 'match': '{a}', 'replace': '{b}'}, 'marcadores da substituição ausentes no padrão: b'),
+])
+def test_invalid_rules(spec, error):
+    with pytest.raises(RuleError, match=error):
+        RewriteRules([spec])
@@ -0,0 +1,105 @@
+import asyncio
+import shutil
+import socket
+import subprocess
+
+import pytest
+
+import tls
+from pg_protocol import CANCEL_REQUEST_CODE, PROTOCOL_V3, ProtocolError, unpack_uint32
+
+
+@pytest.fixture
+def certificate(tmp_path):
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl não encontrado')
+    cert, key = tmp_path / 'cert.pem', tmp_path / 'key.pem'
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+         '-keyout', str(key), '-out', str(cert)],
+        check=True, capture_output=True,
+    )
+    return str(cert), str(key)
+
+
+@pytest.fixture
+def contexts(monkeypatch, certificate):
+    # Os dois lados do proxy: TLS com os clientes e, como cliente deste
+    # mesmo servidor, TLS com o "PostgreSQL"
+    monkeypatch.setattr(tls, 'CLIENT_TLS_CERT_FILE', certificate[0])
+    monkeypatch.setattr(tls, 'CLIENT_TLS_KEY_FILE', certificate[1])
+    monkeypatch.setattr(tls, 'CLIENT_TLS_ENABLED', True)
+    monkeypatch.setattr(tls, 'BACKEND_TLS_MODE', 'require')
+    monkeypatch.setattr(tls, 'BACKEND_TLS_ENABLED', True)
+    monkeypatch.setattr(tls, '_client_context', None)
+    monkeypatch.setattr(tls, '_backend_context', None)
+    monkeypatch.setattr(tls, '_stats', dict.fromkeys(tls._stats, 0))
+
+
+async def _serve_once(reader, writer, refuse):
+    header = await reader.readexactly(8)
+    assert unpack_uint32(header, 4)[0] == tls.SSL_REQUEST_CODE
+    if refuse:
+        writer.write(b'N')
+    else:
+        await tls.accept_client_tls(writer)
+        writer.write(await reader.readexactly(4))
+    await writer.drain()
+    writer.close()
+
+
+async def _connect(port, refuse=False):
+    server = await asyncio.start_server(lambda r, w: _serve_once(r, w, refuse), '127.0.0.1', port)
+    async with server:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            await tls.negotiate_backend_tls(reader, writer, '127.0.0.1')
+            writer.write(b'ping')
+            assert await reader.readexactly(4) == b'ping'
+            tls.remember_backend_session(writer, '127.0.0.1')
+            return writer.get_extra_info('ssl_object') is not None
+        finally:
+            writer.close()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_handshake_and_session_resumption(contexts):
+    port = _free_port()
+    assert asyncio.run(_connect(port))
+    assert asyncio.run(_connect(port))
+    stats = tls.tls_stats()
+    assert stats['client_handshakes'] == 2 and stats['backend_handshakes'] == 2
+    assert stats['client_resumed'] == 1 and stats['backend_resumed'] == 1
+
+
+def test_backend_refusing_tls(contexts, monkeypatch):
+    port = _free_port()
+    with pytest.raises(ProtocolError, match='não aceita TLS'):
+        asyncio.run(_connect(port, refuse=True))
+    monkeypatch.setattr(tls, 'BACKEND_TLS_MODE', 'prefer')
+    # Segue sem TLS; o eco de 'ping' não acontece, a conexão só é fechada
+    with pytest.raises(asyncio.IncompleteReadError):
+        asyncio.run(_connect(port, refuse=True))
+    assert tls.tls_stats()['backend_plaintext'] == 1
+
+
+class _Writer:
+    def __init__(self, ssl_object=None):
+        self.ssl_object = ssl_object
+
+    def get_extra_info(self, name):
+        return self.ssl_object if name == 'ssl_object' else None
+
+
+def test_plaintext_refused(monkeypatch):
+    monkeypatch.setattr(tls, 'CLIENT_TLS_REQUIRED', False)
+    assert not tls.plaintext_refused(_Writer(), PROTOCOL_V3)
+    monkeypatch.setattr(tls, 'CLIENT_TLS_REQUIRED', True)
+    assert tls.plaintext_refused(_Writer(), PROTOCOL_V3)
+    assert not tls.plaintext_refused(_Writer(), CANCEL_REQUEST_CODE)
+    assert not tls.plaintext_refused(_Writer(ssl_object=object()), PROTOCOL_V3)
@@ -0,0 +1,164 @@
+import asyncio
+import ssl
+import time
+from typing import Dict, Optional
+
+from config import (
+    BACKEND_TLS_CA_FILE,
+    BACKEND_TLS_MODE,
+    CLIENT_TLS_CERT_FILE,
+    CLIENT_TLS_KEY_FILE,
+    CLIENT_TLS_REQUIRED,
+    CLIENT_TLS_SESSION_TICKETS,
+    SSL_REQUEST_CODE,
+    TLS_HANDSHAKE_TIMEOUT,
+)
+from metrics import backend_tls_handshake_seconds, client_tls_handshake_seconds
+from pg_protocol import CANCEL_REQUEST_CODE, ProtocolError, error_response, pack_uint32
+from proxy_logging import conn_log
+
+# TLS nas duas pontas. Os contextos são criados uma vez (load_tls_contexts,
+# antes do fork dos trabalhadores, que assim compartilham as chaves dos
+# session tickets): um cliente que reconecta retoma a sessão sem o handshake
+# completo, qualquer que seja o trabalhador que o atende. Com o PostgreSQL o
+# proxy guarda a última sessão de cada servidor e a oferece na próxima
+# conexão, então abrir conexões do pool também evita o handshake completo.
+# O modo segue o sslmode do libpq.
+
+CLIENT_TLS_ENABLED = bool(CLIENT_TLS_CERT_FILE)
+BACKEND_TLS_ENABLED = BACKEND_TLS_MODE != 'disable'
+
+TLS_REQUIRED_ERROR = error_response('28000', 'o proxy exige conexão TLS (use sslmode=require)', 'FATAL')
+
+_SSL_REQUEST = pack_uint32(8) + pack_uint32(SSL_REQUEST_CODE)
+
+_stats = {
+    'client_handshakes': 0,
+    'client_resumed': 0,
+    'client_failures': 0,
+    'client_refused': 0,
+    'backend_handshakes': 0,
+    'backend_resumed': 0,
+    'backend_failures': 0,
+    'backend_plaintext': 0,
+}
+
+
+# O asyncio não repassa `session` ao iniciar o TLS; o contexto oferece a
+# última sessão guardada para o servidor no handshake
+class _ResumingContext(ssl.SSLContext):
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        if session is None and server_hostname is not None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+
+_client_context: Optional[ssl.SSLContext] = None
+_backend_context: Optional[_ResumingContext] = None
+
+
+def _build_client_context() -> ssl.SSLContext:
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.options |= ssl.OP_NO_COMPRESSION
+    context.load_cert_chain(CLIENT_TLS_CERT_FILE, CLIENT_TLS_KEY_FILE or None)
+    context.num_tickets = max(0, CLIENT_TLS_SESSION_TICKETS)
+    return context
+
+
+def _build_backend_context() -> _ResumingContext:
+    context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.sessions = {}
+    if BACKEND_TLS_MODE in ('prefer', 'require'):
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+    context.check_hostname = BACKEND_TLS_MODE == 'verify-full'
+    if BACKEND_TLS_CA_FILE:
+        context.load_verify_locations(BACKEND_TLS_CA_FILE)
+    else:
+        context.load_default_certs()
+    return context
+
+
+def load_tls_contexts() -> None:
+    global _client_context, _backend_context
+    if CLIENT_TLS_REQUIRED and not CLIENT_TLS_ENABLED:
+        raise RuntimeError('CLIENT_TLS_REQUIRED exige CLIENT_TLS_CERT_FILE.')
+    if CLIENT_TLS_ENABLED and _client_context is None:
+        _client_context = _build_client_context()
+    if BACKEND_TLS_ENABLED and _backend_context is None:
+        _backend_context = _build_backend_context()
+
+
+def has_buffered_data(reader: asyncio.StreamReader) -> bool:
+    # Bytes que chegaram junto com o SSLRequest (ou com o 'S') não passaram
+    # pelo TLS e não podem ser tratados como parte da sessão cifrada
+    return bool(reader._buffer)
+
+
+def plaintext_refused(writer: asyncio.StreamWriter, code: int) -> bool:
+    # Com CLIENT_TLS_REQUIRED só o CancelRequest pode vir sem TLS
+    if not CLIENT_TLS_REQUIRED or code == CANCEL_REQUEST_CODE or writer.get_extra_info('ssl_object') is not None:
+        return False
+    _stats['client_refused'] += 1
+    return True
+
+
+async def accept_client_tls(writer: asyncio.StreamWriter) -> None:
+    # Resposta 'S' a um SSLRequest do cliente e handshake
+    load_tls_contexts()
+    writer.write(b'S')
+    started = time.perf_counter()
+    try:
+        await writer.start_tls(_client_context, ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        _stats['client_failures'] += 1
+        raise ProtocolError(f'handshake TLS com o cliente falhou: {e}') from e
+    client_tls_handshake_seconds.observe(time.perf_counter() - started)
+    _stats['client_handshakes'] += 1
+    if writer.get_extra_info('ssl_object').session_reused:
+        _stats['client_resumed'] += 1
+
+
+async def negotiate_backend_tls(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str) -> None:
+    # SSLRequest ao PostgreSQL antes do pacote de inicialização
+    if not BACKEND_TLS_ENABLED:
+        return
+    load_tls_contexts()
+    writer.write(_SSL_REQUEST)
+    await writer.drain()
+    answer = await reader.readexactly(1)
+    if answer == b'N':
+        if BACKEND_TLS_MODE != 'prefer':
+            raise ProtocolError(f'o PostgreSQL em {host} não aceita TLS (BACKEND_TLS_MODE={BACKEND_TLS_MODE})')
+        _stats['backend_plaintext'] += 1
+        return
+    if answer != b'S':
+        raise ProtocolError(f'resposta inesperada ao SSLRequest: {answer!r}')
+    if has_buffered_data(reader):
+        raise ProtocolError('dados do PostgreSQL recebidos antes do handshake TLS')
+    started = time.perf_counter()
+    try:
+        await writer.start_tls(_backend_context, server_hostname=host, ssl_handshake_timeout=TLS_HANDSHAKE_TIMEOUT)
+    except (OSError, asyncio.TimeoutError) as e:
+        _stats['backend_failures'] += 1
+        raise ProtocolError(f'handshake TLS com o PostgreSQL em {host} falhou: {e}') from e
+    backend_tls_handshake_seconds.observe(time.perf_counter() - started)
+    _stats['backend_handshakes'] += 1
+    if writer.get_extra_info('ssl_object').session_reused:
+        _stats['backend_resumed'] += 1
+
+
+def remember_backend_session(writer: asyncio.StreamWriter, host: str) -> None:
+    # Chamado depois da autenticação, quando os tickets do TLS 1.3 já chegaram
+    ssl_object = writer.get_extra_info('ssl_object')
+    if ssl_object is None or ssl_object.session is None:
+        return
+    _backend_context.sessions[host] = ssl_object.session
+    conn_log.debug('Sessão TLS com %s guardada para retomada', host)
+
+
+def tls_stats() -> Dict[str, int]:
+    return dict(_stats)
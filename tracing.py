@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from pathlib import Path
+from typing import Deque, Dict, List, Optional, Set, Tuple
+from urllib.parse import parse_qs
+
+from config import DIAGNOSTICS_DIR, PROFILE_SECONDS, SPAN_TIMING, TRACE_BUFFER_SIZE
+from metrics import span_reads_total, span_seconds_total
+from proxy_logging import proxy_log
+
+# Instrumentação para descobrir onde vai o tempo do proxy, deixada sempre no
+# código e ligada só quando necessário:
+#   spans    tempo de cada leitura dos laços de encaminhamento dividido em
+#            enquadramento, reescrita, escrita e espera no drain, somado por
+#            direção nas métricas (proxy_span_seconds_total)
+#   trace    eventos por mensagem e por leitura das conexões escolhidas num
+#            buffer circular, lido em /trace ou gravado em arquivo
+#   profile  amostragem das pilhas do event loop por uma thread, no formato
+#            "collapsed" dos flame graphs
+# Desligados, os laços leem uma flag por leitura e nada mais. Controle pelo
+# endpoint de métricas (/trace, /profile) ou por sinais: SIGUSR1 liga e
+# desliga o trace de todas as conexões (e os spans), gravando os eventos ao
+# desligar; SIGUSR2 grava um profile de PROFILE_SECONDS.
+
+_SAMPLE_INTERVAL = 0.005
+_MAX_PROFILE_SECONDS = 300.0
+
+_DIRECTION_NAMES = ('client_to_server', 'server_to_client')
+
+# (horário, conexão, tipo, direção, detalhe, bytes, etapas); detalhe é o tipo
+# da mensagem em 'msg' e o endereço do cliente em 'open'
+TraceEvent = Tuple[float, int, str, int, str, int, Optional[Tuple[float, float, float, float]]]
+
+
+class TraceState:
+    __slots__ = ('spans', 'enabled', 'peer')
+
+    def __init__(self) -> None:
+        self.spans = SPAN_TIMING
+        self.enabled = False
+        # Endereço (host ou host:porta) das conexões rastreadas; vazio = todas
+        self.peer = ''
+
+    def matches(self, peer: str) -> bool:
+        return self.enabled and (not self.peer or peer == self.peer or peer.rsplit(':', 1)[0] == self.peer)
+
+
+trace_state = TraceState()
+_events: Deque[TraceEvent] = deque(maxlen=max(1, TRACE_BUFFER_SIZE))
+_connections: Dict[int, 'ConnectionTrace'] = {}
+_next_id = 0
+_stats = {'profiles': 0}
+_profiling = False
+
+
+class ConnectionTrace:
+    __slots__ = ('id', 'peer', 'enabled')
+
+    def __init__(self, peer) -> None:
+        global _next_id
+        _next_id += 1
+        self.id = _next_id
+        self.peer = ':'.join(str(part) for part in peer[:2]) if isinstance(peer, tuple) else str(peer)
+        self.enabled = False
+        _connections[self.id] = self
+        self.refresh()
+
+    def refresh(self) -> None:
+        enabled = trace_state.matches(self.peer)
+        if enabled and not self.enabled:
+            _events.append((time.time(), self.id, 'open', -1, self.peer, 0, None))
+        self.enabled = enabled
+
+    def message(self, direction: int, msg_type: int, size: int) -> None:
+        _events.append((time.time(), self.id, 'msg', direction, chr(msg_type), size, None))
+
+    def close(self) -> None:
+        _connections.pop(self.id, None)
+        if self.enabled:
+            _events.append((time.time(), self.id, 'close', -1, '', 0, None))
+
+
+def record_read(
+    trace: Optional[ConnectionTrace], direction: int, size: int,
+    framing: float, rewrite: float, write: float, drain: float,
+) -> None:
+    # Fim de uma leitura medida: soma os spans e registra no trace
+    if trace_state.spans:
+        seconds = span_seconds_total[direction]
+        seconds[0] += framing
+        seconds[1] += rewrite
+        seconds[2] += write
+        seconds[3] += drain
+        span_reads_total[direction] += 1
+    if trace is not None and trace.enabled:
+        _events.append((time.time(), trace.id, 'read', direction, '', size, (framing, rewrite, write, drain)))
+
+
+def set_trace(enabled: bool, peer: str = '') -> None:
+    trace_state.enabled = enabled
+    trace_state.peer = peer
+    for trace in list(_connections.values()):
+        trace.refresh()
+    if enabled:
+        proxy_log.info('Trace de conexões ligado (%s)', peer or 'todas')
+    else:
+        proxy_log.info('Trace de conexões desligado')
+
+
+def _event_dict(event: TraceEvent) -> Dict[str, object]:
+    timestamp, conn, kind, direction, detail, size, steps = event
+    item: Dict[str, object] = {'time': round(timestamp, 6), 'conn': conn, 'event': kind}
+    if direction >= 0:
+        item['direction'] = _DIRECTION_NAMES[direction]
+    if kind == 'open':
+        item['peer'] = detail
+    elif kind == 'msg':
+        item['type'] = detail
+    if size:
+        item['bytes'] = size
+    if steps is not None:
+        for name, seconds in zip(('framing_us', 'rewrite_us', 'write_us', 'drain_us'), steps):
+            item[name] = round(seconds * 1e6, 1)
+    return item
+
+
+def _flag(params: Dict[str, List[str]], name: str) -> Optional[bool]:
+    if name not in params:
+        return None
+    return params[name][0].lower() in ('1', 'true', 'on', 'yes')
+
+
+def trace_page(query_string: bytes) -> Tuple[bytes, bytes]:
+    # GET /trace[?enable=1|0][&peer=host[:porta]][&spans=1|0][&clear=1]
+    params = parse_qs(query_string.decode('ascii', errors='replace'))
+    spans = _flag(params, 'spans')
+    if spans is not None:
+        trace_state.spans = spans
+    enable = _flag(params, 'enable')
+    if enable is not None:
+        set_trace(enable, params.get('peer', [''])[0])
+    events = [_event_dict(event) for event in _events]
+    if _flag(params, 'clear'):
+        _events.clear()
+    body = json.dumps(
+        {'enabled': trace_state.enabled, 'peer': trace_state.peer, 'spans': trace_state.spans, 'events': events},
+        ensure_ascii=False,
+    )
+    return b'application/json; charset=utf-8', body.encode('utf-8')
+
+
+def _sample_stacks(thread_id: int, seconds: float, interval: float) -> Tuple[Dict[str, int], int]:
+    # Roda numa thread à parte: amostra a pilha da thread do event loop
+    counts: Dict[str, int] = {}
+    samples = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{Path(code.co_filename).stem}:{code.co_name}')
+            frame = frame.f_back
+        if stack:
+            key = ';'.join(reversed(stack))
+            counts[key] = counts.get(key, 0) + 1
+            samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+
+async def profile_event_loop(seconds: float, interval: float = _SAMPLE_INTERVAL) -> Tuple[str, int]:
+    # (pilhas no formato collapsed, amostras); só um profile por vez
+    global _profiling
+    if _profiling:
+        raise RuntimeError('já há um profile em andamento')
+    _profiling = True
+    try:
+        counts, samples = await asyncio.get_running_loop().run_in_executor(
+            None, _sample_stacks, threading.get_ident(), min(max(0.1, seconds), _MAX_PROFILE_SECONDS),
+            min(max(0.001, interval), 1.0),
+        )
+    finally:
+        _profiling = False
+    _stats['profiles'] += 1
+    lines = [f'{stack} {count}' for stack, count in sorted(counts.items(), key=lambda item: item[1], reverse=True)]
+    return '\n'.join(lines) + '\n', samples
+
+
+async def profile_page(query_string: bytes) -> Tuple[bytes, bytes]:
+    # GET /profile?seconds=10&interval_ms=5
+    params = parse_qs(query_string.decode('ascii', errors='replace'))
+    try:
+        seconds = float(params.get('seconds', [PROFILE_SECONDS])[0])
+        interval = float(params.get('interval_ms', [_SAMPLE_INTERVAL * 1000])[0]) / 1000
+    except ValueError:
+        seconds, interval = PROFILE_SECONDS, _SAMPLE_INTERVAL
+    try:
+        text, _ = await profile_event_loop(seconds, interval)
+    except RuntimeError as e:
+        text = f'# {e}\n'
+    return b'text/plain; charset=utf-8', text.encode('utf-8')
+
+
+def _diagnostics_path(kind: str, suffix: str) -> Path:
+    directory = Path(DIAGNOSTICS_DIR or tempfile.gettempdir())
+    directory.mkdir(parents=True, exist_ok=True)
+    return directory / f'{kind}-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}{suffix}'
+
+
+def _dump_trace() -> None:
+    path = _diagnostics_path('trace', '.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for event in _events:
+            f.write(json.dumps(_event_dict(event), ensure_ascii=False) + '\n')
+    proxy_log.info('Trace gravado em %s (%s eventos)', path, len(_events))
+    _events.clear()
+
+
+def _toggle_trace() -> None:
+    # SIGUSR1: liga trace e spans em todas as conexões; ao desligar grava os eventos
+    enable = not trace_state.enabled
+    trace_state.spans = enable or SPAN_TIMING
+    set_trace(enable)
+    if not enable:
+        try:
+            _dump_trace()
+        except OSError as e:
+            proxy_log.error('Erro gravando o trace: %s', e)
+
+
+async def _dump_profile() -> None:
+    try:
+        text, samples = await profile_event_loop(PROFILE_SECONDS)
+        path = _diagnostics_path('profile', '.txt')
+        path.write_text(text, encoding='utf-8')
+    except (RuntimeError, OSError) as e:
+        proxy_log.error('Erro no profile do event loop: %s', e)
+        return
+    proxy_log.info('Profile do event loop gravado em %s (%s amostras)', path, samples)
+
+
+_signal_tasks: Set[asyncio.Task] = set()
+
+
+def _start_profile() -> None:
+    # SIGUSR2
+    proxy_log.info('Profile do event loop por %ss', PROFILE_SECONDS)
+    task = asyncio.get_running_loop().create_task(_dump_profile())
+    _signal_tasks.add(task)
+    task.add_done_callback(_signal_tasks.discard)
+
+
+def install_signal_handlers() -> None:
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, _toggle_trace)
+    loop.add_signal_handler(signal.SIGUSR2, _start_profile)
+
+
+def tracing_stats() -> Dict[str, int]:
+    stats = dict(_stats)
+    stats['enabled'] = int(trace_state.enabled)
+    stats['spans_enabled'] = int(trace_state.spans)
+    stats['connections'] = sum(1 for trace in _connections.values() if trace.enabled)
+    stats['events'] = len(_events)
+    return stats
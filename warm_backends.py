@@ -0,0 +1,140 @@
+import asyncio
+import socket
+import time
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+from admission import backend_connect_slots, configure_socket
+from config import BACKEND_QUEUE_TIMEOUT
+from metrics import warm_backend_refill_seconds
+from pg_protocol import ProtocolError
+from proxy_logging import conn_log
+from tls import negotiate_backend_tls
+
+# Conexões TCP com o PostgreSQL abertas de antemão para o modo sem pool: um
+# cliente novo recebe uma delas já conectada (com as opções TCP e, se ativo,
+# o TLS negociado) e só envia o pacote de inicialização. Uma tarefa repõe as
+# que foram usadas, descarta as que o servidor fechou e as mais antigas que a
+# idade máxima, já que o PostgreSQL encerra quem não se apresenta em
+# authentication_timeout. O endereço do servidor é resolvido uma vez e
+# renovado periodicamente.
+
+# Validade (segundos) do endereço resolvido e tempo máximo para abrir uma conexão
+_RESOLVE_TTL = 60.0
+_CONNECT_TIMEOUT = 10.0
+
+Streams = Tuple[asyncio.StreamReader, asyncio.StreamWriter]
+
+
+def _usable(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> bool:
+    # Antes da inicialização o servidor não envia nada: dados ou EOF indicam
+    # uma conexão encerrada (ou recusada com erro) pelo PostgreSQL
+    return not writer.transport.is_closing() and not reader.at_eof() and not reader._buffer
+
+
+class WarmBackends:
+    def __init__(self, host: str, port: int, size: int, max_age: float) -> None:
+        self.host = host
+        self.port = port
+        self.size = max(1, size)
+        self.max_age = max(1.0, max_age)
+        # (criação, reader, writer), da mais antiga para a mais nova
+        self._idle: Deque[Tuple[float, asyncio.StreamReader, asyncio.StreamWriter]] = deque()
+        self._wakeup = asyncio.Event()
+        self._address: Optional[str] = None
+        self._resolved_at = 0.0
+        self._stats = {'hits': 0, 'misses': 0, 'created': 0, 'expired': 0, 'broken': 0, 'connect_errors': 0}
+
+    def take(self) -> Optional[Streams]:
+        # A mais nova primeiro: é a que está mais longe da idade máxima
+        self._wakeup.set()
+        while self._idle:
+            created, reader, writer = self._idle.pop()
+            if not _usable(reader, writer):
+                self._stats['broken'] += 1
+            elif time.monotonic() - created >= self.max_age:
+                self._stats['expired'] += 1
+            else:
+                self._stats['hits'] += 1
+                return reader, writer
+            writer.close()
+        self._stats['misses'] += 1
+        return None
+
+    async def _resolve(self) -> str:
+        now = time.monotonic()
+        if self._address is None or now - self._resolved_at > _RESOLVE_TTL:
+            try:
+                infos = await asyncio.get_running_loop().getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+                self._address = infos[0][4][0]
+                self._resolved_at = now
+            except OSError as e:
+                if self._address is None:
+                    raise
+                conn_log.warning('Falha ao resolver %s, usando %s: %s', self.host, self._address, e)
+        return self._address
+
+    async def _connect(self) -> Optional[Exception]:
+        if not await backend_connect_slots.acquire(BACKEND_QUEUE_TIMEOUT):
+            return None
+        writer = None
+        started = time.perf_counter()
+        try:
+            address = await self._resolve()
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(address, self.port), _CONNECT_TIMEOUT)
+            configure_socket(writer)
+            await asyncio.wait_for(negotiate_backend_tls(reader, writer, self.host), _CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ProtocolError) as e:
+            self._stats['connect_errors'] += 1
+            if writer is not None:
+                writer.close()
+            return e
+        finally:
+            backend_connect_slots.release()
+        warm_backend_refill_seconds.observe(time.perf_counter() - started)
+        self._stats['created'] += 1
+        self._idle.append((time.monotonic(), reader, writer))
+        return None
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        for item in list(self._idle):
+            created, reader, writer = item
+            if now - created >= self.max_age:
+                self._stats['expired'] += 1
+            elif _usable(reader, writer):
+                continue
+            else:
+                self._stats['broken'] += 1
+            self._idle.remove(item)
+            writer.close()
+
+    async def run(self) -> None:
+        interval = min(5.0, max(0.5, self.max_age / 4))
+        while True:
+            self._wakeup.clear()
+            self._expire()
+            missing = self.size - len(self._idle)
+            if missing > 0:
+                errors = [e for e in await asyncio.gather(*(self._connect() for _ in range(missing))) if e]
+                if errors:
+                    # PostgreSQL indisponível: espera antes de tentar de novo
+                    conn_log.warning(
+                        'Falha ao abrir %s de %s conexões antecipadas com %s:%s: %s',
+                        len(errors), missing, self.host, self.port, errors[0],
+                    )
+                    await asyncio.sleep(interval)
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self) -> None:
+        while self._idle:
+            self._idle.pop()[2].close()
+
+    def stats(self) -> Dict[str, int]:
+        stats = dict(self._stats)
+        stats['idle'] = len(self._idle)
+        return stats
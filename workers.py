@@ -0,0 +1,279 @@
+import asyncio
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import time
+from typing import Dict, List, Optional
+
+from config import PROXY_UVLOOP, WORKER_STATS_INTERVAL
+from proxy_logging import setup_logging, shutdown_logging, worker_log
+from tls import load_tls_contexts
+
+# Modo multiprocesso: o supervisor cria N trabalhadores com fork, cada um com
+# seu próprio event loop escutando a mesma porta. Com SO_REUSEPORT o kernel
+# distribui as conexões entre os processos; sem ele, os trabalhadores herdam
+# um único socket aberto pelo supervisor. Trabalhadores que morrem são
+# recriados e cada um envia suas estatísticas ao supervisor por um pipe.
+
+# Trabalhador que morre antes disso é considerado falha na inicialização e
+# só é recriado após uma espera crescente
+_MIN_UPTIME = 5.0
+_MAX_RESTART_DELAY = 30.0
+
+
+def install_event_loop() -> None:
+    if not PROXY_UVLOOP:
+        return
+    try:
+        import uvloop
+    except ImportError:
+        worker_log.warning('PROXY_UVLOOP ativo, mas uvloop não está instalado; usando o event loop padrão do asyncio')
+        return
+    uvloop.install()
+    worker_log.info('Usando uvloop como event loop')
+
+
+async def _report_stats(fd: int, index: int, interval: float, parent_pid: int) -> None:
+    from proxy_server import server_stats
+
+    while True:
+        await asyncio.sleep(interval)
+        if os.getppid() != parent_pid:
+            # Supervisor morreu: não deixar trabalhadores órfãos
+            shutdown_logging()
+            os._exit(0)
+        line = json.dumps({'worker': index, 'pid': os.getpid(), **server_stats()}) + '\n'
+        try:
+            os.write(fd, line.encode('utf-8'))
+        except BlockingIOError:
+            pass
+
+
+async def _worker_async(index: int, host: str, port: int, stats_fd: int, sock: Optional[socket.socket], parent_pid: int) -> None:
+    from proxy_server import run_server
+
+    interval = max(1, min(WORKER_STATS_INTERVAL, 10))
+    reporter = asyncio.create_task(_report_stats(stats_fd, index, interval, parent_pid))
+    try:
+        await run_server(host, port, reuse_port=sock is None, sock=sock, worker_index=index)
+    finally:
+        reporter.cancel()
+
+
+def _worker_main(index: int, host: str, port: int, stats_fd: int, sock: Optional[socket.socket], parent_pid: int) -> None:
+    # O supervisor trata Ctrl+C e encerra os trabalhadores com SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Trace e profile (tracing.py): ignorados até o event loop instalar os seus
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+    setup_logging()
+    os.set_blocking(stats_fd, False)
+    install_event_loop()
+    code = 0
+    try:
+        asyncio.run(_worker_async(index, host, port, stats_fd, sock, parent_pid))
+    except Exception as e:
+        worker_log.error('Trabalhador %s encerrado com erro: %s', index, e, extra={'worker': index})
+        code = 1
+    shutdown_logging()
+    os._exit(code)
+
+
+def _reuse_port_supported() -> bool:
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        return False
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+            probe.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        return True
+    except OSError:
+        return False
+
+
+def _shared_listen_socket(host: str, port: int) -> socket.socket:
+    info = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(info[0], socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(info[4])
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+
+class _Worker:
+    __slots__ = ('index', 'pid', 'stats_fd', 'started_at', 'failures', 'restart_at', 'buffer')
+
+    def __init__(self, index: int) -> None:
+        self.index = index
+        self.pid = 0
+        self.stats_fd = -1
+        self.started_at = 0.0
+        self.failures = 0
+        self.restart_at = 0.0
+        self.buffer = b''
+
+
+class Supervisor:
+    def __init__(self, host: str, port: int, count: int) -> None:
+        self.host = host
+        self.port = port
+        self.workers = [_Worker(i) for i in range(count)]
+        self.latest_stats: Dict[int, dict] = {}
+        self.stopping = False
+        self.sock: Optional[socket.socket] = None
+
+    def _spawn(self, worker: _Worker) -> None:
+        read_fd, write_fd = os.pipe()
+        parent_pid = os.getpid()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            for other in self.workers:
+                if other.stats_fd >= 0:
+                    os.close(other.stats_fd)
+            _worker_main(worker.index, self.host, self.port, write_fd, self.sock, parent_pid)
+        os.close(write_fd)
+        worker.pid = pid
+        worker.stats_fd = read_fd
+        worker.started_at = time.monotonic()
+        worker.buffer = b''
+        worker_log.info('Trabalhador %s iniciado (pid %s)', worker.index, pid, extra={'worker': worker.index})
+
+    def _read_stats(self, worker: _Worker) -> None:
+        try:
+            data = os.read(worker.stats_fd, 65536)
+        except OSError:
+            data = b''
+        if not data:
+            os.close(worker.stats_fd)
+            worker.stats_fd = -1
+            return
+        lines = (worker.buffer + data).split(b'\n')
+        worker.buffer = lines.pop()
+        for line in lines:
+            try:
+                self.latest_stats[worker.index] = json.loads(line)
+            except ValueError:
+                pass
+
+    def _reap(self) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            for worker in self.workers:
+                if worker.pid != pid:
+                    continue
+                worker.pid = 0
+                self.latest_stats.pop(worker.index, None)
+                if worker.stats_fd >= 0:
+                    os.close(worker.stats_fd)
+                    worker.stats_fd = -1
+                if self.stopping:
+                    break
+                uptime = time.monotonic() - worker.started_at
+                worker.failures = worker.failures + 1 if uptime < _MIN_UPTIME else 0
+                delay = min(_MAX_RESTART_DELAY, 0.5 * (2 ** worker.failures)) if worker.failures else 0.0
+                worker.restart_at = time.monotonic() + delay
+                worker_log.warning(
+                    'Trabalhador %s (pid %s) terminou com status %s; reiniciando em %.1fs',
+                    worker.index, pid, os.waitstatus_to_exitcode(status), delay, extra={'worker': worker.index},
+                )
+
+    def aggregated_stats(self) -> Dict[str, int]:
+        totals: Dict[str, int] = {}
+        for stats in self.latest_stats.values():
+            for name, value in stats.items():
+                if name in ('worker', 'pid') or not isinstance(value, (int, float)):
+                    continue
+                totals[name] = totals.get(name, 0) + value
+        totals['workers_alive'] = sum(1 for w in self.workers if w.pid)
+        return totals
+
+    def _print_stats(self) -> None:
+        totals = self.aggregated_stats()
+        summary = ', '.join(f'{name}={value}' for name, value in sorted(totals.items()))
+        worker_log.info('Estatísticas agregadas: %s', summary)
+
+    def _stop(self, signum, frame) -> None:
+        self.stopping = True
+
+    def _forward_signal(self, signum, frame) -> None:
+        # SIGUSR1/SIGUSR2 (trace e profile) valem para todos os trabalhadores
+        for worker in self.workers:
+            if worker.pid:
+                try:
+                    os.kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def run(self) -> None:
+        if not _reuse_port_supported():
+            worker_log.warning('SO_REUSEPORT indisponível: trabalhadores vão compartilhar um socket herdado')
+            self.sock = _shared_listen_socket(self.host, self.port)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGUSR1, self._forward_signal)
+        signal.signal(signal.SIGUSR2, self._forward_signal)
+        # Contextos TLS criados antes do fork: os trabalhadores compartilham as
+        # chaves dos session tickets e qualquer um deles retoma a sessão
+        load_tls_contexts()
+        for worker in self.workers:
+            self._spawn(worker)
+
+        next_report = time.monotonic() + WORKER_STATS_INTERVAL
+        while not self.stopping:
+            fds: List[int] = [w.stats_fd for w in self.workers if w.stats_fd >= 0]
+            try:
+                readable, _, _ = select.select(fds, [], [], 0.5)
+            except InterruptedError:
+                readable = []
+            except OSError as e:
+                if e.errno != errno.EINTR:
+                    raise
+                readable = []
+            for worker in self.workers:
+                if worker.stats_fd in readable:
+                    self._read_stats(worker)
+            self._reap()
+            now = time.monotonic()
+            if not self.stopping:
+                for worker in self.workers:
+                    if worker.pid == 0 and now >= worker.restart_at:
+                        self._spawn(worker)
+            if WORKER_STATS_INTERVAL > 0 and now >= next_report:
+                self._print_stats()
+                next_report = now + WORKER_STATS_INTERVAL
+
+        worker_log.info('Encerrando trabalhadores...')
+        for worker in self.workers:
+            if worker.pid:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        deadline = time.monotonic() + 10
+        while any(w.pid for w in self.workers) and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for worker in self.workers:
+            if worker.pid:
+                os.kill(worker.pid, signal.SIGKILL)
+
+
+def run_workers(host: str, port: int, count: int) -> None:
+    if not hasattr(os, 'fork'):
+        worker_log.warning('PROXY_WORKERS > 1 requer fork (indisponível nesta plataforma); usando um único processo')
+        from proxy_server import run_server
+
+        install_event_loop()
+        asyncio.run(run_server(host, port))
+        return
+    Supervisor(host, port, count).run()